@@ -10,11 +10,13 @@ import hashlib
 from app.database import Database
 from app.utils import rate_limiter
 from app.config import get_settings
+from app.metrics import rate_limited, timed
 
 # Cache simple para rate limiting y locks
 _rate_limit_cache = {}
 _retrain_lock = {"is_running": False, "started_at": None}
 
+@timed('auth')
 def verify_api_key(x_api_key: str = Header(...)) -> str:
     """
     Valida la API key y retorna el site_id (para endpoints normales)
@@ -80,6 +82,7 @@ def check_rate_limit(request: Request, x_api_key: str = Header(...)):
     identifier = f"{x_api_key}:{client_ip}"
     
     if not rate_limiter.is_allowed(identifier, max_requests=1000, window_seconds=3600):
+        rate_limited('api')
         remaining = rate_limiter.get_remaining(identifier, max_requests=1000)
         raise HTTPException(
             status_code=429,
@@ -114,6 +117,7 @@ def check_admin_rate_limit(identifier: str, max_requests: int = 1, window_minute
         data = _rate_limit_cache[identifier]
         
         if data["count"] >= max_requests:
+            rate_limited('admin')
             time_left = window_minutes - (now - data["first_request"]).seconds // 60
             raise HTTPException(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
@@ -20,6 +20,7 @@ from app.features import extract_features
 from app.utils import sanitize_input, calculate_spam_score_explanation
 from app.ml_model import spam_detector
 from app.config import get_settings
+from app.metrics import stage
 
 router = APIRouter(prefix="/api/v1", tags=["spam-detection"])
 logger = logging.getLogger(__name__)
@@ -102,25 +103,29 @@ async def analyze_comment(
         }
         
         # 1. Extraer características
-        features = extract_features(comment_data)
+        with stage('feature_extraction'):
+            features = extract_features(comment_data)
         
         # 2. Predicción con modelo ML
-        prediction = spam_detector.predict(features)
+        with stage('ml_inference'):
+            prediction = spam_detector.predict(features)
         
         # 3. Generar explicación detallada
-        explanation = calculate_spam_score_explanation(
-            features,
-            prediction['is_spam'],
-            prediction['confidence']
-        )
+        with stage('explanation'):
+            explanation = calculate_spam_score_explanation(
+                features,
+                prediction['is_spam'],
+                prediction['confidence']
+            )
         
         # 4. Guardar análisis en base de datos
-        comment_id = Database.save_comment_analysis(
-            site_id=site_id,
-            comment_data=comment_data,
-            features=features,
-            prediction=prediction
-        )
+        with stage('db_write'):
+            comment_id = Database.save_comment_analysis(
+                site_id=site_id,
+                comment_data=comment_data,
+                features=features,
+                prediction=prediction
+            )
         
         return PredictionResponse(
             is_spam=prediction['is_spam'],
@@ -1,18 +1,40 @@
 """
 Rutas de la API para el módulo Antivirus
 """
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
-from typing import Optional, List
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Request, Query
+from fastapi.responses import StreamingResponse
+from typing import Dict, Optional, List
 from pydantic import BaseModel, Field
-from datetime import datetime
+from datetime import datetime, timedelta
 import asyncio
+import json
+import logging
+import os
+import re
 
-from app.api.dependencies import verify_api_key, check_rate_limit
+from app.api.dependencies import verify_api_key, verify_admin_api_key, check_rate_limit
 from app.modules.antivirus.scanner import FileScanner
-from app.modules.antivirus.signatures import SignatureManager
+from app.modules.antivirus.results import ScanAggregator
+from app.modules.antivirus.progress import (
+    ScanProgressReporter, get_live_progress, subscribe, unsubscribe, publish_event, is_running_here
+)
+from app.modules.antivirus.signatures import get_signature_manager
+from app.modules.antivirus.allowlist import get_allowlist
+from app.modules.antivirus.verdicts import VerdictCache, get_verdict_cache, verdict_version
+from app.modules.antivirus.archive import ArchiveBudget, CappedReader, StreamBridge, iter_archive_members
+from app.modules.antivirus.quarantine import get_content_store, get_quarantine_store
+from app.modules.antivirus.stats import get_site_stats, invalidate_site_stats
+from app.modules.antivirus.jobs import ScanJob, ScanScheduler, ScanCancelled, worker_id
+from app.modules.antivirus.profiling import get_signature_profiler, get_signature_feedback
+from app.modules.antivirus.sandbox import get_regex_sandbox
+from app.modules.antivirus.rescan import DifferentialRescanner, RescanScheduler, SiteFileIndex, retain_content
+from app.modules.antivirus.walker import get_site_root, resolve_in_root
 from app.database import supabase
+from app.config import get_settings
+from app.metrics import rate_limited
 
 router = APIRouter(prefix="/api/v1/antivirus", tags=["antivirus"])
+logger = logging.getLogger(__name__)
 
 # ============================================
 # MODELOS PYDANTIC
@@ -32,6 +54,60 @@ class ScanRequest(BaseModel):
         }
 
 
+class ManifestEntry(BaseModel):
+    path: str = Field(..., min_length=1, max_length=1024)
+    size: int = Field(..., ge=0)
+    sha256: str = Field(..., pattern="^[a-fA-F0-9]{64}$")
+
+
+class ManifestScanRequest(BaseModel):
+    scan_type: str = Field("full", pattern="^(quick|full|custom)$")
+    max_size_mb: int = Field(10, ge=1, le=50)
+    files: List[ManifestEntry] = Field(..., min_length=1, max_length=200000)
+    
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "scan_type": "full",
+                "max_size_mb": 10,
+                "files": [
+                    {
+                        "path": "wp-content/plugins/akismet/akismet.php",
+                        "size": 2675,
+                        "sha256": "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"
+                    }
+                ]
+            }
+        }
+
+
+class ThreatFilter(BaseModel):
+    scan_id: str
+    signature: Optional[str] = None
+    path_prefix: Optional[str] = Field(None, min_length=1, max_length=1024)
+
+
+class BulkThreatUpdate(BaseModel):
+    """Lista de ids o filtro (uno de los dos)"""
+    threat_ids: Optional[List[str]] = Field(None, min_length=1, max_length=1000)
+    filter: Optional[ThreatFilter] = None
+    
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "filter": {
+                    "scan_id": "2b7e1b6c-0000-0000-0000-000000000000",
+                    "signature": "Eval with Base64",
+                    "path_prefix": "wp-content/uploads/"
+                }
+            }
+        }
+
+
+class BulkThreatStatusUpdate(BulkThreatUpdate):
+    status: str = Field(..., pattern="^(active|ignored|resolved|quarantined)$")
+
+
 class ScanProgressResponse(BaseModel):
     scan_id: str
     status: str
@@ -47,7 +123,8 @@ class ThreatDetail(BaseModel):
     threat_type: str
     severity: str
     signature_matched: str
-    code_snippet: str
+    line_number: Optional[int] = None
+    code_snippet: Optional[str] = None  # Se omite en modo summary
     detected_at: str
 
 
@@ -60,6 +137,7 @@ class ScanResultResponse(BaseModel):
     files_scanned: int
     threats_found: int
     threats: List[ThreatDetail]
+    next_cursor: Optional[str] = None  # Cursor de la siguiente página (None: no hay más)
 
 
 # ============================================
@@ -69,7 +147,6 @@ class ScanResultResponse(BaseModel):
 @router.post("/scan/start")
 async def start_scan(
     scan_request: ScanRequest,
-    background_tasks: BackgroundTasks,
     site_id: str = Depends(verify_api_key),
     _: bool = Depends(check_rate_limit)
 ):
@@ -79,10 +156,29 @@ async def start_scan(
     Tipos de escaneo:
     - quick: Solo wp-content/plugins y wp-content/themes
     - full: Todo el sitio WordPress
-    - custom: Rutas específicas
+    - custom: Rutas específicas (relativas a la raíz del sitio)
+    
+    Solo para sitios con directorio local en el servidor (SCAN_SITES_ROOT);
+    el resto usa /scan/manifest o /scan/archive.
+    
+    El escaneo queda en cola (status 'pending') hasta que haya un worker
+    libre y el sitio no supere su límite de escaneos simultáneos.
     """
+    settings = get_settings()
+    if get_site_root(settings.scan_sites_root, site_id) is None:
+        raise HTTPException(status_code=409, detail="Local scans are not available for this site; use /scan/manifest")
+    
+    if scan_scheduler.queue_length(site_id) >= settings.scan_max_queued_per_site:
+        rate_limited('scan_queue')
+        raise HTTPException(status_code=429, detail="Too many queued scans for this site")
+    
     try:
-        # Crear registro de escaneo en la BD
+        options = {
+            'paths': scan_request.paths,
+            'max_size_mb': scan_request.max_size_mb
+        }
+        
+        # Crear registro de escaneo en la BD (es también la cola persistente)
         scan_data = {
             'site_id': site_id,
             'scan_type': scan_request.scan_type,
@@ -90,27 +186,21 @@ async def start_scan(
             'started_at': datetime.utcnow().isoformat(),
             'files_scanned': 0,
             'threats_found': 0,
-            'progress': 0
+            'progress': 0,
+            'options': options
         }
         
         result = supabase.table('scans').insert(scan_data).execute()
         scan_id = result.data[0]['id']
         
-        # Iniciar escaneo en background
-        background_tasks.add_task(
-            run_scan_background,
-            scan_id,
-            site_id,
-            scan_request.scan_type,
-            scan_request.paths,
-            scan_request.max_size_mb
-        )
+        await scan_scheduler.submit(ScanJob(scan_id, site_id, {'scan_type': scan_request.scan_type, **options}))
         
         return {
             "success": True,
             "scan_id": scan_id,
-            "message": "Scan started successfully",
+            "message": "Scan queued successfully",
             "status": "pending",
+            "queue_position": scan_scheduler.position(scan_id),
             "check_progress_at": f"/api/v1/antivirus/scan/{scan_id}/progress"
         }
         
@@ -118,6 +208,407 @@ async def start_scan(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/scan/manifest")
+async def start_manifest_scan(
+    manifest: ManifestScanRequest,
+    site_id: str = Depends(verify_api_key),
+    _: bool = Depends(check_rate_limit)
+):
+    """
+    Iniciar un escaneo a partir del manifiesto de archivos del sitio
+    
+    1. El plugin envía {path, size, sha256} de cada archivo
+    2. La API responde solo con los archivos cuyo contenido no conoce
+       (ni limpio ni malicioso en escaneos anteriores de cualquier sitio)
+    3. El plugin sube esos archivos a /scan/{scan_id}/upload
+    """
+    try:
+        allowlist = get_allowlist()
+        max_size_bytes = manifest.max_size_mb * 1024 * 1024
+        
+        known_clean = 0
+        skipped_large = 0
+        to_lookup = []
+        pending = {}  # sha256 -> rutas con ese contenido
+        
+        # 1. Hashes conocidos localmente (sin consultar la BD)
+        for entry in manifest.files:
+            sha256 = entry.sha256.lower()
+            digest = bytes.fromhex(sha256)
+            if allowlist.is_modified(entry.path, digest):
+                # Archivo del core modificado: hay que verlo aunque el contenido sea conocido
+                pending.setdefault(sha256, []).append(entry.path)
+            elif allowlist.is_known_good(digest):
+                known_clean += 1
+            else:
+                to_lookup.append((entry, sha256))
+        
+        # 2. Veredictos de escaneos anteriores (todos los sitios)
+        # Memoria, un MGET en Redis y consultas por lotes, fuera del event loop
+        verdicts = await asyncio.to_thread(
+            _get_verdict_cache().get_many,
+            [sha256 for _, sha256 in to_lookup]
+        )
+        known_bad = []
+        for entry, sha256 in to_lookup:
+            verdict = verdicts.get(sha256)
+            if verdict is None:
+                if entry.size > max_size_bytes:
+                    skipped_large += 1
+                else:
+                    pending.setdefault(sha256, []).append(entry.path)
+            elif verdict['verdict'] == 'malicious':
+                known_bad.append((entry.path, sha256, verdict))
+            else:
+                known_clean += 1
+        
+        pending_files = sum(len(paths) for paths in pending.values())
+        summary = {
+            'mode': 'manifest',
+            'total_files': len(manifest.files),
+            'known_clean': known_clean,
+            'known_malicious': len(known_bad),
+            'skipped_large': skipped_large,
+            'pending_files': pending_files,
+            'max_size_mb': manifest.max_size_mb
+        }
+        
+        # Crear registro de escaneo en la BD
+        scan_data = {
+            'site_id': site_id,
+            'scan_type': manifest.scan_type,
+            'status': 'awaiting_upload' if pending else 'completed',
+            'started_at': datetime.utcnow().isoformat(),
+            'files_scanned': known_clean + len(known_bad),
+            'threats_found': len(known_bad),
+            'progress': 100 if not pending else int((len(manifest.files) - pending_files) / len(manifest.files) * 100),
+            'results': summary
+        }
+        if not pending:
+            scan_data['completed_at'] = scan_data['started_at']
+        
+        result = supabase.table('scans').insert(scan_data).execute()
+        scan_id = result.data[0]['id']
+        
+        # Ruta -> contenido de lo que no es core conocido (para los reescaneos diferenciales)
+        file_index = SiteFileIndex(supabase, site_id)
+        for entry, sha256 in to_lookup:
+            file_index.add(entry.path, sha256)
+        for sha256, paths in pending.items():
+            for path in paths:
+                file_index.add(path, sha256)
+        file_index.flush()
+        
+        # Amenazas ya conocidas: se registran sin subir nada
+        threat_writer = ThreatBatchWriter(scan_id, site_id)
+        for path, sha256, verdict in known_bad:
+            await threat_writer.add({'file_path': path, 'file_sha256': sha256, 'threats': verdict['threats']})
+        await threat_writer.flush()
+        
+        # Contenido pendiente de subir
+        rows = [
+            {'scan_id': scan_id, 'sha256': sha256, 'path': path}
+            for sha256, paths in pending.items()
+            for path in paths
+        ]
+        for i in range(0, len(rows), 1000):
+            supabase.table('scan_pending_files').insert(rows[i:i + 1000]).execute()
+        
+        return {
+            "success": True,
+            "scan_id": scan_id,
+            "status": scan_data['status'],
+            **summary,
+            # Un solo archivo por contenido distinto
+            "upload": [
+                {"path": paths[0], "sha256": sha256}
+                for sha256, paths in pending.items()
+            ],
+            "upload_at": f"/api/v1/antivirus/scan/{scan_id}/upload"
+        }
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/scan/{scan_id}/upload")
+async def upload_scan_files(
+    scan_id: str,
+    files: List[UploadFile] = File(...),
+    site_id: str = Depends(verify_api_key),
+    _: bool = Depends(check_rate_limit)
+):
+    """
+    Subir los archivos pedidos por /scan/manifest
+    
+    El nombre (filename) de cada archivo debe ser su ruta en el sitio y
+    tiene que estar entre las pedidas: el resto se rechaza sin leerlo. Cada
+    archivo se corta al pasar de max_size_mb (el del manifiesto) mientras se
+    escanea. El veredicto se aplica a todas las rutas del manifiesto con el
+    mismo contenido.
+    """
+    try:
+        scan_result = supabase.table('scans')\
+            .select('status, files_scanned, threats_found, total_files:results->total_files, max_size_mb:results->max_size_mb')\
+            .eq('id', scan_id)\
+            .eq('site_id', site_id)\
+            .single()\
+            .execute()
+        
+        if not scan_result.data:
+            raise HTTPException(status_code=404, detail="Scan not found")
+        
+        scan = scan_result.data
+        if scan['status'] != 'awaiting_upload':
+            raise HTTPException(status_code=409, detail=f"Scan is not awaiting uploads (status: {scan['status']})")
+        
+        scanner = _create_scanner()
+        threat_writer = ThreatBatchWriter(scan_id, site_id)
+        settings = get_settings()
+        
+        max_size_bytes = int(scan.get('max_size_mb') or 10) * 1024 * 1024
+        
+        # Rutas pedidas entre las subidas (una consulta para toda la petición)
+        requested_result = supabase.table('scan_pending_files')\
+            .select('path')\
+            .eq('scan_id', scan_id)\
+            .in_('path', list({upload.filename for upload in files}))\
+            .execute()
+        requested = {row['path'] for row in requested_result.data or []}
+        
+        accepted = []
+        rejected = []
+        files_scanned = 0
+        threats_found = 0
+        
+        for upload in files:
+            if upload.filename not in requested:
+                rejected.append({'path': upload.filename, 'error': 'Path not requested by manifest'})
+                continue
+            if upload.size is not None and upload.size > max_size_bytes:
+                rejected.append({'path': upload.filename, 'error': 'File too large'})
+                continue
+            
+            result = await scanner.scan_stream(CappedReader(upload.file, max_size_bytes), upload.filename, upload.size)
+            if result.get('error'):
+                rejected.append({'path': upload.filename, 'error': result['error']})
+                continue
+            
+            # El hash se calcula en el servidor: solo se acepta contenido pedido en el manifiesto
+            sha256 = result['file_sha256']
+            pending_result = supabase.table('scan_pending_files')\
+                .select('path')\
+                .eq('scan_id', scan_id)\
+                .eq('sha256', sha256)\
+                .execute()
+            paths = [row['path'] for row in pending_result.data or []]
+            
+            if not paths:
+                rejected.append({'path': upload.filename, 'error': 'Content not requested by manifest'})
+                continue
+            
+            if result['is_malicious']:
+                # Conservar el contenido (deduplicado) para poder ponerlo en cuarentena
+                upload.file.seek(0)
+                await asyncio.to_thread(get_quarantine_store().put_fileobj, upload.file)
+            
+            if settings.scan_retain_content and result['file_size'] <= settings.scan_retain_max_kb * 1024:
+                # Y para pasarle las firmas que lleguen más adelante (reescaneo diferencial)
+                upload.file.seek(0)
+                await asyncio.to_thread(get_content_store().put_fileobj, upload.file)
+            
+            content_threats = VerdictCache.content_threats(result)
+            for path in paths:
+                path_threats = result['threats'] if path == upload.filename else content_threats
+                if path_threats:
+                    threats_found += 1
+                    await threat_writer.add({'file_path': path, 'file_sha256': sha256, 'threats': path_threats})
+            files_scanned += len(paths)
+            
+            supabase.table('scan_pending_files')\
+                .delete()\
+                .eq('scan_id', scan_id)\
+                .eq('sha256', sha256)\
+                .execute()
+            
+            accepted.append({
+                'sha256': sha256,
+                'paths': len(paths),
+                'is_malicious': result['is_malicious']
+            })
+        
+        await threat_writer.flush()
+        await asyncio.to_thread(scanner.verdict_cache.flush)
+        
+        # ¿Quedan archivos por subir?
+        remaining = supabase.table('scan_pending_files')\
+            .select('sha256', count='exact')\
+            .eq('scan_id', scan_id)\
+            .limit(1)\
+            .execute()
+        remaining_count = remaining.count or 0
+        
+        total_files = int(scan.get('total_files') or 0)
+        update_data = {
+            'files_scanned': scan['files_scanned'] + files_scanned,
+            'threats_found': scan['threats_found'] + threats_found,
+            'progress': int((total_files - remaining_count) / max(total_files, 1) * 100)
+        }
+        if remaining_count == 0:
+            update_data.update({
+                'status': 'completed',
+                'progress': 100,
+                'completed_at': datetime.utcnow().isoformat()
+            })
+        
+        supabase.table('scans').update(update_data).eq('id', scan_id).execute()
+        
+        return {
+            "success": True,
+            "scan_id": scan_id,
+            "accepted": accepted,
+            "rejected": rejected,
+            "remaining_files": remaining_count,
+            "status": update_data.get('status', 'awaiting_upload')
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/scan/archive")
+async def scan_archive(
+    request: Request,
+    scan_type: str = Query("full", pattern="^(quick|full|custom)$"),
+    archive_format: str = Query("auto", alias="format", pattern="^(auto|tar|zip)$"),
+    max_size_mb: int = Query(10, ge=1, le=50),
+    site_id: str = Depends(verify_api_key),
+    _: bool = Depends(check_rate_limit)
+):
+    """
+    Escanear un sitio completo enviado como tar (gz/bz2/xz) o zip en el cuerpo
+    
+    El archivo se procesa en streaming desde la petición: cada entrada pasa
+    directamente al scanner, nada se escribe a disco y el archivo nunca está
+    entero en memoria. El cuerpo es el archivo en bruto (no multipart).
+    """
+    scan_data = {
+        'site_id': site_id,
+        'scan_type': scan_type,
+        'status': 'running',
+        'started_at': datetime.utcnow().isoformat(),
+        'files_scanned': 0,
+        'threats_found': 0,
+        'progress': 0
+    }
+    
+    try:
+        result = supabase.table('scans').insert(scan_data).execute()
+        scan_id = result.data[0]['id']
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    loop = asyncio.get_running_loop()
+    bridge = StreamBridge(loop)
+    scanner = _create_scanner()
+    threat_writer = ThreatBatchWriter(scan_id, site_id)
+    aggregator = ScanAggregator(threat_sink=threat_writer.add)
+    file_index = SiteFileIndex(supabase, site_id)
+    reporter = ScanProgressReporter(
+        scan_id,
+        site_id,
+        db_writer=lambda data: supabase.table('scans').update(data).eq('id', scan_id).execute()
+    )
+    content_length = int(request.headers.get('content-length') or 0)
+    max_size_bytes = max_size_mb * 1024 * 1024
+    settings = get_settings()
+    budget = ArchiveBudget(settings.scan_archive_max_members, settings.scan_archive_max_mb * 1024 * 1024)
+    
+    async def on_result(scan_result: dict):
+        await aggregator.add(scan_result)
+        if not scan_result.get('known_good'):
+            # Solo el índice: el contenido llega en streaming y no se guarda
+            file_index.add_result(scan_result)
+        if scan_result.get('is_malicious'):
+            reporter.report_threat(scan_result)
+        progress = min(99, bridge.bytes_read * 100 // content_length) if content_length else 0
+        await reporter.update(
+            progress,
+            aggregator.scanned_files,
+            aggregator.threats_found,
+            scan_result.get('file_path')
+        )
+    
+    def scan_members():
+        # Se ejecuta en un hilo: lee del puente y entrega cada resultado al event loop
+        # Bombas: el presupuesto corta el archivo entero; una entrada de tamaño
+        # desconocido que pasa de max_size_mb queda como error de ese archivo
+        for name, size, mtime, member in iter_archive_members(bridge, archive_format, budget, max_size_bytes):
+            if os.path.splitext(name)[1].lower() != '.php':
+                continue
+            aggregator.total_files += 1
+            if size is not None and size > max_size_bytes:
+                continue
+            scan_result = scanner.scan_fileobj(member, name, size, mtime)
+            asyncio.run_coroutine_threadsafe(on_result(scan_result), loop).result()
+    
+    async def feed_body():
+        try:
+            async for chunk in request.stream():
+                await bridge.feed(chunk)
+            await bridge.close_feed()
+        except Exception as e:
+            await bridge.close_feed(e)
+    
+    feeder = asyncio.create_task(feed_body())
+    status = 'failed'
+    try:
+        await asyncio.to_thread(scan_members)
+        await threat_writer.flush()
+        await asyncio.to_thread(scanner.verdict_cache.flush)
+        file_index.flush()
+        results = aggregator.summary()
+        
+        supabase.table('scans')\
+            .update({
+                'status': 'completed',
+                'completed_at': datetime.utcnow().isoformat(),
+                'progress': 100,
+                'files_scanned': results['scanned_files'],
+                'threats_found': results['threats_found'],
+                'results': results
+            })\
+            .eq('id', scan_id)\
+            .execute()
+        status = 'completed'
+        
+        return {
+            "success": True,
+            "scan_id": scan_id,
+            "status": "completed",
+            "results": results
+        }
+        
+    except Exception as e:
+        logger.error(f"❌ Archive scan {scan_id} failed: {str(e)}")
+        supabase.table('scans')\
+            .update({
+                'status': 'failed',
+                'completed_at': datetime.utcnow().isoformat(),
+                'results': {'error': str(e)}
+            })\
+            .eq('id', scan_id)\
+            .execute()
+        raise HTTPException(status_code=400, detail=f"Error scanning archive: {str(e)}")
+        
+    finally:
+        feeder.cancel()  # El resto del cuerpo (relleno, directorio central) no se necesita
+        invalidate_site_stats(site_id)
+        await reporter.finish(status)
+
+
 @router.get("/scan/{scan_id}/progress", response_model=ScanProgressResponse)
 async def get_scan_progress(
     scan_id: str,
@@ -125,10 +616,24 @@ async def get_scan_progress(
 ):
     """
     Obtener progreso de un escaneo en curso
+    
+    Si el escaneo se está ejecutando, el progreso sale de memoria/Redis
+    sin consultar la tabla scans.
     """
     try:
+        live = await get_live_progress(scan_id)
+        if live is not None and live['site_id'] == site_id:
+            return ScanProgressResponse(
+                scan_id=scan_id,
+                status=live['status'],
+                progress=live['progress'],
+                files_scanned=live['files_scanned'],
+                threats_found=live['threats_found'],
+                current_file=live['current_file']
+            )
+        
         result = supabase.table('scans')\
-            .select('*')\
+            .select('status, progress, files_scanned, threats_found, current_file:results->>current_file')\
             .eq('id', scan_id)\
             .eq('site_id', site_id)\
             .single()\
@@ -141,8 +646,8 @@ async def get_scan_progress(
         
         # Obtener archivo actual si está en progreso
         current_file = None
-        if scan['status'] == 'running' and scan.get('results'):
-            current_file = scan['results'].get('current_file')
+        if scan['status'] == 'running':
+            current_file = scan.get('current_file')
         
         return ScanProgressResponse(
             scan_id=scan_id,
@@ -159,18 +664,192 @@ async def get_scan_progress(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+SSE_KEEPALIVE_SECONDS = 15
+SSE_REMOTE_POLL_SECONDS = 1.0
+SSE_PENDING_POLL_SECONDS = 5.0
+TERMINAL_SCAN_STATUSES = ('completed', 'failed', 'cancelled')
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def _scan_snapshot(scan_id: str, site_id: str) -> Optional[dict]:
+    result = supabase.table('scans')\
+        .select('status, progress, files_scanned, threats_found')\
+        .eq('id', scan_id)\
+        .eq('site_id', site_id)\
+        .execute()
+    if not result.data:
+        return None
+    return {'scan_id': scan_id, **result.data[0]}
+
+
+@router.get("/scan/{scan_id}/stream")
+async def stream_scan_events(
+    scan_id: str,
+    request: Request,
+    site_id: str = Depends(verify_api_key)
+):
+    """
+    Eventos de un escaneo en tiempo real (Server-Sent Events)
+    
+    Eventos:
+    - progress: progreso, archivos escaneados y archivo actual
+    - threat: archivo con amenazas, en cuanto se detecta
+    - done: estado final (completed, failed o cancelled)
+    
+    Si el escaneo está en este proceso, los eventos salen directamente del
+    pipeline de escaneo. Si corre en otro worker se sigue su progreso en
+    Redis (sin eventos 'threat'). Mientras el escaneo corre no se consulta
+    la tabla scans.
+    """
+    live = await get_live_progress(scan_id)
+    job = scan_scheduler.get_job(scan_id)
+    snapshot = None
+    
+    if live is not None:
+        owner = live['site_id']
+    elif job is not None:
+        owner = job.site_id
+    else:
+        snapshot = _scan_snapshot(scan_id, site_id)
+        if snapshot is None:
+            raise HTTPException(status_code=404, detail="Scan not found")
+        owner = site_id
+    
+    if owner != site_id:
+        raise HTTPException(status_code=404, detail="Scan not found")
+    
+    async def events():
+        queue = subscribe(scan_id)
+        try:
+            if snapshot is not None and snapshot['status'] in TERMINAL_SCAN_STATUSES:
+                yield _sse('done', snapshot)
+                return
+            
+            initial = live or snapshot
+            if initial is not None:
+                yield _sse('progress', initial)
+            
+            seen_remote = False
+            while not await request.is_disconnected():
+                # Escaneo de este proceso (en cola o en ejecución): eventos directos
+                if not queue.empty() or is_running_here(scan_id) or scan_scheduler.get_job(scan_id):
+                    try:
+                        event, data = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                        continue
+                    yield _sse(event, data)
+                    if event == 'done':
+                        return
+                    continue
+                
+                # Escaneo de otro worker: progreso publicado en Redis
+                state = await get_live_progress(scan_id)
+                if state is not None:
+                    seen_remote = True
+                    yield _sse('progress', state)
+                    await asyncio.sleep(SSE_REMOTE_POLL_SECONDS)
+                    continue
+                
+                # Sin estado en vivo: terminó, o sigue en cola en otro worker
+                current = _scan_snapshot(scan_id, site_id)
+                if current is None or current['status'] in TERMINAL_SCAN_STATUSES:
+                    yield _sse('done', current or {'scan_id': scan_id, 'status': 'unknown'})
+                    return
+                await asyncio.sleep(SSE_REMOTE_POLL_SECONDS if seen_remote else SSE_PENDING_POLL_SECONDS)
+        finally:
+            unsubscribe(scan_id, queue)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Sin buffering en proxies (nginx)
+        }
+    )
+
+
+@router.post("/scan/{scan_id}/cancel")
+async def cancel_scan(
+    scan_id: str,
+    site_id: str = Depends(verify_api_key)
+):
+    """
+    Cancelar un escaneo en cola o en ejecución
+    
+    Un escaneo en ejecución se detiene al terminar el archivo actual;
+    las amenazas ya encontradas se conservan.
+    """
+    try:
+        result = supabase.table('scans')\
+            .update({
+                'status': 'cancelled',
+                'completed_at': datetime.utcnow().isoformat()
+            })\
+            .eq('id', scan_id)\
+            .eq('site_id', site_id)\
+            .in_('status', ['pending', 'running'])\
+            .execute()
+        
+        if not result.data:
+            existing = supabase.table('scans')\
+                .select('status')\
+                .eq('id', scan_id)\
+                .eq('site_id', site_id)\
+                .execute()
+            if not existing.data:
+                raise HTTPException(status_code=404, detail="Scan not found")
+            raise HTTPException(
+                status_code=409,
+                detail=f"Scan cannot be cancelled (status: {existing.data[0]['status']})"
+            )
+        
+        # Si el escaneo está en este proceso se detiene ya; si no, el worker
+        # que lo tenga lo verá al intentar tomarlo o al escribir el resultado
+        scan_scheduler.cancel(scan_id)
+        if not is_running_here(scan_id):
+            # En ejecución, el 'done' lo envía el propio escaneo al parar
+            publish_event(scan_id, 'done', {'scan_id': scan_id, 'status': 'cancelled'})
+        
+        return {
+            "success": True,
+            "scan_id": scan_id,
+            "status": "cancelled"
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.get("/scan/{scan_id}/results", response_model=ScanResultResponse)
 async def get_scan_results(
     scan_id: str,
-    site_id: str = Depends(verify_api_key)
+    site_id: str = Depends(verify_api_key),
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="next_cursor de la página anterior"),
+    severity: Optional[List[str]] = Query(None),
+    summary: bool = Query(False, description="Omitir los fragmentos de código")
 ):
     """
-    Obtener resultados completos de un escaneo
+    Obtener resultados de un escaneo, con las amenazas paginadas
+    
+    Las amenazas se ordenan por severidad (las críticas primero) y después
+    por id, y se paginan con cursor sobre ese par (keyset): para la
+    siguiente página se envía `cursor=<next_cursor>`. El filtro de
+    severidad se aplica en la BD.
     """
+    after = _parse_results_cursor(cursor) if cursor else None
+    
     try:
-        # Obtener escaneo
+        # Obtener escaneo (sin el JSON de resultados)
         scan_result = supabase.table('scans')\
-            .select('*')\
+            .select('status, scan_type, started_at, completed_at, files_scanned, threats_found')\
             .eq('id', scan_id)\
             .eq('site_id', site_id)\
             .single()\
@@ -181,13 +860,31 @@ async def get_scan_results(
         
         scan = scan_result.data
         
-        # Obtener amenazas detectadas
-        threats_result = supabase.table('threats')\
-            .select('*')\
+        # Página de amenazas (una fila de más para saber si hay siguiente)
+        columns = 'id, file_path, threat_type, severity, signature_matched, line_number, detected_at'
+        if not summary:
+            columns += ', code_snippet'
+        
+        query = supabase.table('threats')\
+            .select(columns)\
             .eq('scan_id', scan_id)\
+            .eq('site_id', site_id)
+        if severity:
+            query = query.in_('severity', severity)
+        if after:
+            # Filas después de (severidad, id) en el orden severity desc, id asc
+            last_severity, last_id = after
+            query = query.or_(f"severity.lt.{last_severity},and(severity.eq.{last_severity},id.gt.{last_id})")
+        
+        threats_result = query\
             .order('severity', desc=True)\
+            .order('id')\
+            .limit(limit + 1)\
             .execute()
         
+        rows = threats_result.data or []
+        next_cursor = f"{rows[limit - 1]['severity']}:{rows[limit - 1]['id']}" if len(rows) > limit else None
+        
         threats = [
             ThreatDetail(
                 id=threat['id'],
@@ -195,10 +892,11 @@ async def get_scan_results(
                 threat_type=threat['threat_type'],
                 severity=threat['severity'],
                 signature_matched=threat['signature_matched'],
-                code_snippet=threat['code_snippet'],
+                line_number=threat.get('line_number'),
+                code_snippet=threat.get('code_snippet'),
                 detected_at=threat['detected_at']
             )
-            for threat in threats_result.data
+            for threat in rows[:limit]
         ]
         
         return ScanResultResponse(
@@ -209,7 +907,8 @@ async def get_scan_results(
             completed_at=scan.get('completed_at'),
             files_scanned=scan['files_scanned'],
             threats_found=scan['threats_found'],
-            threats=threats
+            threats=threats,
+            next_cursor=next_cursor
         )
         
     except HTTPException:
@@ -218,6 +917,17 @@ async def get_scan_results(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+_RESULTS_CURSOR = re.compile(r'^([a-z_]+):([0-9a-fA-F-]{1,64})$')
+
+
+def _parse_results_cursor(cursor: str):
+    """(severidad, id) de un next_cursor; se valida porque va dentro de un filtro or()"""
+    match = _RESULTS_CURSOR.match(cursor)
+    if not match:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return match.group(1), match.group(2)
+
+
 @router.get("/scans/recent")
 async def get_recent_scans(
     site_id: str = Depends(verify_api_key),
@@ -250,33 +960,118 @@ async def quarantine_threat(
 ):
     """
     Poner una amenaza en cuarentena
+    
+    El contenido del archivo se guarda en el almacén de cuarentena (si está
+    disponible) y, si viene de un escaneo local, se retira de su ruta.
     """
     try:
-        # Obtener amenaza
         threat_result = supabase.table('threats')\
-            .select('*')\
+            .select('id, scan_id, file_path, file_sha256, status')\
             .eq('id', threat_id)\
             .eq('site_id', site_id)\
-            .single()\
             .execute()
         
         if not threat_result.data:
             raise HTTPException(status_code=404, detail="Threat not found")
         
-        threat = threat_result.data
+        threat = threat_result.data[0]
+        if threat['status'] != 'active':
+            raise HTTPException(status_code=409, detail=f"Threat is not active (status: {threat['status']})")
         
-        # TODO: Implementar lógica de cuarentena real
-        # Por ahora solo actualizamos el estado
+        counts = await _quarantine_threats(site_id, [threat])
         
-        supabase.table('threats')\
-            .update({'status': 'quarantined'})\
-            .eq('id', threat_id)\
+        return {
+            "success": True,
+            "message": "Threat quarantined successfully",
+            "threat_id": threat_id,
+            **counts
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/scan/{scan_id}/quarantine")
+async def quarantine_scan_threats(
+    scan_id: str,
+    site_id: str = Depends(verify_api_key),
+    severity: Optional[List[str]] = Query(None)
+):
+    """
+    Poner en cuarentena todas las amenazas activas de un escaneo
+    
+    Cada contenido distinto se guarda una sola vez y la BD se actualiza
+    con una sentencia por contenido, no por amenaza.
+    """
+    try:
+        def select_active():
+            query = supabase.table('threats')\
+                .select('id, scan_id, file_path, file_sha256')\
+                .eq('scan_id', scan_id)\
+                .eq('site_id', site_id)\
+                .eq('status', 'active')
+            if severity:
+                query = query.in_('severity', severity)
+            return query
+        
+        threats = _select_threats_paged(select_active)
+        
+        if not threats:
+            return {"success": True, "scan_id": scan_id, "quarantined": 0, "blobs": 0, "without_content": 0}
+        
+        counts = await _quarantine_threats(site_id, threats)
+        
+        return {
+            "success": True,
+            "scan_id": scan_id,
+            **counts
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/threat/{threat_id}/restore")
+async def restore_threat(
+    threat_id: str,
+    site_id: str = Depends(verify_api_key)
+):
+    """
+    Sacar de cuarentena el archivo de una amenaza
+    
+    Si la amenaza viene de un escaneo local, el contenido se escribe de
+    nuevo en su ruta (siempre dentro de la raíz del sitio); si no, el plugin
+    puede descargarlo de /threat/{threat_id}/quarantined-content.
+    Todas las amenazas de esa ruta en cuarentena pasan a 'restored'.
+    """
+    try:
+        threat = _get_quarantined_threat(threat_id, site_id)
+        blob = threat['quarantine_blob']
+        restored_to = None
+        
+        local_path = _local_threat_paths(site_id, [threat]).get(threat['id'])
+        if local_path is not None:
+            await asyncio.to_thread(get_quarantine_store().restore, blob, local_path)
+            restored_to = threat['file_path']
+        
+        result = supabase.table('threats')\
+            .update({'status': 'restored'}, count='exact', returning='minimal')\
+            .eq('site_id', site_id)\
+            .eq('file_path', threat['file_path'])\
+            .eq('quarantine_blob', blob)\
+            .eq('status', 'quarantined')\
             .execute()
+        invalidate_site_stats(site_id)
         
         return {
             "success": True,
-            "message": "Threat quarantined successfully",
-            "threat_id": threat_id
+            "threat_id": threat_id,
+            "restored_to": restored_to,
+            "threats_restored": result.count or 0
         }
         
     except HTTPException:
@@ -285,6 +1080,22 @@ async def quarantine_threat(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/threat/{threat_id}/quarantined-content")
+async def get_quarantined_content(
+    threat_id: str,
+    site_id: str = Depends(verify_api_key)
+):
+    """
+    Descargar el contenido original de un archivo en cuarentena
+    """
+    threat = _get_quarantined_threat(threat_id, site_id)
+    return StreamingResponse(
+        get_quarantine_store().iter_content(threat['quarantine_blob']),
+        media_type='application/octet-stream',
+        headers={'X-File-Path': threat['file_path']}
+    )
+
+
 @router.delete("/threat/{threat_id}/ignore")
 async def ignore_threat(
     threat_id: str,
@@ -299,6 +1110,7 @@ async def ignore_threat(
             .eq('id', threat_id)\
             .eq('site_id', site_id)\
             .execute()
+        invalidate_site_stats(site_id)
         
         return {
             "success": True,
@@ -309,106 +1121,464 @@ async def ignore_threat(
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.get("/signatures")
-async def get_signatures(
+@router.post("/threats/bulk-status")
+async def bulk_update_threat_status(
+    update: BulkThreatStatusUpdate,
     site_id: str = Depends(verify_api_key)
 ):
     """
-    Obtener firmas de malware disponibles
+    Cambiar el estado de muchas amenazas en una sola petición
+    
+    Con un filtro (scan_id + firma + prefijo de ruta) el cambio es una
+    única sentencia UPDATE, sin importar cuántas amenazas afecte.
+    'quarantined' pasa por el almacén de cuarentena.
     """
     try:
-        sig_manager = SignatureManager()
-        signatures = sig_manager.load_signatures()
-        
+        updated = await _bulk_set_status(site_id, update, update.status)
         return {
-            "total": len(signatures),
-            "signatures": signatures
+            "success": True,
+            "status": update.status,
+            **updated
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.get("/stats")
-async def get_antivirus_stats(
+@router.post("/threats/bulk-ignore")
+async def bulk_ignore_threats(
+    update: BulkThreatUpdate,
     site_id: str = Depends(verify_api_key)
 ):
     """
-    Obtener estadísticas del antivirus
+    Ignorar (falso positivo) muchas amenazas en una sola petición
     """
     try:
-        # Total de escaneos
-        scans_result = supabase.table('scans')\
-            .select('id', count='exact')\
-            .eq('site_id', site_id)\
-            .execute()
+        updated = await _bulk_set_status(site_id, update, 'ignored')
+        return {
+            "success": True,
+            "message": "Threats marked as false positive",
+            **updated
+        }
         
-        # Amenazas activas
-        threats_result = supabase.table('threats')\
-            .select('id, severity', count='exact')\
-            .eq('site_id', site_id)\
-            .eq('status', 'active')\
-            .execute()
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/signatures")
+async def get_signatures(
+    site_id: str = Depends(verify_api_key)
+):
+    """
+    Obtener firmas de malware disponibles
+    """
+    try:
+        compiled = get_signature_manager().get_compiled()
         
-        # Último escaneo
-        last_scan_result = supabase.table('scans')\
-            .select('*')\
-            .eq('site_id', site_id)\
-            .order('started_at', desc=True)\
-            .limit(1)\
-            .execute()
+        return {
+            "total": len(compiled),
+            "version": compiled.version,
+            "signatures": compiled.signatures
+        }
         
-        last_scan = last_scan_result.data[0] if last_scan_result.data else None
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/admin/signatures/profile", tags=["admin"])
+async def get_signature_profile(
+    admin_key: str = Depends(verify_admin_api_key)
+):
+    """
+    🔒 Coste y eficacia de cada firma (contadores de este proceso)
+    
+    - Tiempo de regex, bytes escaneados y descartes del prefiltro
+    - Aciertos, y falsos positivos estimados a partir de las amenazas ignoradas
+    - Riesgos de backtracking catastrófico detectados por el lint, patrones
+      reescritos al cargar y firmas descartadas por el sondeo de crecimiento
+    - Timeouts y patrones desactivados en el sandbox de regex
+    """
+    try:
+        compiled = get_signature_manager().get_compiled()
+        profiler = get_signature_profiler()
+        profile = profiler.snapshot()
+        lint = compiled.lint()
+        names = [signature['name'] for signature in compiled.signatures]
+        feedback = await asyncio.to_thread(get_signature_feedback, supabase, names)
         
-        # Contar amenazas por severidad
-        threats_by_severity = {}
-        for threat in threats_result.data or []:
-            severity = threat['severity']
-            threats_by_severity[severity] = threats_by_severity.get(severity, 0) + 1
+        signatures = []
+        for signature in compiled.signatures:
+            name = signature['name']
+            stats = profile.get(name) or dict.fromkeys(profiler.FIELDS, 0)
+            evaluations = stats['runs'] + stats['prefilter_skips']
+            seconds = stats['time_ns'] / 1e9
+            signatures.append({
+                "name": name,
+                "id": signature.get('id'),
+                "type": signature.get('type', 'regex'),
+                "severity": signature['severity'],
+                "runs": stats['runs'],
+                "prefilter_skip_rate": round(stats['prefilter_skips'] / evaluations, 4) if evaluations else None,
+                "time_ms": round(stats['time_ns'] / 1e6, 3),
+                "avg_us_per_run": round(stats['time_ns'] / 1e3 / stats['runs'], 2) if stats['runs'] else None,
+                "mb_scanned": round(stats['bytes_scanned'] / 1024 / 1024, 2),
+                "mb_per_second": round(stats['bytes_scanned'] / 1024 / 1024 / seconds, 1) if seconds else None,
+                "hits": stats['hits'],
+                "never_fired": stats['hits'] == 0 and not feedback.get(name),
+                **(feedback.get(name) or {'detections': 0, 'ignored': 0, 'false_positive_rate': None}),
+                "lint": lint.get(name, []),
+                "effective_pattern": signature.get('effective_pattern')
+            })
         
+        signatures.sort(key=lambda s: s['time_ms'], reverse=True)
         return {
-            "total_scans": scans_result.count,
-            "active_threats": threats_result.count,
-            "threats_by_severity": threats_by_severity,
-            "last_scan": {
-                "date": last_scan['started_at'] if last_scan else None,
-                "threats_found": last_scan['threats_found'] if last_scan else 0,
-                "status": last_scan['status'] if last_scan else None
-            }
+            "version": compiled.version,
+            "since": datetime.fromtimestamp(profiler.started_at).isoformat(),
+            "files": profiler.files,
+            "signatures": signatures,
+            "rejected": compiled.rejected,
+            "sandbox": _sandbox_status()
         }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _sandbox_status() -> Optional[dict]:
+    settings = get_settings()
+    if not settings.scan_regex_sandbox:
+        return None
+    sandbox = get_regex_sandbox(settings.scan_workers, settings.scan_regex_pattern_timeout)
+    return {
+        "workers": sandbox.workers,
+        "pattern_timeout": sandbox.pattern_timeout,
+        "file_timeout": settings.scan_regex_file_timeout,
+        "kills": sandbox.kills,
+        "timeouts": {pattern.decode(errors='replace'): strikes for (pattern, _), strikes in sandbox.strikes.items()},
+        "disabled": [pattern.decode(errors='replace') for pattern, _ in sandbox.disabled]
+    }
+
+
+@router.delete("/admin/signatures/profile", tags=["admin"])
+async def reset_signature_profile(
+    admin_key: str = Depends(verify_admin_api_key)
+):
+    """
+    🔒 Poner a cero los contadores de perfilado (p.ej. tras cambiar firmas)
+    """
+    get_signature_profiler().reset()
+    return {"success": True}
+
+
+@router.get("/admin/signatures/rescan", tags=["admin"])
+async def get_differential_rescan(
+    admin_key: str = Depends(verify_admin_api_key)
+):
+    """
+    🔒 Estado del reescaneo diferencial (última pasada de este proceso)
+    """
+    return {
+        "version": get_signature_manager().get_compiled().version,
+        "interval": rescan_scheduler.interval,
+        "last_run": rescan_scheduler.last_run
+    }
+
+
+@router.post("/admin/signatures/rescan", tags=["admin"])
+async def trigger_differential_rescan(
+    admin_key: str = Depends(verify_admin_api_key)
+):
+    """
+    🔒 Lanzar ya una pasada de reescaneo diferencial (p.ej. tras publicar firmas)
+    
+    Solo se pasan las firmas nuevas o modificadas, y solo sobre el contenido
+    distinto ya escaneado; las amenazas nuevas se registran en cada sitio
+    que tiene ese contenido.
+    """
+    rescan_scheduler.trigger()
+    return {"success": True, "message": "Differential rescan triggered"}
+
+
+@router.get("/stats")
+async def get_antivirus_stats(
+    site_id: str = Depends(verify_api_key)
+):
+    """
+    Obtener estadísticas del antivirus
+    
+    Una sola consulta agregada (RPC) con caché corta por sitio.
+    """
+    try:
+        return get_site_stats(supabase, site_id)
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 # ============================================
 # FUNCIÓN DE BACKGROUND
 # ============================================
 
+def _create_scanner(executor=None) -> FileScanner:
+    """Scanner con la allowlist, la caché de veredictos y el sandbox de regex compartidos del proceso"""
+    settings = get_settings()
+    sandbox = None
+    if settings.scan_regex_sandbox:
+        # Un proceso por escaneo simultáneo; las subidas directas esperan turno
+        sandbox = get_regex_sandbox(settings.scan_workers, settings.scan_regex_pattern_timeout)
+    return FileScanner(
+        allowlist=get_allowlist(),
+        verdict_cache=_get_verdict_cache(),
+        executor=executor,
+        sandbox=sandbox,
+        regex_time_budget=settings.scan_regex_file_timeout
+    )
+
+
+def _get_verdict_cache() -> VerdictCache:
+    """Caché de veredictos compartida del proceso, para las firmas cargadas y este motor"""
+    return get_verdict_cache(
+        supabase,
+        verdict_version(get_signature_manager().get_compiled().version),
+        get_settings().redis_url
+    )
+
+
+QUARANTINE_PAGE_SIZE = 1000
+QUARANTINE_ID_BATCH = 200  # ids por sentencia (mantiene la URL de PostgREST acotada)
+
+
+def _select_threats_paged(make_query) -> List[dict]:
+    """
+    Todas las filas de una consulta de threats, por páginas (keyset sobre id)
+    
+    `make_query` devuelve la consulta sin paginar; se llama una vez por página.
+    """
+    threats = []
+    cursor = None
+    while True:
+        query = make_query()
+        if cursor:
+            query = query.gt('id', cursor)
+        page = query.order('id').limit(QUARANTINE_PAGE_SIZE).execute().data or []
+        threats.extend(page)
+        if len(page) < QUARANTINE_PAGE_SIZE:
+            return threats
+        cursor = page[-1]['id']
+
+
+async def _quarantine_threats(site_id: str, threats: List[dict]) -> dict:
+    """
+    Guardar el contenido de las amenazas y marcarlas como 'quarantined'
+    
+    La BD se actualiza por lotes de ids, con una sentencia por blob y lote:
+    solo cambian las amenazas seleccionadas, aunque otras del mismo escaneo
+    tengan el mismo contenido.
+    """
+    local_paths = _local_threat_paths(site_id, threats)
+    by_blob = await asyncio.to_thread(get_quarantine_store().quarantine_files, threats, local_paths)
+    now = datetime.utcnow().isoformat()
+    quarantined = 0
+    
+    for blob, group in by_blob.items():
+        data = {'status': 'quarantined', 'quarantine_blob': blob, 'quarantined_at': now}
+        ids = [t['id'] for t in group]
+        for i in range(0, len(ids), QUARANTINE_ID_BATCH):
+            result = supabase.table('threats')\
+                .update(data, count='exact', returning='minimal')\
+                .in_('id', ids[i:i + QUARANTINE_ID_BATCH])\
+                .eq('site_id', site_id)\
+                .eq('status', 'active')\
+                .execute()
+            quarantined += result.count or 0
+    
+    invalidate_site_stats(site_id)
+    return {
+        'quarantined': quarantined,
+        'blobs': sum(1 for blob in by_blob if blob),
+        'without_content': len(by_blob.get(None, []))
+    }
+
+
+def _local_threat_paths(site_id: str, threats: List[dict]) -> Dict[str, str]:
+    """
+    Rutas reales en el servidor de las amenazas de escaneos locales ({id: ruta})
+    
+    Solo cuentan los escaneos locales del sitio (los lanzados con /scan/start,
+    que guardan options) y solo las rutas que, resueltas con realpath, quedan
+    dentro de la raíz del sitio. Las amenazas de manifiestos y archivos
+    subidos nunca tocan el disco del servidor: su file_path lo eligió el cliente.
+    """
+    site_root = get_site_root(get_settings().scan_sites_root, site_id)
+    scan_ids = list({t['scan_id'] for t in threats if t.get('scan_id')})
+    if site_root is None or not scan_ids:
+        return {}
+    
+    local_scans = set()
+    for i in range(0, len(scan_ids), QUARANTINE_ID_BATCH):
+        result = supabase.table('scans')\
+            .select('id')\
+            .in_('id', scan_ids[i:i + QUARANTINE_ID_BATCH])\
+            .eq('site_id', site_id)\
+            .not_.is_('options', 'null')\
+            .execute()
+        local_scans.update(row['id'] for row in result.data or [])
+    
+    paths = {}
+    for threat in threats:
+        if threat.get('scan_id') in local_scans:
+            real_path = resolve_in_root(site_root, threat['file_path'])
+            if real_path is not None:
+                paths[threat['id']] = real_path
+    return paths
+
+
+def _threats_query(query, site_id: str, update: BulkThreatUpdate):
+    """Aplicar la selección (ids o filtro) de una petición bulk a una consulta de threats"""
+    query = query.eq('site_id', site_id)
+    if update.threat_ids:
+        return query.in_('id', update.threat_ids)
+    
+    query = query.eq('scan_id', update.filter.scan_id)
+    if update.filter.signature:
+        query = query.eq('signature_matched', update.filter.signature)
+    if update.filter.path_prefix:
+        # Escapar los comodines de LIKE que pueda traer la ruta
+        prefix = update.filter.path_prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.like('file_path', prefix + '%')
+    return query
+
+
+async def _bulk_set_status(site_id: str, update: BulkThreatUpdate, status: str) -> dict:
+    """
+    Cambiar el estado de las amenazas seleccionadas; devuelve los conteos
+    
+    Las amenazas en cuarentena no cambian de estado aquí: su archivo solo
+    vuelve con /threat/{threat_id}/restore, y marcarlas de otra forma
+    dejaría el contenido huérfano en el almacén. Se devuelven como skipped.
+    """
+    if bool(update.threat_ids) == bool(update.filter):
+        raise HTTPException(status_code=400, detail="Provide either threat_ids or filter")
+    
+    if status == 'quarantined':
+        # Hace falta el contenido de cada archivo: se seleccionan por páginas y pasan por el almacén
+        threats = _select_threats_paged(
+            lambda: _threats_query(
+                supabase.table('threats').select('id, scan_id, file_path, file_sha256'),
+                site_id,
+                update
+            ).eq('status', 'active')
+        )
+        if not threats:
+            return {'updated': 0}
+        counts = await _quarantine_threats(site_id, threats)
+        return {'updated': counts['quarantined'], **counts}
+    
+    result = _threats_query(
+        supabase.table('threats').update({'status': status}, count='exact', returning='minimal'),
+        site_id,
+        update
+    ).neq('status', status).neq('status', 'quarantined').execute()
+    
+    skipped = _threats_query(
+        supabase.table('threats').select('id', count='exact'),
+        site_id,
+        update
+    ).eq('status', 'quarantined').limit(1).execute()
+    
+    invalidate_site_stats(site_id)
+    return {'updated': result.count or 0, 'skipped_quarantined': skipped.count or 0}
+
+
+def _get_quarantined_threat(threat_id: str, site_id: str) -> dict:
+    result = supabase.table('threats')\
+        .select('id, scan_id, file_path, status, quarantine_blob')\
+        .eq('id', threat_id)\
+        .eq('site_id', site_id)\
+        .execute()
+    
+    if not result.data:
+        raise HTTPException(status_code=404, detail="Threat not found")
+    
+    threat = result.data[0]
+    if threat['status'] != 'quarantined' or not threat.get('quarantine_blob'):
+        raise HTTPException(status_code=409, detail="Threat has no quarantined content")
+    if not get_quarantine_store().has(threat['quarantine_blob']):
+        raise HTTPException(status_code=410, detail="Quarantined content is no longer available")
+    return threat
+
+
+class ThreatBatchWriter:
+    """
+    Inserta las amenazas de un escaneo en la tabla threats por lotes,
+    a medida que el scanner las encuentra
+    """
+    
+    def __init__(self, scan_id: str, site_id: str, batch_size: int = 100):
+        self.scan_id = scan_id
+        self.site_id = site_id
+        self.batch_size = batch_size
+        self._pending: List[dict] = []
+    
+    async def add(self, scan_result: dict):
+        """Encolar las amenazas de un archivo"""
+        for threat in scan_result.get('threats', []):
+            self._pending.append({
+                'scan_id': self.scan_id,
+                'site_id': self.site_id,
+                'file_path': scan_result['file_path'],
+                'threat_type': 'malware',
+                'severity': threat['severity'],
+                'signature_matched': threat['signature'],
+                'code_snippet': threat['code_snippet'],
+                'line_number': threat.get('line_number'),
+                'file_sha256': scan_result.get('file_sha256'),
+                'status': 'active'
+            })
+        
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+    
+    async def flush(self):
+        """Insertar las amenazas pendientes en una sola petición"""
+        if not self._pending:
+            return
+        
+        supabase.table('threats').insert(self._pending).execute()
+        self._pending = []
+        invalidate_site_stats(self.site_id)
+
+
 async def run_scan_background(
     scan_id: str,
     site_id: str,
     scan_type: str,
     custom_paths: Optional[List[str]],
-    max_size_mb: int
+    max_size_mb: int,
+    job: Optional[ScanJob] = None
 ):
     """
     Ejecutar escaneo en background
+    
+    Lo lanza un worker del planificador, que ya marcó el escaneo como
+    'running' al tomarlo de la cola.
     """
     import logging
     logger = logging.getLogger(__name__)
     
+    reporter = None
+    status = 'failed'
+    
     try:
         logger.info(f"🔍 Starting scan {scan_id} for site {site_id}")
         
-        # Actualizar estado a "running"
-        supabase.table('scans')\
-            .update({'status': 'running'})\
-            .eq('id', scan_id)\
-            .execute()
-        
-        # Inicializar scanner
-        scanner = FileScanner()
+        # Inicializar scanner (hashes conocidos de WordPress y veredictos de otros sitios)
+        # El trabajo de CPU va al pool de hilos del planificador
+        scanner = _create_scanner(executor=scan_scheduler.executor)
         
         # Determinar qué escanear según el tipo
         # NOTA: En producción, esto debería recibir las rutas desde WordPress
@@ -425,50 +1595,96 @@ async def run_scan_background(
         else:  # custom
             paths_to_scan = custom_paths or []
         
-        # Callback para actualizar progreso
+        # Solo dentro del directorio del sitio: nunca rutas absolutas ni que escapen con '..' o enlaces
+        settings = get_settings()
+        site_root = get_site_root(settings.scan_sites_root, site_id)
+        if site_root is None:
+            raise ValueError("Local scans are not available for this site")
+        
+        # Acumulador compacto: las amenazas se insertan a medida que aparecen
+        threat_writer = ThreatBatchWriter(scan_id, site_id)
+        aggregator = ScanAggregator(threat_sink=threat_writer.add)
+        file_index = SiteFileIndex(supabase, site_id)
+        
+        # Progreso: en memoria/Redis por archivo, en BD solo en checkpoints
+        # (todas las escrituras exigen seguir siendo el dueño del lease)
+        owner = worker_id()
+        reporter = ScanProgressReporter(
+            scan_id,
+            site_id,
+            db_writer=lambda data: supabase.table('scans').update(data).eq('id', scan_id).eq('lease_owner', owner).execute()
+        )
+        path_index = 0
+        
         async def progress_callback(progress: int, scan_result: dict):
+            if job is not None:
+                job.check_cancelled()
+            if scan_result.get('is_malicious'):
+                reporter.report_threat(scan_result)
+            if not scan_result.get('known_good'):
+                file_index.add_result(scan_result)
+                if settings.scan_retain_content and scan_result.get('file_sha256'):
+                    await asyncio.to_thread(
+                        retain_content,
+                        get_content_store(),
+                        os.path.join(site_root, scan_result['file_path']),
+                        scan_result['file_sha256'],
+                        scan_result.get('file_size') or 0,
+                        settings.scan_retain_max_kb * 1024
+                    )
+            overall = (path_index * 100 + progress) // max(len(paths_to_scan), 1)
+            await reporter.update(
+                overall,
+                aggregator.scanned_files,
+                aggregator.threats_found,
+                scan_result.get('file_path')
+            )
+        
+        # Ejecutar escaneo (rutas relativas a la raíz del sitio; las amenazas también)
+        try:
+            for path_index, path in enumerate(paths_to_scan):
+                directory = resolve_in_root(site_root, path)
+                if directory is None:
+                    logger.warning(f"⚠️  Ruta fuera del sitio en el scan {scan_id}: {path}")
+                    aggregator.add_error({'file_path': path, 'error': 'Path outside site root'})
+                    continue
+                if not os.path.isdir(directory):
+                    logger.warning(f"⚠️  Ruta no accesible para el scan {scan_id}: {path}")
+                    continue
+                
+                await scanner.scan_directory(
+                    directory,
+                    max_size_mb=max_size_mb,
+                    progress_callback=progress_callback,
+                    aggregator=aggregator,
+                    site_root=site_root
+                )
+            
+            cancelled = False
+        except ScanCancelled:
+            cancelled = True
+        finally:
+            await threat_writer.flush()
+            await asyncio.to_thread(scanner.verdict_cache.flush)
+            await asyncio.to_thread(file_index.flush)
+            results = aggregator.summary()
+        
+        if cancelled:
+            status = 'cancelled'
+            # El estado 'cancelled' ya lo escribió /cancel; solo se guardan los contadores
             supabase.table('scans')\
                 .update({
-                    'progress': progress,
-                    'files_scanned': scan_result.get('scanned_files', 0),
-                    'results': {
-                        'current_file': scan_result.get('file_path')
-                    }
+                    'files_scanned': results['scanned_files'],
+                    'threats_found': results['threats_found'],
+                    'results': results
                 })\
                 .eq('id', scan_id)\
+                .eq('lease_owner', owner)\
                 .execute()
+            logger.info(f"🛑 Scan {scan_id} stopped after {results['scanned_files']} files")
+            return
         
-        # Ejecutar escaneo
-        # NOTA: En producción real, WordPress enviaría los archivos o rutas
-        # Por ahora simulamos con un escaneo local
-        results = {
-            'total_files': 0,
-            'scanned_files': 0,
-            'threats_found': 0,
-            'suspicious_files': []
-        }
-        
-        # Simular progreso (en producción real esto vendría del scanner)
-        for i in range(0, 101, 10):
-            await asyncio.sleep(0.5)  # Simular tiempo de escaneo
-            await progress_callback(i, {'scanned_files': i, 'file_path': f'example-{i}.php'})
-        
-        # Guardar amenazas en la BD
-        for suspicious_file in results.get('suspicious_files', []):
-            for threat in suspicious_file.get('threats', []):
-                threat_data = {
-                    'scan_id': scan_id,
-                    'site_id': site_id,
-                    'file_path': suspicious_file['file_path'],
-                    'threat_type': 'malware',
-                    'severity': threat['severity'],
-                    'signature_matched': threat['signature'],
-                    'code_snippet': threat['code_snippet'],
-                    'status': 'active'
-                }
-                supabase.table('threats').insert(threat_data).execute()
-        
-        # Actualizar estado final
+        # Actualizar estado final (solo si nadie lo canceló ni lo reclamó mientras tanto)
         supabase.table('scans')\
             .update({
                 'status': 'completed',
@@ -479,7 +1695,10 @@ async def run_scan_background(
                 'results': results
             })\
             .eq('id', scan_id)\
+            .eq('status', 'running')\
+            .eq('lease_owner', owner)\
             .execute()
+        status = 'completed'
         
         logger.info(f"✅ Scan {scan_id} completed - {results['threats_found']} threats found")
         
@@ -494,4 +1713,104 @@ async def run_scan_background(
                 'results': {'error': str(e)}
             })\
             .eq('id', scan_id)\
+            .eq('status', 'running')\
+            .eq('lease_owner', worker_id())\
             .execute()
+    
+    finally:
+        invalidate_site_stats(site_id)
+        # Después del estado final en BD: quien reciba 'done' ya puede pedir los resultados
+        if reporter is not None:
+            await reporter.finish(status)
+
+
+def _lease_expiry() -> str:
+    return (datetime.utcnow() + timedelta(seconds=get_settings().scan_lease_seconds)).isoformat()
+
+
+def _claim_scan(job: ScanJob) -> bool:
+    """Pasar el escaneo de 'pending' a 'running' con un lease de este proceso (falla si otro worker lo tomó o se canceló)"""
+    result = supabase.table('scans')\
+        .update({'status': 'running', 'lease_owner': worker_id(), 'lease_expires_at': _lease_expiry()})\
+        .eq('id', job.scan_id)\
+        .eq('status', 'pending')\
+        .execute()
+    return bool(result.data)
+
+
+def _renew_lease(job: ScanJob) -> bool:
+    """Alargar el lease de un escaneo en ejecución (False: cancelado o reclamado por otro proceso)"""
+    result = supabase.table('scans')\
+        .update({'lease_expires_at': _lease_expiry()}, returning='minimal', count='exact')\
+        .eq('id', job.scan_id)\
+        .eq('status', 'running')\
+        .eq('lease_owner', worker_id())\
+        .execute()
+    return bool(result.count)
+
+
+async def _run_scan_job(job: ScanJob):
+    await run_scan_background(
+        job.scan_id,
+        job.site_id,
+        job.options.get('scan_type', 'quick'),
+        job.options.get('paths'),
+        job.options.get('max_size_mb', 10),
+        job=job
+    )
+
+
+async def recover_scan_queue() -> int:
+    """
+    Reconstruir la cola al arrancar (y periódicamente desde el planificador)
+    
+    Los escaneos 'running' cuyo lease venció (su proceso murió o dejó de
+    renovarlo) vuelven a 'pending' desde el principio; los que siguen
+    vivos en otros procesos no se tocan. Después se encolan aquí los
+    'pending' que este proceso aún no tiene (tomarlos es atómico).
+    """
+    now = datetime.utcnow().isoformat()
+    supabase.table('scans')\
+        .update({'status': 'pending', 'progress': 0, 'lease_owner': None, 'lease_expires_at': None})\
+        .eq('status', 'running')\
+        .not_.is_('options', 'null')\
+        .or_(f"lease_expires_at.is.null,lease_expires_at.lt.{now}")\
+        .execute()
+    
+    result = supabase.table('scans')\
+        .select('id, site_id, scan_type, options')\
+        .eq('status', 'pending')\
+        .not_.is_('options', 'null')\
+        .order('started_at')\
+        .execute()
+    
+    submitted = 0
+    for row in result.data or []:
+        if scan_scheduler.get_job(row['id']) is None:
+            await scan_scheduler.submit(ScanJob(row['id'], row['site_id'], {'scan_type': row['scan_type'], **row['options']}))
+            submitted += 1
+    
+    return submitted
+
+
+_settings = get_settings()
+scan_scheduler = ScanScheduler(
+    runner=_run_scan_job,
+    claim=_claim_scan,
+    workers=_settings.scan_workers,
+    per_site_limit=_settings.scan_max_per_site,
+    renew=_renew_lease,
+    recover=recover_scan_queue,
+    lease_seconds=_settings.scan_lease_seconds
+)
+rescan_scheduler = RescanScheduler(
+    DifferentialRescanner(
+        supabase,
+        get_signature_manager(),
+        get_content_store(),
+        sandbox=get_regex_sandbox(_settings.scan_workers, _settings.scan_regex_pattern_timeout) if _settings.scan_regex_sandbox else None,
+        batch_size=_settings.scan_rescan_batch
+    ),
+    interval=_settings.scan_rescan_interval,
+    max_store_bytes=_settings.scan_content_max_mb * 1024 * 1024
+)
@@ -21,6 +21,33 @@ class Settings(BaseSettings):
     # Redis
     redis_url: Optional[str] = None
     
+    # Antivirus
+    scan_progress_interval: float = 2.0  # Segundos mínimos entre escrituras de progreso
+    scan_progress_min_delta: int = 5  # Puntos de progreso mínimos entre escrituras
+    scan_workers: int = 2  # Escaneos simultáneos por proceso
+    scan_max_per_site: int = 1  # Escaneos simultáneos de un mismo sitio
+    scan_max_queued_per_site: int = 5  # Escaneos en cola por sitio (el resto: 429)
+    scan_lease_seconds: float = 120.0  # Un escaneo sin renovar su lease en este tiempo se reencola
+    scan_regex_sandbox: bool = True  # Firmas en procesos aislados que se matan al pasar el límite
+    scan_regex_pattern_timeout: float = 2.0  # Segundos por patrón y bloque
+    scan_regex_file_timeout: float = 20.0  # Segundos de regex de firmas por archivo
+    scan_retain_content: bool = True  # Guardar el contenido escaneado para reescaneos diferenciales
+    scan_retain_max_kb: int = 1024  # Archivos más grandes no se guardan
+    scan_content_max_mb: int = 2048  # Tamaño máximo del almacén de contenido (se borra lo más antiguo)
+    scan_rescan_interval: float = 300.0  # Segundos entre pasadas del reescaneo diferencial
+    scan_rescan_batch: int = 200  # Contenidos distintos por pasada
+    scan_archive_max_mb: int = 1024  # Bytes descomprimidos máximos por archivo tar/zip
+    scan_archive_max_members: int = 200000  # Entradas máximas por archivo tar/zip
+    scan_sites_root: Optional[str] = None  # Escaneos locales: <raíz>/<site_id>; sin ella no se toca el disco
+    
+    # Observabilidad
+    server_timing: bool = False  # Cabecera Server-Timing con el tiempo de cada etapa
+    log_level: str = "INFO"
+    log_format: str = "text"  # "text" (líneas legibles) o "json" (una línea JSON por registro)
+    log_sample_rate: float = 1.0  # Fracción de peticiones 2xx/3xx que se registran (errores siempre)
+    log_slow_ms: float = 1000.0  # Peticiones más lentas se registran siempre
+    log_queue_size: int = 10000  # Registros pendientes de escribir antes de descartar los de nivel < ERROR
+    
     # Admin (para endpoints sensibles)
     admin_secret: str = "tu_clave_super_secreta_aqui_123456"
     
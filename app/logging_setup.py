@@ -0,0 +1,136 @@
+"""
+Logging de la API fuera del event loop
+
+Los handlers del logger raíz se sustituyen por un QueueHandler: en el
+camino de la petición solo se fija el mensaje y se encola el registro; un
+QueueListener en su propio hilo lo formatea (texto o JSON) y lo escribe en
+stdout. Si stdout se bloquea, la cola se llena y los registros por
+debajo de ERROR se descartan (contados y avisados después). Los errores
+tienen una reserva propia en la cola y, si también se agota, esperan como
+mucho ERROR_PUT_TIMEOUT: el event loop nunca queda bloqueado por los logs.
+"""
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+ERROR_RESERVE = 1000        # Huecos de la cola solo para ERROR y superiores
+ERROR_PUT_TIMEOUT = 0.05    # Espera máxima (s) de un error con la cola llena
+
+# Atributos propios de LogRecord: el resto (extra=...) va como campos del JSON
+_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[QueueHandler] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro con los campos pasados en `extra`"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _LoopQueueHandler(QueueHandler):
+    """
+    QueueHandler para una cola en el mismo proceso
+
+    No formatea (eso lo hace el hilo del listener): solo fija el mensaje
+    para que los argumentos mutables no cambien antes de escribirse. Por
+    debajo de ERROR solo se encola si quedan más de `reserve` huecos.
+    """
+
+    def __init__(self, log_queue: queue.Queue, reserve: int = ERROR_RESERVE):
+        super().__init__(log_queue)
+        self.limit = log_queue.maxsize - reserve
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if record.levelno >= logging.ERROR:
+                self.queue.put(record, timeout=ERROR_PUT_TIMEOUT)
+                return
+            if self.queue.qsize() >= self.limit:
+                raise queue.Full
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': __name__,
+                    'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': f"⚠️  {self.dropped} registros descartados (cola de logs llena)"
+                }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level: str = 'INFO', fmt: str = 'text', queue_size: int = 10000) -> QueueListener:
+    """Configurar el logger raíz (sustituye a logging.basicConfig); idempotente"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size + ERROR_RESERVE)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    _queue_handler = _LoopQueueHandler(log_queue)
+    root.addHandler(_queue_handler)
+    root.setLevel(level.upper())
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """
+    Vaciar la cola y parar el hilo de escritura (al cerrar la aplicación)
+
+    El logger raíz pasa a escribir directamente en la salida: lo que se
+    registre después (apagado, atexit) no se queda en una cola sin lector.
+    """
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    root = logging.getLogger()
+    root.removeHandler(_queue_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        root.addHandler(handler)
+    _listener = None
+    _queue_handler = None
+
+
+def should_log_request(status_code: int, seconds: float, sample_rate: float, slow_seconds: float) -> bool:
+    """Errores (4xx/5xx) y peticiones lentas siempre; el resto según la tasa de muestreo"""
+    if status_code >= 400 or seconds >= slow_seconds:
+        return True
+    return sample_rate >= 1.0 or random.random() < sample_rate
@@ -1,6 +1,6 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.exceptions import RequestValidationError
 from contextlib import asynccontextmanager
 import time
@@ -10,6 +10,9 @@ import os
 from pathlib import Path
 
 from app.config import get_settings
+from app.metrics import observe_request, render as render_metrics
+from app.tracing import end_trace, has_exporters, start_trace
+from app.logging_setup import setup_logging, should_log_request, stop_logging
 from app.api.routes import router as spam_router  # Anti-spam (existente)
 from app.api.routes_antivirus import router as antivirus_router  # 🆕 Antivirus (nuevo)
 from app.ml_model import spam_detector
@@ -17,12 +20,10 @@ from app.ml_model import spam_detector
 # Configuración
 settings = get_settings()
 
-# Configurar logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configurar logging (escritura en un hilo aparte, fuera del event loop)
+setup_logging(settings.log_level, settings.log_format, settings.log_queue_size)
 logger = logging.getLogger(__name__)
+access_logger = logging.getLogger('spamguard.access')
 
 
 @asynccontextmanager
@@ -63,11 +64,23 @@ async def lifespan(app: FastAPI):
     # 2. Inicializar módulo Antivirus
     logger.info("\n🦠 Módulo Antivirus:")
     try:
-        from app.modules.antivirus.signatures import SignatureManager
+        from app.modules.antivirus.signatures import get_signature_manager
+        from app.modules.antivirus.allowlist import get_allowlist
+        
+        # Compila el conjunto compartido una vez; los escaneos lo reutilizan
+        signatures = get_signature_manager().get_compiled()
+        logger.info(f"   ✅ Firmas de malware cargadas: {len(signatures)} (versión {signatures.version})")
+        logger.info(f"   ✅ Hashes conocidos (core/plugins): {len(get_allowlist())}")
         
-        sig_manager = SignatureManager()
-        signatures = sig_manager.load_signatures()
-        logger.info(f"   ✅ Firmas de malware cargadas: {len(signatures)}")
+        # Cola de escaneos: workers propios y escaneos pendientes de antes del reinicio
+        from app.api.routes_antivirus import scan_scheduler, rescan_scheduler, recover_scan_queue
+        await scan_scheduler.start()
+        recovered = await recover_scan_queue()
+        logger.info(f"   ✅ Workers de escaneo: {scan_scheduler.workers} ({recovered} escaneos en cola recuperados)")
+        
+        # Contenido ya escaneado frente a firmas nuevas, en segundo plano
+        await rescan_scheduler.start()
+        logger.info(f"   ✅ Reescaneo diferencial cada {rescan_scheduler.interval:.0f}s")
         logger.info(f"   ✅ Antivirus: Sistema activo")
         
     except Exception as e:
@@ -98,6 +111,15 @@ async def lifespan(app: FastAPI):
     logger.info("=" * 60)
     logger.info("👋 Cerrando SpamGuard Security Suite...")
     logger.info("=" * 60)
+    
+    from app.api.routes_antivirus import scan_scheduler, rescan_scheduler
+    await rescan_scheduler.stop()
+    await scan_scheduler.stop()
+    
+    from app.modules.antivirus.sandbox import close_regex_sandboxes
+    close_regex_sandboxes()
+    
+    stop_logging()
 
 
 # Crear aplicación FastAPI
@@ -150,22 +172,50 @@ app.add_middleware(
 async def log_requests(request: Request, call_next):
     start_time = time.time()
     
+    # Traza por etapas solo si alguien la va a leer (exportador o Server-Timing)
+    trace = None
+    if settings.server_timing or has_exporters():
+        trace = start_trace(f"{request.method} {request.url.path}", request.headers.get('traceparent'))
+    
     try:
         response = await call_next(request)
         process_time = time.time() - start_time
         
-        # Log con formato mejorado
-        log_message = (
-            f"{request.method} {request.url.path} - "
-            f"{response.status_code} - {process_time:.3f}s"
-        )
+        # Plantilla de la ruta (no la URL): cardinalidad acotada en Prometheus
+        route = request.scope.get('route')
+        route_path = route.path if route is not None else 'unmatched'
+        observe_request(request.method, route_path, response.status_code, process_time)
         
-        if response.status_code >= 500:
-            logger.error(f"❌ {log_message}")
-        elif response.status_code >= 400:
-            logger.warning(f"⚠️  {log_message}")
-        else:
-            logger.info(f"📝 {log_message}")
+        if trace is not None:
+            trace.root.name = f"{request.method} {route_path}"
+            trace.root.set_attribute('http.method', request.method)
+            trace.root.set_attribute('http.route', route_path)
+            trace.root.set_attribute('http.status_code', response.status_code)
+            end_trace(trace)
+            if settings.server_timing:
+                response.headers["Server-Timing"] = trace.server_timing()
+            trace = None
+        
+        # Log de acceso: errores y lentas siempre, el resto muestreado;
+        # el formato se aplica en el hilo del listener, no aquí
+        if should_log_request(response.status_code, process_time, settings.log_sample_rate, settings.log_slow_ms / 1000):
+            if response.status_code >= 500:
+                level, icon = logging.ERROR, "❌"
+            elif response.status_code >= 400:
+                level, icon = logging.WARNING, "⚠️ "
+            else:
+                level, icon = logging.INFO, "📝"
+            access_logger.log(
+                level, "%s %s %s - %s - %.3fs",
+                icon, request.method, request.url.path, response.status_code, process_time,
+                extra={
+                    'method': request.method,
+                    'path': request.url.path,
+                    'route': route_path,
+                    'status': response.status_code,
+                    'duration_ms': round(process_time * 1000, 2)
+                }
+            )
         
         response.headers["X-Process-Time"] = str(process_time)
         
@@ -174,6 +224,11 @@ async def log_requests(request: Request, call_next):
     except Exception as e:
         logger.error(f"❌ Error processing request: {str(e)}")
         raise
+    
+    finally:
+        if trace is not None:
+            trace.root.set_attribute('error', True)
+            end_trace(trace)
 
 
 # Manejador de errores de validación
@@ -224,6 +279,17 @@ app.include_router(antivirus_router)
 # ENDPOINTS PRINCIPALES
 # ============================================
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Métricas Prometheus (latencias por ruta y etapa, cachés, rate limit, colas)
+    
+    Con PROMETHEUS_MULTIPROC_DIR agrega las de todos los workers.
+    """
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
 @app.get("/")
 async def root():
     """
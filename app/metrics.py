@@ -0,0 +1,153 @@
+"""
+Métricas Prometheus de la API (/metrics)
+
+Con varios workers de uvicorn, cada proceso escribe sus métricas en
+archivos mmap del directorio PROMETHEUS_MULTIPROC_DIR (debe existir y
+vaciarse antes de arrancar) y /metrics las agrega todas. Sin esa
+variable se usa el registro del propio proceso.
+
+Coste por observación: una búsqueda en dict y una suma bajo lock; los
+hijos con etiquetas se resuelven una vez y se reutilizan.
+"""
+import functools
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+from app.tracing import span
+
+MULTIPROCESS = bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+
+# Buckets en segundos: de peticiones en caché (~1 ms) a escaneos de archivos grandes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGES = ('auth', 'feature_extraction', 'ml_inference', 'explanation', 'db_write', 'scan_file')
+
+REQUEST_LATENCY = Histogram(
+    'spamguard_request_duration_seconds',
+    'Duración de las peticiones HTTP por ruta',
+    ['method', 'route', 'status'],
+    buckets=LATENCY_BUCKETS
+)
+STAGE_LATENCY = Histogram(
+    'spamguard_stage_duration_seconds',
+    'Duración de cada etapa de los caminos calientes',
+    ['stage'],
+    buckets=LATENCY_BUCKETS
+)
+CACHE_REQUESTS = Counter(
+    'spamguard_cache_requests_total',
+    'Consultas a cachés por resultado',
+    ['cache', 'result']
+)
+RATE_LIMIT_REJECTIONS = Counter(
+    'spamguard_rate_limit_rejections_total',
+    'Peticiones rechazadas por rate limit',
+    ['scope']
+)
+MODEL_INFO = Gauge(
+    'spamguard_model_info',
+    'Versión del modelo de spam cargado (valor 1)',
+    ['version'],
+    multiprocess_mode='max'
+)
+QUEUE_DEPTH = Gauge(
+    'spamguard_queue_depth',
+    'Trabajos en cola o en ejecución',
+    ['queue', 'state'],
+    multiprocess_mode='livesum'
+)
+
+_stage_children = {stage: STAGE_LATENCY.labels(stage) for stage in STAGES}
+_request_children: Dict[Tuple[str, str, str], object] = {}
+_model_version = None
+
+
+@contextmanager
+def stage(name: str):
+    """Medir una etapa: `with stage('ml_inference'): ...` (histograma y span de la traza en curso)"""
+    started = time.perf_counter()
+    with span(name) as current:
+        try:
+            yield current
+        finally:
+            _stage_children[name].observe(time.perf_counter() - started)
+
+
+def timed(name: str):
+    """Decorador: medir cada llamada a la función como la etapa `name`"""
+    child = _stage_children[name]
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            with span(name):
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def observe_stage(name: str, seconds: float):
+    _stage_children[name].observe(seconds)
+
+
+def observe_request(method: str, route: str, status_code: int, seconds: float):
+    """Latencia de una petición; `route` es la plantilla (/scan/{scan_id}), no la URL"""
+    key = (method, route, f"{status_code // 100}xx")
+    child = _request_children.get(key)
+    if child is None:
+        child = _request_children[key] = REQUEST_LATENCY.labels(*key)
+    child.observe(seconds)
+
+
+def cache_result(cache: str, hit: bool, count: int = 1):
+    if count:
+        CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc(count)
+
+
+def rate_limited(scope: str):
+    RATE_LIMIT_REJECTIONS.labels(scope).inc()
+
+
+def set_model_version(version: str):
+    """Marcar el modelo cargado (la versión anterior deja de contar)"""
+    global _model_version
+    if _model_version is not None and _model_version != version:
+        MODEL_INFO.labels(_model_version).set(0)
+    MODEL_INFO.labels(version).set(1)
+    _model_version = version
+
+
+def set_queue_depth(queue: str, queued: int, running: int):
+    QUEUE_DEPTH.labels(queue, 'queued').set(queued)
+    QUEUE_DEPTH.labels(queue, 'running').set(running)
+
+
+def render() -> Tuple[bytes, str]:
+    """(cuerpo, content-type) de /metrics"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int):
+    """Limpiar los gauges 'live' de un worker que terminó (hook del gestor de procesos)"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
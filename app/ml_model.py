@@ -5,6 +5,7 @@ import os
 from pathlib import Path
 
 from app.config import get_settings
+from app.metrics import set_model_version
 
 settings = get_settings()
 
@@ -14,6 +15,7 @@ class SpamDetector:
     def __init__(self):
         self.model = None
         self.is_trained = False
+        self.model_version = 'rules'  # Sin modelo: reglas básicas
         
         # Intentar cargar modelo pre-entrenado
         self._load_global_model()
@@ -45,6 +47,15 @@ class SpamDetector:
             print(f"ℹ️ No existe modelo entrenado en: {model_path}")
             print("📝 API funcionará con reglas básicas hasta el primer entrenamiento")
             self.is_trained = False
+        self._set_version(model_path)
+    
+    def _set_version(self, path: Path):
+        """Versión del modelo = nombre y fecha del archivo (la de /metrics)"""
+        if self.is_trained:
+            self.model_version = f"{path.stem}-{int(path.stat().st_mtime)}"
+        else:
+            self.model_version = 'rules'
+        set_model_version(self.model_version)
     
     def load_model(self, model_path: str):
         """
@@ -68,6 +79,7 @@ class SpamDetector:
         except Exception as e:
             print(f"❌ Error recargando modelo desde {model_path}: {e}")
             self.is_trained = False
+        self._set_version(path)
     
     def predict(self, features: Dict) -> Dict:
         """
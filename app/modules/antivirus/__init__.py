@@ -4,6 +4,19 @@ Módulo Antivirus de SpamGuard Security Suite
 __version__ = "1.0.0-beta"
 
 from .scanner import FileScanner
-from .signatures import SignatureManager
+from .signatures import SignatureManager, CompiledSignatures, get_signature_manager
+from .allowlist import HashAllowlist, get_allowlist
+from .walker import DirectoryWalker
+from .results import ScanAggregator
+from .verdicts import VerdictCache, get_verdict_cache
+from .stats import get_site_stats, invalidate_site_stats
+from .quarantine import QuarantineStore, get_quarantine_store
 
-__all__ = ['FileScanner', 'SignatureManager']
+__all__ = [
+    'FileScanner', 'SignatureManager', 'CompiledSignatures', 'get_signature_manager',
+    'HashAllowlist', 'get_allowlist',
+    'DirectoryWalker', 'ScanAggregator',
+    'VerdictCache', 'get_verdict_cache',
+    'get_site_stats', 'invalidate_site_stats',
+    'QuarantineStore', 'get_quarantine_store'
+]
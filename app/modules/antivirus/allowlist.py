@@ -0,0 +1,131 @@
+"""
+Lista de hashes conocidos (known-good) de WordPress core y plugins populares
+"""
+import json
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+
+class HashAllowlist:
+    """
+    Base de datos local de hashes de archivos legítimos.
+
+    Los digests se guardan como bytes en un set, así que comprobar si un
+    archivo es conocido es una búsqueda O(1) sin convertir a hex.
+    Además se recuerda el digest esperado de cada ruta del manifiesto
+    para detectar archivos del core modificados.
+    """
+
+    def __init__(self):
+        self._digests = set()
+        self._known_files: Dict[str, Tuple[bytes, ...]] = {}
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def add(self, digests: Iterable[str], path: Optional[str] = None):
+        """Registrar uno o varios digests hex (md5/sha256) para una ruta"""
+        raw = tuple(bytes.fromhex(d.strip()) for d in digests if d)
+        self._digests.update(raw)
+
+        if path:
+            path = self._normalize(path)
+            self._known_files[path] = self._known_files.get(path, ()) + raw
+
+    def load_manifest(self, manifest_path: str) -> int:
+        """
+        Cargar un manifiesto de checksums
+
+        Formatos soportados:
+        - API de WordPress.org (core): {"checksums": {"wp-includes/x.php": "<md5>"}}
+          o {"checksums": {"<version>": {...}}}
+        - API de WordPress.org (plugins): {"plugin": "slug", "files": {"a.php": {"md5": ..., "sha256": ...}}}
+        - Texto estilo md5sum/sha256sum: "<hash>  <ruta>" por línea
+
+        Returns:
+            Número de entradas cargadas
+        """
+        path = Path(manifest_path)
+
+        if path.suffix == '.json':
+            with open(path, 'r') as f:
+                data = json.load(f)
+            return self._load_json(data)
+
+        loaded = 0
+        with open(path, 'r') as f:
+            for line in f:
+                parts = line.strip().split(None, 1)
+                if len(parts) != 2:
+                    continue
+                digest, file_path = parts
+                self.add([digest], file_path.lstrip('*'))
+                loaded += 1
+        return loaded
+
+    def _load_json(self, data: Dict) -> int:
+        loaded = 0
+
+        # Checksums de plugins: rutas relativas al directorio del plugin
+        if 'files' in data:
+            prefix = f"wp-content/plugins/{data['plugin']}/" if data.get('plugin') else ''
+            for file_path, hashes in data['files'].items():
+                digests = []
+                for algo in ('md5', 'sha256'):
+                    value = hashes.get(algo)
+                    if isinstance(value, list):
+                        digests.extend(value)
+                    elif value:
+                        digests.append(value)
+                self.add(digests, prefix + file_path)
+                loaded += 1
+            return loaded
+
+        # Checksums del core (una o varias versiones)
+        checksums = data.get('checksums') or {}
+        for key, value in checksums.items():
+            if isinstance(value, dict):
+                for file_path, digest in value.items():
+                    self.add([digest], file_path)
+                    loaded += 1
+            else:
+                self.add([value], key)
+                loaded += 1
+        return loaded
+
+    def is_known_good(self, digest: bytes) -> bool:
+        """¿El contenido coincide exactamente con algún archivo conocido?"""
+        return digest in self._digests
+
+    def is_modified(self, file_path: str, digest: bytes) -> bool:
+        """¿La ruta corresponde a un archivo conocido pero el contenido difiere?"""
+        expected = self._known_files.get(self._normalize(file_path))
+        if not expected or digest in expected:
+            return False
+        # Solo se puede comparar con digests del mismo algoritmo (md5 vs sha256)
+        return any(len(d) == len(digest) for d in expected)
+
+    @staticmethod
+    def _normalize(path: str) -> str:
+        path = path.replace('\\', '/')
+        while path.startswith('./'):
+            path = path[2:]
+        return path.lstrip('/')
+
+
+@lru_cache()
+def get_allowlist(manifests_dir: str = "signatures/known_good") -> HashAllowlist:
+    """
+    Allowlist compartida por todo el proceso, cargada una sola vez
+    desde los manifiestos (*.json, *.md5, *.txt) del directorio
+    """
+    allowlist = HashAllowlist()
+    directory = Path(manifests_dir)
+
+    if directory.is_dir():
+        for manifest in sorted(directory.iterdir()):
+            if manifest.suffix in ('.json', '.md5', '.sha256', '.txt'):
+                allowlist.load_manifest(str(manifest))
+
+    return allowlist
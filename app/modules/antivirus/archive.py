@@ -0,0 +1,395 @@
+"""
+Lectura en streaming de archivos tar/zip para escanear sin extraer a disco
+"""
+import asyncio
+import io
+import struct
+import tarfile
+import zlib
+from typing import Iterator, Optional, Tuple
+
+ZIP_LOCAL_HEADER = b'PK\x03\x04'
+ZIP_DATA_DESCRIPTOR = b'PK\x07\x08'
+INFLATE_READ_SIZE = 64 * 1024
+
+
+class ArchiveLimitExceeded(ValueError):
+    """El archivo supera el máximo de entradas o de bytes descomprimidos"""
+
+
+class MemberTooLarge(OSError):
+    """Una entrada supera el tamaño máximo (se descubre al descomprimir)"""
+
+
+class CappedReader(io.RawIOBase):
+    """Stream que falla (MemberTooLarge) en cuanto se leen más de `max_size` bytes"""
+
+    def __init__(self, stream, max_size: int):
+        super().__init__()
+        self._stream = stream
+        self._max_size = max_size
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        # Un byte de más basta para saber que el contenido pasa del límite
+        data = self._stream.read(min(len(buffer), self._max_size - self.bytes_read + 1))
+        n = len(data)
+        self.bytes_read += n
+        if self.bytes_read > self._max_size:
+            raise MemberTooLarge(f"El archivo supera {self._max_size // (1024 * 1024)} MB")
+        buffer[:n] = data
+        return n
+
+
+class ArchiveBudget:
+    """
+    Límites de un archivo completo, sobre lo que de verdad se descomprime
+
+    Cuenta todas las entradas (también las que no se escanean) y todos los
+    bytes inflados, incluidos los que se descartan al saltar una entrada:
+    una bomba zip se corta en cuanto pasa del límite, no al terminar.
+    """
+
+    def __init__(self, max_members: Optional[int] = None, max_total_bytes: Optional[int] = None):
+        self.max_members = max_members
+        self.max_total_bytes = max_total_bytes
+        self.members = 0
+        self.total_bytes = 0
+
+    def add_member(self):
+        self.members += 1
+        if self.max_members is not None and self.members > self.max_members:
+            raise ArchiveLimitExceeded(f"El archivo tiene más de {self.max_members} entradas")
+
+    def consume(self, size: int):
+        self.total_bytes += size
+        if self.max_total_bytes is not None and self.total_bytes > self.max_total_bytes:
+            raise ArchiveLimitExceeded(
+                f"El archivo descomprime más de {self.max_total_bytes // (1024 * 1024)} MB"
+            )
+
+
+class StreamBridge(io.RawIOBase):
+    """
+    Objeto tipo archivo (síncrono) alimentado desde un stream asíncrono
+
+    El event loop llama a feed() con cada bloque del cuerpo de la petición y
+    un hilo de trabajo lo consume con read(). La cola es acotada, así que la
+    lectura de red se frena si el escaneo va más lento (memoria constante).
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_chunks: int = 16):
+        super().__init__()
+        self._loop = loop
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_chunks)
+        self._chunk = memoryview(b'')
+        self._pushback = b''
+        self._eof = False
+        self.bytes_fed = 0
+        self.bytes_read = 0
+
+    # --- Lado asíncrono (event loop) ---
+
+    async def feed(self, chunk: bytes):
+        if chunk:
+            self.bytes_fed += len(chunk)
+            await self._queue.put(chunk)
+
+    async def close_feed(self, error: Optional[BaseException] = None):
+        """Marcar fin del stream (o propagar un error al lector)"""
+        await self._queue.put(error)
+
+    # --- Lado síncrono (hilo de trabajo) ---
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self._pushback:
+            n = min(len(buffer), len(self._pushback))
+            buffer[:n] = self._pushback[:n]
+            self._pushback = self._pushback[n:]
+            self.bytes_read += n
+            return n
+
+        while not self._chunk:
+            if self._eof:
+                return 0
+            item = asyncio.run_coroutine_threadsafe(self._queue.get(), self._loop).result()
+            if item is None:
+                self._eof = True
+                return 0
+            if isinstance(item, BaseException):
+                self._eof = True
+                raise item
+            self._chunk = memoryview(item)
+
+        n = min(len(buffer), len(self._chunk))
+        buffer[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        self.bytes_read += n
+        return n
+
+    def unread(self, data: bytes):
+        """Devolver bytes al stream (se leerán antes que el resto)"""
+        if data:
+            self._pushback = bytes(data) + self._pushback
+            self.bytes_read -= len(data)
+
+
+def read_exact(stream, size: int) -> bytes:
+    """Leer exactamente `size` bytes (menos solo si el stream termina)"""
+    parts = []
+    remaining = size
+    while remaining > 0:
+        data = stream.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return b''.join(parts)
+
+
+class _LimitedReader(io.RawIOBase):
+    """Vista de los siguientes `size` bytes de un stream"""
+
+    def __init__(self, stream, size: int, budget: Optional[ArchiveBudget] = None):
+        super().__init__()
+        self._stream = stream
+        self._remaining = size
+        self._budget = budget
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self._remaining <= 0:
+            return 0
+        data = self._stream.read(min(len(buffer), self._remaining))
+        if not data:
+            raise EOFError("Archivo comprimido truncado")
+        n = len(data)
+        if self._budget is not None:
+            self._budget.consume(n)
+        buffer[:n] = data
+        self._remaining -= n
+        return n
+
+    def drain(self):
+        while self.read(INFLATE_READ_SIZE):
+            pass
+
+
+class _InflateReader(io.RawIOBase):
+    """
+    Descompresión deflate en streaming de una entrada zip
+
+    Si el tamaño comprimido no se conoce (bit 3, data descriptor), se lee
+    hasta el final del stream deflate y el sobrante se devuelve al origen.
+    Con `max_size`, la lectura falla (MemberTooLarge) en cuanto la salida
+    pasa de ese tamaño, aunque la cabecera no lo declarase.
+    """
+
+    def __init__(
+        self,
+        stream: StreamBridge,
+        compressed_size: Optional[int],
+        budget: Optional[ArchiveBudget] = None,
+        max_size: Optional[int] = None
+    ):
+        super().__init__()
+        self._stream = stream
+        self._remaining = compressed_size
+        self._inflater = zlib.decompressobj(-15)
+        self._pending = b''
+        self._budget = budget
+        self._max_size = max_size
+        self._inflated = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            if self._inflater.eof:
+                return 0
+
+            if self._inflater.unconsumed_tail:
+                data = self._inflater.unconsumed_tail
+            else:
+                to_read = INFLATE_READ_SIZE if self._remaining is None else min(INFLATE_READ_SIZE, self._remaining)
+                data = self._stream.read(to_read) if to_read else b''
+                if not data:
+                    raise EOFError("Archivo comprimido truncado")
+                if self._remaining is not None:
+                    self._remaining -= len(data)
+
+            # Salida acotada: nunca más de lo que pide el lector
+            self._pending = self._inflater.decompress(data, len(buffer))
+            self._feed_unconsumed()
+            self._inflated += len(self._pending)
+            if self._budget is not None:
+                self._budget.consume(len(self._pending))
+            if self._max_size is not None and self._inflated > self._max_size:
+                self._pending = b''
+                raise MemberTooLarge(f"La entrada supera {self._max_size} bytes descomprimida")
+
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def _feed_unconsumed(self):
+        if self._inflater.eof and self._inflater.unused_data:
+            self._stream.unread(self._inflater.unused_data)
+
+    def drain(self):
+        # Hasta el final del stream deflate para encontrar la siguiente
+        # entrada; ya sin límite por entrada, pero sí con el del archivo
+        self._max_size = None
+        while self.read(INFLATE_READ_SIZE):
+            pass
+
+
+def iter_tar_members(
+    stream,
+    budget: Optional[ArchiveBudget] = None
+) -> Iterator[Tuple[str, int, float, io.BufferedIOBase]]:
+    """
+    Recorrer un tar (opcionalmente gz/bz2/xz) en modo streaming
+
+    En tar el tamaño de cada entrada es exacto y saltarla también obliga a
+    descomprimirla, así que el presupuesto se descuenta con la cabecera,
+    antes de leer el contenido.
+    """
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for member in archive:
+            if budget is not None:
+                budget.add_member()
+                budget.consume(member.size)
+            if not member.isfile():
+                continue
+            yield member.name, member.size, member.mtime, archive.extractfile(member)
+
+
+def iter_zip_members(
+    stream: StreamBridge,
+    budget: Optional[ArchiveBudget] = None,
+    max_member_size: Optional[int] = None
+) -> Iterator[Tuple[str, Optional[int], Optional[float], io.BufferedReader]]:
+    """
+    Recorrer un zip leyendo las cabeceras locales en orden
+
+    No usa el directorio central (está al final), así que funciona sobre
+    un stream sin posibilidad de seek. El contenido no leído de cada
+    entrada se descarta antes de pasar a la siguiente. Las entradas con
+    data descriptor (tamaño desconocido) se cortan con MemberTooLarge al
+    pasar de `max_member_size` bytes descomprimidos.
+    """
+    while True:
+        signature = read_exact(stream, 4)
+        if signature != ZIP_LOCAL_HEADER:
+            return  # Directorio central o fin del stream
+
+        header = read_exact(stream, 26)
+        if len(header) != 26:
+            raise EOFError("Cabecera zip truncada")
+
+        (_, flags, method, _, _, _, compressed_size, size,
+         name_len, extra_len) = struct.unpack('<HHHHHIIIHH', header)
+        name = read_exact(stream, name_len).decode('utf-8' if flags & 0x800 else 'cp437', errors='replace')
+        extra = read_exact(stream, extra_len)
+        if budget is not None:
+            budget.add_member()
+
+        if compressed_size == 0xFFFFFFFF or size == 0xFFFFFFFF:
+            size, compressed_size = _zip64_sizes(extra, size, compressed_size)
+
+        if flags & 0x1:
+            raise ValueError(f"Entrada zip cifrada no soportada: {name}")
+
+        has_descriptor = bool(flags & 0x08)
+        if method == 0:
+            if has_descriptor:
+                raise ValueError(f"Entrada zip sin compresión con data descriptor no soportada: {name}")
+            reader = _LimitedReader(stream, compressed_size, budget)
+        elif method == 8:
+            reader = _InflateReader(
+                stream,
+                None if has_descriptor else compressed_size,
+                budget,
+                max_member_size if has_descriptor else None
+            )
+        else:
+            raise ValueError(f"Método de compresión zip no soportado ({method}): {name}")
+
+        if not name.endswith('/'):
+            # Buffered: read(n) devuelve bloques completos al scanner
+            yield name, (None if has_descriptor else size), None, io.BufferedReader(reader, INFLATE_READ_SIZE)
+
+        reader.drain()
+
+        if has_descriptor:
+            _skip_data_descriptor(stream)
+
+
+def _zip64_sizes(extra: bytes, size: int, compressed_size: int) -> Tuple[int, int]:
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, data_size = struct.unpack('<HH', extra[offset:offset + 4])
+        data = extra[offset + 4:offset + 4 + data_size]
+        if header_id == 0x0001:
+            values = list(struct.unpack(f'<{len(data) // 8}Q', data[:len(data) // 8 * 8]))
+            if size == 0xFFFFFFFF and values:
+                size = values.pop(0)
+            if compressed_size == 0xFFFFFFFF and values:
+                compressed_size = values.pop(0)
+            break
+        offset += 4 + data_size
+    return size, compressed_size
+
+
+def _skip_data_descriptor(stream: StreamBridge):
+    """Saltar el data descriptor (con o sin firma, 32 o 64 bits)"""
+    head = read_exact(stream, 4)
+    if head != ZIP_DATA_DESCRIPTOR:
+        stream.unread(head)
+    read_exact(stream, 12)
+
+    # Zip64: tamaños de 8 bytes; si lo que sigue no es una cabecera, saltar 8 más
+    peek = read_exact(stream, 4)
+    if peek and peek[:2] != b'PK':
+        read_exact(stream, 4)
+    else:
+        stream.unread(peek)
+
+
+def iter_archive_members(
+    stream: StreamBridge,
+    archive_format: str = 'auto',
+    budget: Optional[ArchiveBudget] = None,
+    max_member_size: Optional[int] = None
+):
+    """
+    Recorrer las entradas de un tar o zip
+
+    Args:
+        stream: StreamBridge con el cuerpo de la petición
+        archive_format: 'tar', 'zip' o 'auto' (detecta por la firma inicial)
+        budget: Máximo de entradas y de bytes descomprimidos (ArchiveLimitExceeded)
+        max_member_size: Tamaño máximo de una entrada cuyo tamaño no se conoce de antemano
+
+    Yields:
+        (ruta, tamaño o None, mtime o None, objeto tipo archivo)
+    """
+    if archive_format == 'auto':
+        head = read_exact(stream, 4)
+        stream.unread(head)
+        archive_format = 'zip' if head == ZIP_LOCAL_HEADER else 'tar'
+
+    if archive_format == 'zip':
+        return iter_zip_members(stream, budget, max_member_size)
+    return iter_tar_members(stream, budget)
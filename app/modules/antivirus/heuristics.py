@@ -0,0 +1,177 @@
+"""
+Análisis estructural de PHP: entropía y estadísticas de tokens para detectar ofuscación
+"""
+import re
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+BLOCK_SIZE = 1024            # Bytes por bloque para la entropía
+LONG_LINE = 1000             # A partir de aquí una línea se considera sospechosa
+MAX_LINES_FOR_ENTROPY = 32   # Solo se mide la entropía de las líneas más largas
+
+DEEP_ANALYSIS_SCORE = 40     # Puntuación a partir de la cual se hace el análisis profundo
+OBFUSCATION_SCORE = 70       # Puntuación a partir de la cual se reporta amenaza
+
+MAX_CONCAT_PASSES = 8        # Pasadas de unión de literales en el análisis profundo
+
+_STRING_LITERAL = re.compile(rb"'(?:[^'\\\n]|\\.){0,4096}'|\"(?:[^\"\\\n]|\\.){0,4096}\"")
+_VARIABLE_CALL = re.compile(rb'\$[A-Za-z_]\w*(?:\s*\[[^\]\n]{0,64}\])*\s*\(')
+_CHR_CALL = re.compile(rb'\bchr\s*\(\s*(\d{1,3})\s*\)', re.IGNORECASE)
+_JOIN_LITERALS = re.compile(rb"'([^'\\\n]*)'\s*\.\s*'([^'\\\n]*)'|\"([^\"\\\n$]*)\"\s*\.\s*\"([^\"\\\n$]*)\"")
+
+# Funciones que delatan una llamada ofuscada cuando aparecen reconstruidas en un literal
+DANGEROUS_CALLS = {
+    b'eval', b'assert', b'system', b'exec', b'shell_exec', b'passthru',
+    b'popen', b'proc_open', b'create_function', b'base64_decode',
+    b'gzinflate', b'str_rot13', b'call_user_func', b'preg_replace'
+}
+
+
+# c * log2(c) precalculado: la entropía de un bloque sale de una consulta a tabla
+_C_LOG_C = np.zeros(BLOCK_SIZE + 1)
+_C_LOG_C[1:] = np.arange(1, BLOCK_SIZE + 1) * np.log2(np.arange(1, BLOCK_SIZE + 1))
+
+
+def block_entropy(data) -> np.ndarray:
+    """
+    Entropía de Shannon (bits/byte) de cada bloque de BLOCK_SIZE bytes
+
+    Un solo bincount para todos los bloques: el índice combina bloque y byte.
+    H = log2(N) - sum(c·log2 c) / N
+    """
+    arr = np.frombuffer(data, dtype=np.uint8)
+    blocks = len(arr) // BLOCK_SIZE
+    if blocks == 0:
+        return np.array([_entropy(np.bincount(arr, minlength=256), len(arr))])
+
+    index = arr[:blocks * BLOCK_SIZE].reshape(blocks, BLOCK_SIZE).astype(np.int32)
+    index += (np.arange(blocks, dtype=np.int32) * 256)[:, None]
+    counts = np.bincount(index.ravel(), minlength=blocks * 256).reshape(blocks, 256)
+    return np.log2(BLOCK_SIZE) - _C_LOG_C[counts].sum(axis=1) / BLOCK_SIZE
+
+
+def _entropy(counts: np.ndarray, total: int) -> float:
+    if total == 0:
+        return 0.0
+    nonzero = counts[counts > 0]
+    return float(np.log2(total) - (nonzero * np.log2(nonzero)).sum() / total)
+
+
+def line_stats(data) -> Tuple[int, float]:
+    """Línea más larga y entropía máxima entre las líneas más largas"""
+    arr = np.frombuffer(data, dtype=np.uint8)
+    if len(arr) == 0:
+        return 0, 0.0
+
+    bounds = np.concatenate(([-1], np.flatnonzero(arr == 10), [len(arr)]))
+    lengths = np.diff(bounds) - 1
+    longest = int(lengths.max())
+    if longest < LONG_LINE:
+        return longest, 0.0
+
+    max_entropy = 0.0
+    candidates = np.argsort(lengths)[-MAX_LINES_FOR_ENTROPY:]
+    for i in candidates:
+        if lengths[i] < LONG_LINE:
+            continue
+        line = arr[bounds[i] + 1:bounds[i + 1]]
+        max_entropy = max(max_entropy, _entropy(np.bincount(line, minlength=256), len(line)))
+    return longest, max_entropy
+
+
+def analyze_structure(data) -> Dict:
+    """
+    Características estructurales de un bloque de código
+
+    Returns:
+        Dict con entropías, línea más larga, proporción de literales,
+        llamadas a funciones variables, chr() y concatenaciones, y `score` (0-100)
+    """
+    size = len(data)
+    if size == 0:
+        return {'score': 0}
+
+    entropies = block_entropy(data)
+    longest_line, max_line_entropy = line_stats(data)
+
+    # Proporción de literales: solo hace falta si hay líneas largas (payload embebido)
+    literal_bytes = 0
+    if longest_line >= LONG_LINE:
+        literal_bytes = sum(m.end() - m.start() for m in _STRING_LITERAL.finditer(data))
+
+    raw = bytes(data)
+    lowered = raw.lower()
+
+    features = {
+        'max_block_entropy': round(float(entropies.max()), 3),
+        'mean_entropy': round(float(entropies.mean()), 3),
+        'high_entropy_blocks': int((entropies > 5.5).sum()),
+        'longest_line': longest_line,
+        'max_line_entropy': round(max_line_entropy, 3),
+        'string_ratio': round(literal_bytes / size, 3),
+        'variable_calls': len(_VARIABLE_CALL.findall(data)),
+        'chr_calls': lowered.count(b'chr(') + lowered.count(b'chr ('),
+        'concat_ops': sum(raw.count(op) for op in (b"'.'", b"' . '", b'"."', b'" . "'))
+    }
+    features['score'] = structure_score(features)
+    return features
+
+
+def structure_score(features: Dict) -> int:
+    """Combinar las características en una puntuación 0-100"""
+    entropy = max(features['max_block_entropy'], features['max_line_entropy'])
+    score = 30 * _clamp((entropy - 4.8) / 1.2)
+    if features['longest_line'] > LONG_LINE:
+        score += 20 * _clamp(np.log10(features['longest_line'] / LONG_LINE) / 2)
+    score += 15 * _clamp((features['string_ratio'] - 0.5) / 0.4)
+    score += 15 * _clamp(features['variable_calls'] / 5)
+    score += 10 * _clamp(features['chr_calls'] / 20)
+    score += 10 * _clamp(features['concat_ops'] / 50)
+
+    # Función variable + nombres construidos a trozos: patrón típico aunque el archivo
+    # sea corto; basta para pedir el análisis profundo, no para reportar amenaza
+    if features['variable_calls'] and (features['chr_calls'] or features['concat_ops'] >= 2):
+        score = max(score + 25, DEEP_ANALYSIS_SCORE)
+    return min(int(round(score)), 100)
+
+
+def _clamp(value: float) -> float:
+    return min(max(float(value), 0.0), 1.0)
+
+
+def normalize_strings(data: bytes) -> bytes:
+    """
+    Análisis profundo: reconstruir literales ofuscados
+
+    chr(101) -> 'e' y 'ev' . 'al' -> 'eval', para volver a pasar las
+    firmas sobre el código tal como se ejecutaría.
+    """
+    def chr_literal(match):
+        value = int(match.group(1))
+        if value > 255 or value in (0x27, 0x5c, 0x0a):  # ', \ y salto rompen el literal
+            return match.group(0)
+        return b"'" + bytes([value]) + b"'"
+
+    data = _CHR_CALL.sub(chr_literal, data)
+
+    def join(match):
+        if match.group(1) is not None:
+            return b"'" + match.group(1) + match.group(2) + b"'"
+        return b'"' + match.group(3) + match.group(4) + b'"'
+
+    for _ in range(MAX_CONCAT_PASSES):
+        data, replaced = _JOIN_LITERALS.subn(join, data)
+        if not replaced:
+            break
+    return data
+
+
+def hidden_calls(normalized: bytes) -> List[str]:
+    """Nombres de funciones peligrosas que solo aparecen como literal reconstruido"""
+    found = set()
+    for match in _STRING_LITERAL.finditer(normalized):
+        literal = match.group(0)[1:-1].strip().lower()
+        if literal in DANGEROUS_CALLS:
+            found.add(literal.decode())
+    return sorted(found)
@@ -0,0 +1,243 @@
+"""
+Cola de escaneos con límite por sitio y reparto justo entre sitios
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+from app.metrics import set_queue_depth
+
+logger = logging.getLogger(__name__)
+
+_worker_ids: Dict[int, str] = {}
+
+
+def worker_id() -> str:
+    """Dueño de los leases de este proceso (distinto tras un fork o un reinicio con el mismo pid)"""
+    pid = os.getpid()
+    if pid not in _worker_ids:
+        _worker_ids[pid] = f"{socket.gethostname()}:{pid}:{uuid.uuid4().hex[:8]}"
+    return _worker_ids[pid]
+
+
+class ScanCancelled(Exception):
+    """El escaneo fue cancelado mientras se ejecutaba"""
+
+
+class ScanJob:
+    """Escaneo pendiente o en ejecución en este proceso"""
+
+    def __init__(self, scan_id: str, site_id: str, options: Dict):
+        self.scan_id = scan_id
+        self.site_id = site_id
+        self.options = options
+        self.cancelled = False
+
+    def check_cancelled(self):
+        """Lanzar ScanCancelled si se pidió cancelar (se llama entre archivos)"""
+        if self.cancelled:
+            raise ScanCancelled(self.scan_id)
+
+
+class ScanScheduler:
+    """
+    Planificador de escaneos
+
+    - La cola persistente es la tabla scans (status 'pending'); en memoria
+      solo hay una cola por sitio, que se reconstruye al arrancar
+    - `workers` escaneos simultáneos como máximo en el proceso, y como
+      mucho `per_site_limit` de un mismo sitio
+    - Reparto round-robin: tras lanzar un escaneo de un sitio, ese sitio
+      pasa al final, así una ráfaga de un sitio no bloquea a los demás
+    - El trabajo de CPU (regex, hashes) va a un pool de hilos propio del
+      tamaño de `workers`, fuera del event loop que atiende /analyze
+    - Cada escaneo en ejecución tiene un lease en BD que se renueva cada
+      tercio de `lease_seconds` (`renew`); si se pierde (lo reclamó otro
+      proceso o se canceló) el escaneo para. `recover` se llama cada
+      `lease_seconds` para reencolar los escaneos con el lease vencido
+    """
+
+    def __init__(
+        self,
+        runner: Callable[[ScanJob], Awaitable[None]],
+        claim: Callable[[ScanJob], bool],
+        workers: int = 2,
+        per_site_limit: int = 1,
+        renew: Optional[Callable[[ScanJob], bool]] = None,
+        recover: Optional[Callable[[], Awaitable[int]]] = None,
+        lease_seconds: float = 120.0
+    ):
+        self.runner = runner
+        self.claim = claim
+        self.renew = renew
+        self.recover = recover
+        self.lease_seconds = lease_seconds
+        self.workers = workers
+        self.per_site_limit = per_site_limit
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scan')
+
+        self._queues: Dict[str, Deque[ScanJob]] = {}
+        self._site_order: Deque[str] = deque()
+        self._running: Dict[str, int] = {}
+        self._jobs: Dict[str, ScanJob] = {}
+        self._wakeup = asyncio.Condition()
+        self._worker_tasks = []
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    @property
+    def running(self) -> int:
+        return sum(self._running.values())
+
+    async def start(self):
+        """Arrancar los workers (en el lifespan de la app)"""
+        self._worker_tasks = [
+            asyncio.create_task(self._worker(), name=f"scan-worker-{i}")
+            for i in range(self.workers)
+        ]
+        if self.recover is not None:
+            self._worker_tasks.append(asyncio.create_task(self._reaper(), name="scan-reaper"))
+
+    async def stop(self):
+        """Parar los workers; los escaneos interrumpidos se reanudan al vencer su lease"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def queue_length(self, site_id: str) -> int:
+        """Escaneos en cola (sin contar los que se ejecutan) de un sitio"""
+        return len(self._queues.get(site_id) or ())
+
+    async def submit(self, job: ScanJob):
+        """Encolar un escaneo"""
+        queue = self._queues.get(job.site_id)
+        if queue is None:
+            queue = self._queues[job.site_id] = deque()
+            self._site_order.append(job.site_id)
+        queue.append(job)
+        self._jobs[job.scan_id] = job
+        self._publish_depth()
+
+        async with self._wakeup:
+            self._wakeup.notify()
+
+    def cancel(self, scan_id: str) -> bool:
+        """
+        Cancelar un escaneo de este proceso
+
+        Si está en cola se quita; si está en ejecución se marca y el
+        escaneo se detiene al terminar el archivo actual.
+        Devuelve False si el escaneo no está en este proceso.
+        """
+        job = self._jobs.get(scan_id)
+        if job is None:
+            return False
+
+        job.cancelled = True
+        queue = self._queues.get(job.site_id)
+        if queue is not None and job in queue:
+            queue.remove(job)
+            self._jobs.pop(scan_id, None)
+            self._drop_site_if_idle(job.site_id)
+            self._publish_depth()
+        return True
+
+    def get_job(self, scan_id: str) -> Optional[ScanJob]:
+        """Escaneo en cola o en ejecución en este proceso"""
+        return self._jobs.get(scan_id)
+
+    def position(self, scan_id: str) -> Optional[int]:
+        """Posición aproximada en la cola (0 = en ejecución, None = desconocido)"""
+        job = self._jobs.get(scan_id)
+        if job is None:
+            return None
+        queue = self._queues.get(job.site_id)
+        if queue is None or job not in queue:
+            return 0
+        return queue.index(job) + 1
+
+    def _next_job(self) -> Optional[ScanJob]:
+        """Siguiente escaneo en orden round-robin entre sitios con hueco"""
+        for _ in range(len(self._site_order)):
+            site_id = self._site_order[0]
+            self._site_order.rotate(-1)
+            queue = self._queues.get(site_id)
+            if queue and self._running.get(site_id, 0) < self.per_site_limit:
+                return queue.popleft()
+        return None
+
+    def _publish_depth(self):
+        set_queue_depth('scan', self.queued, self.running)
+
+    def _drop_site_if_idle(self, site_id: str):
+        if not self._queues.get(site_id) and not self._running.get(site_id):
+            self._queues.pop(site_id, None)
+            self._running.pop(site_id, None)
+            try:
+                self._site_order.remove(site_id)
+            except ValueError:
+                pass
+
+    async def _worker(self):
+        while True:
+            async with self._wakeup:
+                job = self._next_job()
+                while job is None:
+                    await self._wakeup.wait()
+                    job = self._next_job()
+                self._running[job.site_id] = self._running.get(job.site_id, 0) + 1
+                self._publish_depth()
+
+            heartbeat = None
+            try:
+                # Otro proceso pudo tomarlo o cancelarlo (el estado en BD manda)
+                if not job.cancelled and await asyncio.to_thread(self.claim, job):
+                    if self.renew is not None:
+                        heartbeat = asyncio.create_task(self._heartbeat(job))
+                    await self.runner(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error ejecutando el escaneo {job.scan_id}: {e}")
+            finally:
+                if heartbeat is not None:
+                    heartbeat.cancel()
+                self._running[job.site_id] -= 1
+                self._jobs.pop(job.scan_id, None)
+                self._drop_site_if_idle(job.site_id)
+                self._publish_depth()
+                async with self._wakeup:
+                    self._wakeup.notify_all()
+
+    async def _heartbeat(self, job: ScanJob):
+        """Renovar el lease del escaneo mientras se ejecuta"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                renewed = await asyncio.to_thread(self.renew, job)
+            except Exception as e:
+                logger.warning(f"⚠️  No se pudo renovar el lease del escaneo {job.scan_id}: {e}")
+                continue
+            if not renewed:
+                # Cancelado o reclamado por otro proceso: parar en el siguiente archivo
+                logger.warning(f"⚠️  Lease perdido, se detiene el escaneo {job.scan_id}")
+                job.cancelled = True
+                return
+
+    async def _reaper(self):
+        """Reencolar periódicamente los escaneos cuyo lease venció (procesos caídos)"""
+        while True:
+            await asyncio.sleep(self.lease_seconds)
+            try:
+                await self.recover()
+            except Exception as e:
+                logger.warning(f"⚠️  Error recuperando escaneos huérfanos: {e}")
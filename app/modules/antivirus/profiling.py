@@ -0,0 +1,129 @@
+"""
+Perfilado de firmas: coste, bytes escaneados, aciertos y falsos positivos por firma
+"""
+import logging
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+FEEDBACK_CACHE_TTL = 60.0  # Segundos
+
+_feedback_cache: Optional[Tuple[float, Dict[str, Dict]]] = None
+_feedback_rpc_available = True
+
+
+class SignatureProfiler:
+    """
+    Contadores acumulados por firma (nombre) en este proceso
+
+    El motor acumula por archivo en su MatchState y vuelca aquí una vez
+    por archivo, así el lock no está en el bucle de regex.
+    """
+
+    FIELDS = ('runs', 'prefilter_skips', 'time_ns', 'bytes_scanned', 'hits')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self.files = 0  # Contenidos analizados (archivos y capas desempaquetadas)
+        self.started_at = time.time()
+
+    def record_file(self, counters: Iterable[Tuple[str, int, int, int, int, int]]):
+        """Volcar los contadores de un archivo: (nombre, runs, skips, ns, bytes, hits)"""
+        with self._lock:
+            self.files += 1
+            for name, *values in counters:
+                stats = self._stats.get(name)
+                if stats is None:
+                    stats = self._stats[name] = dict.fromkeys(self.FIELDS, 0)
+                for field, value in zip(self.FIELDS, values):
+                    stats[field] += value
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.files = 0
+            self.started_at = time.time()
+
+
+@lru_cache()
+def get_signature_profiler() -> SignatureProfiler:
+    """Perfilador compartido por todo el proceso"""
+    return SignatureProfiler()
+
+
+def get_signature_feedback(client, names: List[str]) -> Dict[str, Dict]:
+    """
+    Detecciones e ignoradas por firma (tabla threats, todos los sitios)
+
+    Usa la función SQL `antivirus_signature_feedback()`:
+
+        select signature_matched,
+               count(*) as detections,
+               count(*) filter (where status = 'ignored') as ignored
+        from threats group by signature_matched
+
+    Si no existe, dos conteos con head por firma. Caché de FEEDBACK_CACHE_TTL segundos.
+    """
+    global _feedback_cache
+    now = time.monotonic()
+    if _feedback_cache is not None and _feedback_cache[0] > now:
+        return _feedback_cache[1]
+
+    feedback = _fetch_feedback_rpc(client) if _feedback_rpc_available else None
+    if feedback is None:
+        feedback = _fetch_feedback_counts(client, names)
+
+    _feedback_cache = (now + FEEDBACK_CACHE_TTL, feedback)
+    return feedback
+
+
+def _fetch_feedback_rpc(client) -> Optional[Dict[str, Dict]]:
+    global _feedback_rpc_available
+    try:
+        result = client.rpc('antivirus_signature_feedback', {}).execute()
+    except Exception as e:
+        # Función inexistente (PostgREST PGRST202 / Postgres 42883): no volver a intentarlo
+        if 'PGRST202' in str(e) or '42883' in str(e):
+            _feedback_rpc_available = False
+        logger.warning(f"⚠️  RPC antivirus_signature_feedback no disponible, usando conteos: {e}")
+        return None
+
+    return {
+        row['signature_matched']: _feedback(row.get('detections') or 0, row.get('ignored') or 0)
+        for row in result.data or []
+    }
+
+
+def _fetch_feedback_counts(client, names: List[str]) -> Dict[str, Dict]:
+    feedback = {}
+    for name in names:
+        total = client.table('threats')\
+            .select('id', count='exact', head=True)\
+            .eq('signature_matched', name)\
+            .execute()
+        if not total.count:
+            continue
+        ignored = client.table('threats')\
+            .select('id', count='exact', head=True)\
+            .eq('signature_matched', name)\
+            .eq('status', 'ignored')\
+            .execute()
+        feedback[name] = _feedback(total.count, ignored.count or 0)
+    return feedback
+
+
+def _feedback(detections: int, ignored: int) -> Dict:
+    return {
+        'detections': detections,
+        'ignored': ignored,
+        # Amenazas ignoradas por el usuario ~ falsos positivos
+        'false_positive_rate': round(ignored / detections, 4) if detections else None
+    }
@@ -0,0 +1,223 @@
+"""
+Reporte de progreso de escaneos con escrituras a BD agrupadas
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, Optional, Set
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Progreso en vivo de los escaneos de este proceso (scan_id -> estado)
+_live_progress: Dict[str, Dict] = {}
+# Suscriptores a los eventos de cada escaneo (scan_id -> colas)
+_subscribers: Dict[str, Set[asyncio.Queue]] = {}
+_redis_client = None
+
+SUBSCRIBER_QUEUE_SIZE = 256
+
+REDIS_KEY_PREFIX = "spamguard:scan_progress:"
+REDIS_TTL_SECONDS = 3600
+
+
+def _get_redis():
+    """Cliente Redis compartido (None si no hay REDIS_URL configurada)"""
+    global _redis_client
+    settings = get_settings()
+    if _redis_client is None and settings.redis_url:
+        import redis.asyncio as redis
+        _redis_client = redis.from_url(settings.redis_url, decode_responses=True)
+    return _redis_client
+
+
+async def get_live_progress(scan_id: str) -> Optional[Dict]:
+    """
+    Progreso actual de un escaneo en curso
+
+    Primero en memoria (mismo proceso), después en Redis (otro worker).
+    Devuelve None si el escaneo no está en ejecución en ningún sitio conocido.
+    """
+    state = _live_progress.get(scan_id)
+    if state is not None:
+        return state
+
+    client = _get_redis()
+    if client is None:
+        return None
+
+    try:
+        raw = await client.get(REDIS_KEY_PREFIX + scan_id)
+        return json.loads(raw) if raw else None
+    except Exception as e:
+        logger.warning(f"⚠️  Error leyendo progreso de Redis: {e}")
+        return None
+
+
+def subscribe(scan_id: str) -> asyncio.Queue:
+    """
+    Suscribirse a los eventos de un escaneo de este proceso
+
+    La cola recibe tuplas (evento, datos) con evento 'progress', 'threat' o 'done'.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    _subscribers.setdefault(scan_id, set()).add(queue)
+    return queue
+
+
+def unsubscribe(scan_id: str, queue: asyncio.Queue):
+    queues = _subscribers.get(scan_id)
+    if queues is not None:
+        queues.discard(queue)
+        if not queues:
+            _subscribers.pop(scan_id, None)
+
+
+def has_subscribers(scan_id: str) -> bool:
+    return bool(_subscribers.get(scan_id))
+
+
+def is_running_here(scan_id: str) -> bool:
+    """¿El escaneo se está ejecutando en este proceso?"""
+    return scan_id in _live_progress
+
+
+def publish_event(scan_id: str, event: str, data: Dict):
+    """Entregar un evento sin bloquear al escaneo"""
+    for queue in _subscribers.get(scan_id, ()):
+        if queue.full():
+            # Cliente lento: se descarta el evento más antiguo
+            queue.get_nowait()
+        queue.put_nowait((event, data))
+
+
+class ScanProgressReporter:
+    """
+    Agrupa las actualizaciones de progreso de un escaneo
+
+    - Cada archivo actualiza el estado en memoria (sin I/O)
+    - Los suscriptores en proceso (SSE) reciben el progreso como mucho cada
+      `stream_interval` segundos, y cada amenaza en cuanto aparece
+    - Redis se actualiza como mucho cada `live_interval` segundos
+    - La tabla scans solo se escribe en checkpoints: cuando han pasado
+      `min_interval` segundos y el progreso avanzó `min_delta` puntos,
+      o cada `max_interval` segundos como latido
+    """
+
+    def __init__(
+        self,
+        scan_id: str,
+        site_id: str,
+        db_writer,
+        min_interval: Optional[float] = None,
+        min_delta: Optional[int] = None,
+        max_interval: float = 30.0,
+        live_interval: float = 0.5,
+        stream_interval: float = 0.2
+    ):
+        settings = get_settings()
+        self.scan_id = scan_id
+        self.db_writer = db_writer
+        self.min_interval = min_interval if min_interval is not None else settings.scan_progress_interval
+        self.min_delta = min_delta if min_delta is not None else settings.scan_progress_min_delta
+        self.max_interval = max_interval
+        self.live_interval = live_interval
+        self.stream_interval = stream_interval
+
+        self.state = {
+            'scan_id': scan_id,
+            'site_id': site_id,
+            'status': 'running',
+            'progress': 0,
+            'files_scanned': 0,
+            'threats_found': 0,
+            'current_file': None
+        }
+        self.db_writes = 0
+        self._last_db_write = time.monotonic()
+        self._last_db_progress = 0
+        self._last_live_write = 0.0
+        self._last_stream = 0.0
+
+        _live_progress[scan_id] = self.state
+
+    async def update(
+        self,
+        progress: int,
+        files_scanned: int,
+        threats_found: int,
+        current_file: Optional[str] = None
+    ):
+        """Registrar el progreso tras escanear un archivo"""
+        self.state['progress'] = progress
+        self.state['files_scanned'] = files_scanned
+        self.state['threats_found'] = threats_found
+        self.state['current_file'] = current_file
+
+        now = time.monotonic()
+
+        if now - self._last_stream >= self.stream_interval and has_subscribers(self.scan_id):
+            self._last_stream = now
+            publish_event(self.scan_id, 'progress', dict(self.state))
+
+        if now - self._last_live_write >= self.live_interval:
+            self._last_live_write = now
+            await self._publish_live()
+
+        elapsed = now - self._last_db_write
+        advanced = progress - self._last_db_progress >= self.min_delta
+        if (advanced and elapsed >= self.min_interval) or elapsed >= self.max_interval:
+            await self.checkpoint()
+
+    async def checkpoint(self):
+        """Escribir el estado actual en la tabla scans"""
+        self._last_db_write = time.monotonic()
+        self._last_db_progress = self.state['progress']
+        self.db_writes += 1
+
+        self.db_writer({
+            'progress': self.state['progress'],
+            'files_scanned': self.state['files_scanned'],
+            'threats_found': self.state['threats_found'],
+            'results': {
+                'current_file': self.state['current_file']
+            }
+        })
+
+    def report_threat(self, scan_result: Dict):
+        """Avisar a los suscriptores de un archivo con amenazas"""
+        publish_event(self.scan_id, 'threat', {
+            'file_path': scan_result['file_path'],
+            'threats': [
+                {'signature': t['signature'], 'severity': t['severity']}
+                for t in scan_result['threats']
+            ]
+        })
+
+    async def finish(self, status: str = 'completed'):
+        """Quitar el escaneo del estado en vivo y avisar a los suscriptores"""
+        _live_progress.pop(self.scan_id, None)
+        publish_event(self.scan_id, 'done', {**self.state, 'status': status, 'current_file': None})
+
+        client = _get_redis()
+        if client is not None:
+            try:
+                await client.delete(REDIS_KEY_PREFIX + self.scan_id)
+            except Exception as e:
+                logger.warning(f"⚠️  Error limpiando progreso en Redis: {e}")
+
+    async def _publish_live(self):
+        client = _get_redis()
+        if client is None:
+            return
+
+        try:
+            await client.set(
+                REDIS_KEY_PREFIX + self.scan_id,
+                json.dumps(self.state),
+                ex=REDIS_TTL_SECONDS
+            )
+        except Exception as e:
+            logger.warning(f"⚠️  Error publicando progreso en Redis: {e}")
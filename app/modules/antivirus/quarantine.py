@@ -0,0 +1,236 @@
+"""
+Cuarentena: almacén de contenido direccionado por hash, comprimido y sin duplicados
+"""
+import hashlib
+import os
+import tempfile
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+READ_SIZE = 1024 * 1024
+COMPRESSION_LEVEL = 6
+
+
+class QuarantineStore:
+    """
+    Blobs de archivos en cuarentena, uno por contenido (sha256)
+
+    Estructura: <root>/<sha[:2]>/<sha>.z (deflate). Cada blob se escribe en
+    un temporal del mismo directorio y se publica con os.replace, así nunca
+    hay blobs a medio escribir. Si el contenido ya existe no se vuelve a
+    guardar: la misma webshell en 5.000 rutas ocupa un solo blob.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def blob_path(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / f"{sha256}.z"
+
+    def has(self, sha256: str) -> bool:
+        return self.blob_path(sha256).exists()
+
+    def put_fileobj(self, f: BinaryIO) -> Tuple[str, int]:
+        """
+        Guardar un contenido leído por bloques (memoria constante)
+
+        Returns:
+            (sha256, tamaño original en bytes)
+        """
+        digest = hashlib.sha256()
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        size = 0
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.incoming-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = f.read(READ_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+                    out.write(compressor.compress(chunk))
+                out.write(compressor.flush())
+
+            sha256 = digest.hexdigest()
+            target = self.blob_path(sha256)
+            if target.exists():
+                os.unlink(tmp_path)  # Ya estaba: deduplicado
+                os.utime(target)  # Visto de nuevo: el último en salir con prune()
+            else:
+                target.parent.mkdir(exist_ok=True)
+                os.replace(tmp_path, target)
+            return sha256, size
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def put_file(self, file_path: str, expected_sha256: Optional[str] = None) -> Tuple[str, int]:
+        """
+        Guardar un archivo local
+
+        Si ya hay blob con el hash esperado solo se verifica el hash (sin
+        comprimir ni escribir); el archivo pudo cambiar desde el escaneo.
+        """
+        if expected_sha256 and self.has(expected_sha256):
+            digest = hashlib.sha256()
+            size = 0
+            with open(file_path, 'rb') as f:
+                while True:
+                    chunk = f.read(READ_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+            if digest.hexdigest() == expected_sha256:
+                os.utime(self.blob_path(expected_sha256))
+                return expected_sha256, size
+
+        with open(file_path, 'rb') as f:
+            return self.put_fileobj(f)
+
+    def iter_content(self, sha256: str) -> Iterable[bytes]:
+        """Contenido original de un blob, por bloques"""
+        decompressor = zlib.decompressobj()
+        with open(self.blob_path(sha256), 'rb') as f:
+            while True:
+                chunk = f.read(READ_SIZE)
+                if not chunk:
+                    break
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+            tail = decompressor.flush()
+            if tail:
+                yield tail
+
+    def restore(self, sha256: str, dest_path: str) -> int:
+        """
+        Restaurar un blob en `dest_path` (escritura atómica, con verificación del hash)
+
+        Returns:
+            Bytes escritos
+        """
+        dest = Path(dest_path)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+
+        fd, tmp_path = tempfile.mkstemp(dir=dest.parent, prefix=f".{dest.name}.restore-")
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for data in self.iter_content(sha256):
+                    digest.update(data)
+                    size += len(data)
+                    out.write(data)
+            if digest.hexdigest() != sha256:
+                raise ValueError(f"Blob de cuarentena corrupto: {sha256}")
+            os.replace(tmp_path, dest)
+            return size
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def delete(self, sha256: str) -> bool:
+        try:
+            self.blob_path(sha256).unlink()
+            return True
+        except FileNotFoundError:
+            return False
+
+    def prune(self, max_bytes: int) -> int:
+        """
+        Borrar los blobs usados hace más tiempo hasta ocupar como mucho `max_bytes`
+
+        El mtime de un blob se renueva cada vez que se vuelve a guardar su
+        contenido. Devuelve el número de blobs borrados.
+        """
+        blobs = []
+        total = 0
+        for path in self.root.glob('*/*.z'):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            blobs.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        removed = 0
+        blobs.sort()
+        for _, size, path in blobs:
+            if total <= max_bytes:
+                break
+            try:
+                path.unlink()
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return removed
+
+    def quarantine_files(self, threats: List[Dict], local_paths: Optional[Dict[str, str]] = None) -> Dict[str, List[Dict]]:
+        """
+        Poner en cuarentena un lote de amenazas (filas con id, file_path y file_sha256)
+
+        Solo se lee y se borra del disco lo que está en `local_paths` (id de
+        amenaza -> ruta real ya comprobada dentro de la raíz del sitio); el
+        resto solo puede usar un blob que ya esté guardado. Cada contenido se
+        guarda una sola vez y los archivos locales se borran una vez guardado
+        su contenido. Las amenazas sin contenido disponible quedan con blob None.
+
+        Returns:
+            {sha256 o None: [amenazas]} para actualizar la BD con un UPDATE por blob
+        """
+        local_paths = local_paths or {}
+        by_blob: Dict[Optional[str], List[Dict]] = {}
+        stored_paths: Dict[str, str] = {}  # ruta -> sha256 (la misma ruta puede tener varias amenazas)
+
+        for threat in threats:
+            expected = threat.get('file_sha256')
+            path = local_paths.get(threat['id'])
+            sha256 = stored_paths.get(path) if path else None
+
+            if sha256 is None:
+                if path and os.path.isfile(path):
+                    sha256, _ = self.put_file(path, expected)
+                    stored_paths[path] = sha256
+                elif expected and self.has(expected):
+                    sha256 = expected
+
+            by_blob.setdefault(sha256, []).append(threat)
+
+        # Solo ahora, con todos los blobs escritos, se retiran los originales
+        for path in stored_paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+        return by_blob
+
+
+@lru_cache()
+def get_quarantine_store() -> QuarantineStore:
+    """Almacén compartido, en el volumen persistente si existe"""
+    volume_path = os.getenv('RAILWAY_VOLUME_MOUNT_PATH')
+    root = Path(volume_path) / 'quarantine' if volume_path else Path('quarantine')
+    return QuarantineStore(str(root))
+
+
+@lru_cache()
+def get_content_store() -> QuarantineStore:
+    """
+    Contenido ya escaneado (limpio o no), para reescanearlo con firmas nuevas
+
+    Mismo formato que la cuarentena pero otro directorio: sus blobs se
+    pueden borrar (prune) sin tocar nada en cuarentena.
+    """
+    volume_path = os.getenv('RAILWAY_VOLUME_MOUNT_PATH')
+    root = Path(volume_path) / 'content' if volume_path else Path('content')
+    return QuarantineStore(str(root))
@@ -0,0 +1,456 @@
+"""
+Reescaneo diferencial: contenido ya escaneado frente a las firmas nuevas
+
+Cuando cambia el conjunto de firmas, los veredictos de file_verdicts de
+versiones anteriores se revisan pasando solo las firmas añadidas o
+modificadas sobre el contenido guardado (un blob por contenido distinto,
+ver get_content_store). Las amenazas nuevas se registran en cada sitio
+que tiene ese contenido.
+
+Tablas:
+- signature_versions: version (PK), fingerprints (JSON nombre -> huella o null), created_at
+- site_files: site_id + file_path (PK), sha256, seen_at (índice por sha256)
+"""
+import asyncio
+import io
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from .quarantine import QuarantineStore
+from .scanner import FileScanner
+from .signatures import SignatureManager
+from .stats import invalidate_site_stats
+from .verdicts import ENGINE_VERSION, split_verdict_version, verdict_version
+
+logger = logging.getLogger(__name__)
+
+INDEX_BATCH = 1000          # Filas de site_files por upsert
+LOOKUP_BATCH = 200          # Hashes por consulta (mantiene la URL de PostgREST acotada)
+THREAT_BATCH = 500          # Amenazas por insert
+PRUNE_INTERVAL = 3600.0     # Segundos entre limpiezas del almacén de contenido
+BATCH_PAUSE = 1.0           # Segundos entre lotes seguidos (no martillear la BD)
+
+
+class SignatureVersions:
+    """
+    Huellas de las firmas de cada versión del conjunto (tabla signature_versions)
+
+    Una huella None marca una firma que sigue en los archivos de firmas
+    pero se descartó al vetarla en esa versión: no está activa, pero no se
+    ha quitado. created_at ordena las versiones; en un despliegue gradual
+    conviven procesos con firmas distintas y cada uno solo revisa lo
+    registrado antes que su versión.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._cache: Dict[str, Optional[Dict]] = {}  # versión -> fila (fingerprints, created_at) o None
+
+    def register(self, compiled):
+        """Guardar las huellas de la versión actual (una vez por proceso)"""
+        if self._cache.get(compiled.version) is not None:
+            return
+        fingerprints = {entry['name']: None for entry in compiled.rejected}
+        fingerprints.update(compiled.fingerprints)
+        self.client.table('signature_versions')\
+            .upsert({
+                'version': compiled.version,
+                'fingerprints': fingerprints,
+                'created_at': datetime.utcnow().isoformat()
+            }, ignore_duplicates=True)\
+            .execute()
+        # Se relee: si otro proceso la registró antes, manda su created_at
+        self._cache.pop(compiled.version, None)
+        self._row(compiled.version)
+
+    def forget_missing(self):
+        """Volver a consultar las versiones no registradas (un proceso nuevo pudo registrarlas)"""
+        self._cache = {version: row for version, row in self._cache.items() if row is not None}
+
+    def _row(self, version: str) -> Optional[Dict]:
+        if version not in self._cache:
+            result = self.client.table('signature_versions')\
+                .select('fingerprints, created_at')\
+                .eq('version', version)\
+                .execute()
+            self._cache[version] = result.data[0] if result.data else None
+        return self._cache[version]
+
+    def get(self, version: str) -> Optional[Dict[str, Optional[str]]]:
+        """Huellas de una versión, o None si nunca se registró (anterior a esta tabla)"""
+        row = self._row(version)
+        return row['fingerprints'] if row is not None else None
+
+    def is_older(self, version: str, than: str) -> bool:
+        """True si `version` se registró antes que `than` (False si alguna no está registrada)"""
+        row, reference = self._row(version), self._row(than)
+        return row is not None and reference is not None and row['created_at'] < reference['created_at']
+
+
+class SiteFileIndex:
+    """
+    Qué contenido tiene cada ruta de un sitio (tabla site_files), escrito por lotes
+
+    Es lo que permite pasar de "este contenido tiene una amenaza nueva" a
+    "estos sitios y rutas la tienen" sin volver a escanear ningún sitio.
+    """
+
+    def __init__(self, client, site_id: str, batch_size: int = INDEX_BATCH):
+        self.client = client
+        self.site_id = site_id
+        self.batch_size = batch_size
+        self._pending: Dict[str, str] = {}  # ruta -> sha256 (una fila por ruta y upsert)
+
+    def add(self, file_path: str, sha256: str):
+        self._pending[file_path] = sha256.lower()
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def add_result(self, scan_result: Dict):
+        if not scan_result.get('error') and scan_result.get('file_sha256'):
+            self.add(scan_result['file_path'], scan_result['file_sha256'])
+
+    def flush(self):
+        if not self._pending:
+            return
+        now = datetime.utcnow().isoformat()
+        rows = [
+            {'site_id': self.site_id, 'file_path': path, 'sha256': sha256, 'seen_at': now}
+            for path, sha256 in self._pending.items()
+        ]
+        self._pending = {}
+        self.client.table('site_files').upsert(rows, on_conflict='site_id,file_path').execute()
+
+
+def retain_content(store: QuarantineStore, file_path: str, sha256: str, size: int, max_size: int) -> bool:
+    """Guardar en el almacén el contenido de un archivo local ya escaneado (si no es muy grande)"""
+    if size > max_size or not os.path.isfile(file_path):
+        return False
+    try:
+        stored, _ = store.put_file(file_path, sha256)
+    except OSError as e:
+        logger.warning(f"⚠️  No se pudo guardar el contenido de {file_path}: {e}")
+        return False
+    return stored == sha256
+
+
+class DifferentialRescanner:
+    """
+    Una pasada de reescaneo diferencial (se ejecuta en un hilo)
+
+    Por cada contenido con veredicto de una versión registrada antes que la
+    actual (los de versiones más nuevas o sin registrar no se tocan: son de
+    otro proceso del mismo despliegue o anteriores a signature_versions):
+    1. Firmas cambiadas = activas nuevas o con otra huella; se olvidan las
+       amenazas de las cambiadas y de las que la versión actual ya no define
+    2. Solo las cambiadas se pasan sobre el blob guardado, con el mismo
+       FileScanner de un escaneo normal (capas desempaquetadas y código
+       normalizado incluidos)
+    3. El veredicto pasa a la versión actual; si hay amenazas nuevas, el
+       cambio se hace con un UPDATE condicionado a la versión anterior, así
+       entre varios procesos solo uno las registra
+    4. Contenido no guardado, o veredicto de una versión anterior del motor
+       (sus heurísticas no se pueden rehacer con un subconjunto de firmas):
+       se borra el veredicto y el próximo escaneo del sitio lo vuelve a pedir
+
+    Los lotes avanzan por sha256 (keyset): los veredictos que se saltan no
+    vuelven a aparecer hasta la siguiente vuelta completa.
+    """
+
+    def __init__(
+        self,
+        client,
+        manager: SignatureManager,
+        store: QuarantineStore,
+        sandbox=None,
+        batch_size: int = 200
+    ):
+        self.client = client
+        self.manager = manager
+        self.store = store
+        self.sandbox = sandbox
+        self.batch_size = batch_size
+        self.versions = SignatureVersions(client)
+        self._cursor: Optional[str] = None  # Último sha256 revisado en la vuelta actual
+
+    def run_once(self) -> Dict:
+        """
+        Revisar un lote de veredictos desactualizados
+
+        Returns:
+            Contadores de la pasada; `more` indica que puede quedar trabajo
+        """
+        started = time.monotonic()
+        compiled = self.manager.get_compiled()
+        self.versions.forget_missing()
+        self.versions.register(compiled)
+        current_version = verdict_version(compiled.version)
+        current_fingerprints = self.versions.get(compiled.version)
+
+        query = self.client.table('file_verdicts')\
+            .select('sha256, signature_version, verdict, threats, suspicious_functions')\
+            .neq('signature_version', current_version)
+        if self._cursor is not None:
+            query = query.gt('sha256', self._cursor)
+        rows = query.order('sha256').limit(self.batch_size).execute().data or []
+        more = len(rows) == self.batch_size
+        self._cursor = rows[-1]['sha256'] if more else None
+
+        stats = {
+            'version': compiled.version,
+            'checked': 0,
+            'rules_run': 0,
+            'unavailable': 0,
+            'engine_changed': 0,
+            'not_older': 0,
+            'new_threats': 0,
+            'raced': 0,
+            'more': more
+        }
+        unchanged = []
+        new_by_content: Dict[str, List[Dict]] = {}
+
+        for row in rows:
+            row_signatures, row_engine = split_verdict_version(row['signature_version'])
+            if row_engine is not None and row_engine > ENGINE_VERSION:
+                stats['not_older'] += 1  # Motor más nuevo: lo revisa su proceso
+                continue
+            if row_engine != ENGINE_VERSION:
+                self._forget(row)
+                stats['engine_changed'] += 1
+                continue
+            if current_fingerprints is None or not self.versions.is_older(row_signatures, compiled.version):
+                stats['not_older'] += 1
+                continue
+
+            changed, stale = self._diff(self.versions.get(row_signatures), current_fingerprints)
+            threats = [t for t in row.get('threats') or [] if t['signature'] not in stale]
+
+            new = []
+            if changed:
+                new = self._match(compiled.subset(changed), row['sha256'])
+                if new is None:
+                    self._forget(row)
+                    stats['unavailable'] += 1
+                    continue
+                stats['rules_run'] += len(changed)
+
+            known = {t['signature'] for t in row.get('threats') or []}
+            added = [t for t in new if t['signature'] not in known]
+            verdict = {
+                'signature_version': current_version,
+                'verdict': 'malicious' if threats + new else 'clean',
+                'threats': threats + new,
+                'suspicious_functions': row.get('suspicious_functions') or [],
+                'updated_at': datetime.utcnow().isoformat()
+            }
+            stats['checked'] += 1
+
+            if not added:
+                unchanged.append({'sha256': row['sha256'], **verdict})
+                continue
+
+            claimed = self.client.table('file_verdicts')\
+                .update(verdict)\
+                .eq('sha256', row['sha256'])\
+                .eq('signature_version', row['signature_version'])\
+                .execute()
+            if claimed.data:
+                new_by_content[row['sha256']] = added
+            else:
+                stats['raced'] += 1  # Otro proceso ya lo revisó
+
+        for i in range(0, len(unchanged), LOOKUP_BATCH):
+            self.client.table('file_verdicts').upsert(unchanged[i:i + LOOKUP_BATCH]).execute()
+
+        if new_by_content:
+            stats['new_threats'] = self._record_threats(new_by_content, compiled.version)
+
+        stats['seconds'] = round(time.monotonic() - started, 3)
+        if rows:
+            logger.info(
+                f"🔁 Reescaneo diferencial ({compiled.version}): {stats['checked']} contenidos, "
+                f"{stats['new_threats']} amenazas nuevas, {stats['unavailable']} sin contenido"
+            )
+        return stats
+
+    @staticmethod
+    def _diff(old: Dict[str, Optional[str]], current: Dict[str, Optional[str]]) -> Tuple[Set[str], Set[str]]:
+        """
+        (firmas a pasar, firmas cuyas amenazas previas dejan de valer)
+
+        Huellas tal como están registradas (None = definida pero descartada
+        al vetarla). Solo se quitan las amenazas de firmas que la versión
+        actual ya no define; las de una firma descartada se conservan, y
+        las heurísticas (ofuscación, etc.) también.
+        """
+        changed = {
+            name for name, fingerprint in current.items()
+            if fingerprint is not None and old.get(name) != fingerprint
+        }
+        return changed, changed | (set(old) - set(current))
+
+    def _match(self, subset, sha256: str) -> Optional[List[Dict]]:
+        """
+        Amenazas de las firmas de `subset` en un contenido guardado
+
+        None si el contenido no está o la pasada quedó incompleta (se olvida
+        el veredicto y el próximo escaneo del sitio lo rehace entero).
+        """
+        if not self.store.has(sha256):
+            return None
+        try:
+            data = b''.join(self.store.iter_content(sha256))
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️  Contenido guardado ilegible {sha256}: {e}")
+            return None
+
+        result = FileScanner(signatures=subset, sandbox=self.sandbox).scan_fileobj(io.BytesIO(data), sha256)
+        if result.get('error'):
+            logger.warning(f"⚠️  Error reescaneando {sha256}: {result['error']}")
+            return None
+        if any(t['signature'] == 'scan_timeout' for t in result['threats']):
+            return None
+
+        # Solo las firmas del subconjunto: las heurísticas ya están en el veredicto
+        names = {signature['name'] for signature in subset.signatures}
+        return [
+            {
+                'signature': t['signature'],
+                'severity': t['severity'],
+                'code_snippet': t.get('code_snippet', ''),
+                'line_number': t.get('line_number')
+            }
+            for t in result['threats']
+            if t['signature'] in names
+        ]
+
+    def _forget(self, row: Dict):
+        self.client.table('file_verdicts')\
+            .delete()\
+            .eq('sha256', row['sha256'])\
+            .eq('signature_version', row['signature_version'])\
+            .execute()
+
+    def _record_threats(self, new_by_content: Dict[str, List[Dict]], version: str) -> int:
+        """Registrar las amenazas nuevas en cada sitio que tiene ese contenido"""
+        hashes = list(new_by_content)
+        by_site: Dict[str, List[Tuple[str, str]]] = {}
+        for i in range(0, len(hashes), LOOKUP_BATCH):
+            result = self.client.table('site_files')\
+                .select('site_id, file_path, sha256')\
+                .in_('sha256', hashes[i:i + LOOKUP_BATCH])\
+                .execute()
+            for row in result.data or []:
+                by_site.setdefault(row['site_id'], []).append((row['file_path'], row['sha256']))
+
+        recorded = 0
+        now = datetime.utcnow().isoformat()
+        for site_id, files in by_site.items():
+            threats_found = sum(len(new_by_content[sha256]) for _, sha256 in files)
+            scan = self.client.table('scans').insert({
+                'site_id': site_id,
+                'scan_type': 'differential',
+                'status': 'completed',
+                'started_at': now,
+                'completed_at': now,
+                'progress': 100,
+                'files_scanned': len(files),
+                'threats_found': threats_found,
+                'results': {'mode': 'differential', 'signature_version': version}
+            }).execute()
+            scan_id = scan.data[0]['id']
+
+            rows = [
+                {
+                    'scan_id': scan_id,
+                    'site_id': site_id,
+                    'file_path': file_path,
+                    'threat_type': 'malware',
+                    'severity': threat['severity'],
+                    'signature_matched': threat['signature'],
+                    'code_snippet': threat['code_snippet'],
+                    'line_number': threat.get('line_number'),
+                    'file_sha256': sha256,
+                    'status': 'active'
+                }
+                for file_path, sha256 in files
+                for threat in new_by_content[sha256]
+            ]
+            for i in range(0, len(rows), THREAT_BATCH):
+                self.client.table('threats').insert(rows[i:i + THREAT_BATCH]).execute()
+            recorded += len(rows)
+            invalidate_site_stats(site_id)
+        return recorded
+
+
+class RescanScheduler:
+    """
+    Bucle de reescaneo diferencial del proceso
+
+    Encadena pasadas mientras quede trabajo, con `batch_pause` segundos
+    entre una y otra; si no, espera `interval` segundos o a que alguien
+    llame a trigger() (p.ej. tras subir firmas).
+    De paso mantiene el almacén de contenido por debajo de `max_store_bytes`.
+    """
+
+    def __init__(
+        self,
+        rescanner: DifferentialRescanner,
+        interval: float = 300.0,
+        max_store_bytes: Optional[int] = None,
+        batch_pause: float = BATCH_PAUSE
+    ):
+        self.rescanner = rescanner
+        self.interval = interval
+        self.batch_pause = batch_pause
+        self.max_store_bytes = max_store_bytes
+        self.last_run: Optional[Dict] = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._last_prune = 0.0
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop(), name='differential-rescan')
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def trigger(self):
+        """Lanzar una pasada ya, sin esperar al intervalo"""
+        self._wakeup.set()
+
+    async def _loop(self):
+        while True:
+            more = False
+            try:
+                self.last_run = await asyncio.to_thread(self.rescanner.run_once)
+                more = self.last_run['more']
+                await self._maybe_prune()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error en el reescaneo diferencial: {e}")
+
+            if more:
+                await asyncio.sleep(self.batch_pause)
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _maybe_prune(self):
+        if self.max_store_bytes is None or time.monotonic() - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = time.monotonic()
+        removed = await asyncio.to_thread(self.rescanner.store.prune, self.max_store_bytes)
+        if removed:
+            logger.info(f"🧹 Almacén de contenido: {removed} blobs antiguos borrados")
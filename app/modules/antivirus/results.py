@@ -0,0 +1,142 @@
+"""
+Acumulación compacta de resultados de escaneo
+"""
+import os
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# Cubetas del histograma de tamaños (límite superior en bytes)
+SIZE_BUCKETS = [
+    ('<4KB', 4 * 1024),
+    ('<64KB', 64 * 1024),
+    ('<1MB', 1024 * 1024),
+    ('<10MB', 10 * 1024 * 1024),
+]
+
+
+class ScanAggregator:
+    """
+    Acumulador de resultados con memoria acotada
+
+    - Archivos limpios: solo contadores e histogramas, nunca rutas
+    - Archivos con amenazas: se envían a `threat_sink` en cuanto aparecen
+      (p.ej. para insertarlos en la tabla threats)
+    - Detalle por archivo marcado: solo los primeros `max_details`; del
+      resto se cuenta el total (las amenazas completas están en threats)
+    """
+
+    def __init__(
+        self,
+        threat_sink: Optional[Callable[[Dict], Awaitable[None]]] = None,
+        max_details: int = 200,
+        max_errors: int = 50
+    ):
+        self.threat_sink = threat_sink
+        self.max_details = max_details
+        self.max_errors = max_errors
+
+        self.total_files = 0
+        self.scanned_files = 0
+        self.clean_files = 0
+        self.known_good_files = 0
+        self.suspicious_count = 0
+        self.threats_found = 0
+        self.errors_count = 0
+        self.bytes_scanned = 0
+
+        self.threats_by_severity: Dict[str, int] = {}
+        self.threats_by_signature: Dict[str, int] = {}
+        self.files_by_extension: Dict[str, int] = {}
+        self.size_histogram: Dict[str, int] = {}
+
+        self.details: List[Dict] = []
+        self.details_total = 0
+        self.errors: List[Dict] = []
+
+        self.start_time = datetime.utcnow().isoformat()
+
+    async def add(self, scan_result: Dict):
+        """Incorporar el resultado de un archivo"""
+        self.scanned_files += 1
+
+        if scan_result.get('error'):
+            self.add_error(scan_result)
+            return
+
+        size = scan_result.get('file_size', 0)
+        self.bytes_scanned += size
+        self._bump(self.size_histogram, self._size_bucket(size))
+        extension = os.path.splitext(scan_result['file_path'])[1].lower() or '(none)'
+        self._bump(self.files_by_extension, extension)
+
+        if scan_result['is_malicious']:
+            self.threats_found += 1
+            for threat in scan_result['threats']:
+                self._bump(self.threats_by_severity, threat['severity'])
+                self._bump(self.threats_by_signature, threat['signature'])
+            if self.threat_sink:
+                await self.threat_sink(scan_result)
+            self._add_detail(scan_result)
+        elif scan_result['suspicious_functions']:
+            self.suspicious_count += 1
+            self._add_detail(scan_result)
+        else:
+            self.clean_files += 1
+            if scan_result.get('known_good'):
+                self.known_good_files += 1
+
+    def add_error(self, error: Dict):
+        """Registrar un error (solo se guardan los primeros `max_errors`)"""
+        self.errors_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'file_path': error.get('file_path'), 'error': error.get('error')})
+
+    def _add_detail(self, scan_result: Dict):
+        self.details_total += 1
+        if len(self.details) >= self.max_details:
+            return
+        # Detalle compacto: sin fragmentos de código (esos van a la tabla threats)
+        self.details.append({
+            'file_path': scan_result['file_path'],
+            'file_hash': scan_result.get('file_hash'),
+            'is_malicious': scan_result['is_malicious'],
+            'threats': [
+                {'signature': t['signature'], 'severity': t['severity']}
+                for t in scan_result['threats']
+            ],
+            'suspicious_functions': scan_result['suspicious_functions']
+        })
+
+    def summary(self) -> Dict:
+        """Resumen compacto para guardar en scans.results"""
+        return {
+            'total_files': self.total_files,
+            'scanned_files': self.scanned_files,
+            'threats_found': self.threats_found,
+            'clean_files': self.clean_files,
+            'known_good_files': self.known_good_files,
+            'suspicious_count': self.suspicious_count,
+            'bytes_scanned': self.bytes_scanned,
+            'threats_by_severity': self.threats_by_severity,
+            'threats_by_signature': self.threats_by_signature,
+            'files_by_extension': self.files_by_extension,
+            'size_histogram': self.size_histogram,
+            'suspicious_files': self.details,
+            'details_total': self.details_total,
+            'details_truncated': self.details_total > len(self.details),
+            'errors': self.errors,
+            'errors_count': self.errors_count,
+            'start_time': self.start_time,
+            'end_time': datetime.utcnow().isoformat()
+        }
+
+    @staticmethod
+    def _bump(histogram: Dict[str, int], key: str):
+        histogram[key] = histogram.get(key, 0) + 1
+
+    @staticmethod
+    def _size_bucket(size: int) -> str:
+        for label, limit in SIZE_BUCKETS:
+            if size < limit:
+                return label
+        return '>=10MB'
@@ -0,0 +1,742 @@
+"""
+Reglas estilo YARA (subconjunto) para la base de firmas
+
+Formato soportado:
+
+    rule webshell_uploader : backdoor
+    {
+        meta:
+            name = "Webshell uploader"
+            severity = "critical"
+            description = "Subida de archivos y ejecución en el mismo script"
+        strings:
+            $upload = "move_uploaded_file" nocase
+            $exec = /(system|passthru|shell_exec)\\s*\\(/i
+            $php = { 3C 3F 70 68 70 }
+        condition:
+            $php and 2 of ($upload, $exec) and filesize < 200KB
+    }
+
+- Strings: texto ("..." con nocase, fullword, wide, ascii), hex
+  ({ 4D ?? [2-4] (5A | 5B) }) y regex (/.../ con flags i y s)
+- Condición: $id, `N of them`, `any/all of (...)` (con comodines $a*),
+  `filesize` con <, <=, >, >=, ==, != y sufijos KB/MB, and/or/not y paréntesis
+"""
+import re
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+try:
+    import re._parser as sre_parse
+    from re._constants import (
+        ANY, BRANCH, CATEGORY, CATEGORY_DIGIT, CATEGORY_SPACE, CATEGORY_WORD, IN, LITERAL,
+        MAX_REPEAT, MAXREPEAT, MIN_REPEAT, NEGATE, NOT_LITERAL, RANGE, SUBPATTERN
+    )
+except ImportError:  # Python < 3.11
+    import sre_parse
+    from sre_constants import (
+        ANY, BRANCH, CATEGORY, CATEGORY_DIGIT, CATEGORY_SPACE, CATEGORY_WORD, IN, LITERAL,
+        MAX_REPEAT, MAXREPEAT, MIN_REPEAT, NEGATE, NOT_LITERAL, RANGE, SUBPATTERN
+    )
+
+MIN_LITERAL = 3  # Literales más cortos no filtran nada
+
+_RULE_HEADER = re.compile(r'(?:^|\n)\s*(?:private\s+|global\s+)*rule\s+(\w+)\s*(?::\s*([\w\s]+?))?\s*\{')
+_SECTION = re.compile(r'^\s*(meta|strings|condition)\s*:', re.MULTILINE)
+_META = re.compile(r'^\s*(\w+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|(\S+))\s*$')
+_STRING_DEF = re.compile(r'^\s*(\$\w*)\s*=\s*(.+?)\s*$')
+_HEX_TOKEN = re.compile(r'\s*(?:([0-9A-Fa-f?]{2})|\[\s*(\d*)\s*(?:(-)\s*(\d*)\s*)?\]|([(|)]))')
+_CONDITION_TOKEN = re.compile(
+    r'\s*(?:(\$\w*\*?)|(\d+)(KB|MB)?\b|(<=|>=|==|!=|<|>)|([(),])|(\w+))'
+)
+_WORD_BOUNDARY = rb'[A-Za-z0-9_]'
+
+
+class RuleSyntaxError(ValueError):
+    """Regla mal formada (se descarta esa regla, no el archivo entero)"""
+
+
+def parse_rules(text: str) -> Tuple[List[Dict], List[str]]:
+    """
+    Separar un archivo .yar en reglas
+
+    Returns:
+        (reglas válidas como dicts de firma, errores de las descartadas)
+    """
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
+    text = re.sub(r'(?m)^\s*//.*$', '', text)
+
+    rules, errors = [], []
+    headers = list(_RULE_HEADER.finditer(text))
+    for i, header in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(text)
+        body = text[header.end():end]
+        close = body.rfind('}')
+        try:
+            if close == -1:
+                raise RuleSyntaxError("falta '}'")
+            rules.append(_parse_rule(header.group(1), (header.group(2) or '').split(), body[:close]))
+        except RuleSyntaxError as e:
+            errors.append(f"{header.group(1)}: {e}")
+    return rules, errors
+
+
+def _parse_rule(rule_id: str, tags: List[str], body: str) -> Dict:
+    sections = {}
+    markers = list(_SECTION.finditer(body))
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(body)
+        sections[marker.group(1)] = body[marker.end():end]
+
+    if 'condition' not in sections:
+        raise RuleSyntaxError("falta la sección condition")
+
+    meta = {}
+    for line in sections.get('meta', '').splitlines():
+        if line.strip():
+            match = _META.match(line)
+            if not match:
+                raise RuleSyntaxError(f"meta inválido: {line.strip()}")
+            meta[match.group(1)] = match.group(2) if match.group(2) is not None else match.group(3)
+
+    strings = []
+    for line in sections.get('strings', '').splitlines():
+        if line.strip():
+            match = _STRING_DEF.match(line)
+            if not match:
+                raise RuleSyntaxError(f"string inválido: {line.strip()}")
+            strings.append(_parse_string(match.group(1), match.group(2)))
+
+    condition = ' '.join(sections['condition'].split())
+    rule = {
+        'id': rule_id,
+        'name': meta.get('name', rule_id),
+        'description': meta.get('description', ''),
+        'severity': meta.get('severity', 'medium'),
+        'category': meta.get('category', tags[0] if tags else 'rule'),
+        'type': 'rule',
+        'pattern': condition,
+        'strings': strings,
+        'condition': condition
+    }
+    # Validar ya: mejor descartar la regla al cargar que fallar en mitad de un escaneo
+    compile_condition(condition, [s['id'] for s in strings])
+    for string in strings:
+        compile_string(string)
+    return rule
+
+
+def _parse_string(string_id: str, definition: str) -> Dict:
+    if definition.startswith('"'):
+        match = re.match(r'"((?:[^"\\]|\\.)*)"(.*)$', definition)
+        kind = 'text'
+    elif definition.startswith('{'):
+        match = re.match(r'\{([^}]*)\}(.*)$', definition)
+        kind = 'hex'
+    elif definition.startswith('/'):
+        match = re.match(r'/((?:[^/\\]|\\.)*)/([is]*)(.*)$', definition)
+        kind = 'regex'
+    else:
+        match = None
+    if not match:
+        raise RuleSyntaxError(f"string inválido: {string_id}")
+
+    string = {'id': string_id, 'type': kind, 'value': match.group(1)}
+    if kind == 'regex':
+        string['flags'] = match.group(2)
+    modifiers = match.group(match.lastindex).split()
+    unknown = set(modifiers) - {'nocase', 'fullword', 'wide', 'ascii'}
+    if unknown:
+        raise RuleSyntaxError(f"modificadores no soportados en {string_id}: {', '.join(sorted(unknown))}")
+    string['modifiers'] = modifiers
+    return string
+
+
+def _unescape_text(value: str) -> bytes:
+    out = bytearray()
+    i = 0
+    while i < len(value):
+        char = value[i]
+        if char == '\\' and i + 1 < len(value):
+            nxt = value[i + 1]
+            if nxt == 'x' and re.match(r'[0-9A-Fa-f]{2}', value[i + 2:i + 4]):
+                out.append(int(value[i + 2:i + 4], 16))
+                i += 4
+                continue
+            out += {'n': b'\n', 't': b'\t', 'r': b'\r'}.get(nxt, nxt.encode())
+            i += 2
+            continue
+        out += char.encode()
+        i += 1
+    return bytes(out)
+
+
+def _hex_to_regex(value: str) -> Tuple[bytes, Optional[Tuple[bytes, ...]]]:
+    """Hex de YARA -> regex de bytes, y el tramo fijo más largo (fuera de alternativas)"""
+    parts = []
+    runs, current = [], b''
+    depth = 0
+    pos = 0
+    value = value.strip()
+    while pos < len(value):
+        match = _HEX_TOKEN.match(value, pos)
+        if not match or match.end() == pos:
+            raise RuleSyntaxError(f"hex inválido: {value}")
+        pos = match.end()
+        byte, low, dash, high, symbol = match.groups()
+        if byte is not None:
+            if byte == '??':
+                parts.append(b'.')
+                runs.append(current)
+                current = b''
+            elif '?' in byte:
+                raise RuleSyntaxError("comodines de medio byte no soportados")
+            else:
+                parts.append(re.escape(bytes([int(byte, 16)])))
+                if depth == 0:
+                    current += bytes([int(byte, 16)])
+        elif symbol is not None:
+            if symbol == '|' and depth == 0:
+                raise RuleSyntaxError(f"alternativa fuera de paréntesis: {value}")
+            parts.append(symbol.encode())
+            depth += {'(': 1, ')': -1, '|': 0}[symbol]
+            runs.append(current)
+            current = b''
+        else:
+            if dash is None:
+                if not low:
+                    raise RuleSyntaxError(f"salto vacío: {value}")
+                parts.append(b'.{%d}' % int(low))
+            else:
+                parts.append(b'.{%s,%s}' % (low.encode() or b'0', high.encode()))
+            runs.append(current)
+            current = b''
+        if depth < 0:
+            raise RuleSyntaxError(f"paréntesis desequilibrados: {value}")
+    runs.append(current)
+    if depth != 0:
+        raise RuleSyntaxError(f"paréntesis desequilibrados: {value}")
+    literal = max(runs, key=len)
+    return b''.join(parts), (literal.lower(),) if len(literal) >= MIN_LITERAL else None
+
+
+def required_literals(pattern: str, flags: int = 0) -> Optional[Tuple[bytes, ...]]:
+    """
+    Literales (en minúsculas) de los que toda coincidencia contiene al menos uno
+
+    Candidatos del nivel superior de la regex: cada secuencia de literales
+    consecutivos, y cada grupo de alternativas cuyas ramas empiezan todas
+    por un literal ((system|exec|passthru) -> system, exec o passthru).
+    Se elige el candidato cuyo literal más corto es más largo; si ninguno
+    llega a MIN_LITERAL bytes, None (la regex se evalúa siempre).
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return None
+
+    candidates = []
+    current = bytearray()
+    for op, arg in parsed:
+        if op is LITERAL and arg < 128:
+            current.append(arg)
+            continue
+        if current:
+            candidates.append((bytes(current),))
+            current = bytearray()
+        if op is SUBPATTERN:
+            alternatives = _branch_prefixes(list(arg[-1]))
+            if alternatives:
+                candidates.append(alternatives)
+    if current:
+        candidates.append((bytes(current),))
+
+    candidates = [c for c in candidates if min(len(lit) for lit in c) >= MIN_LITERAL]
+    if not candidates:
+        return None
+    best = max(candidates, key=lambda c: (min(len(lit) for lit in c), -len(c)))
+    return tuple(dict.fromkeys(lit.lower() for lit in best))
+
+
+def _branch_prefixes(items: List) -> Optional[Tuple[bytes, ...]]:
+    """Prefijo literal de cada rama de un grupo `(a|b|c)` (None si alguna no tiene)"""
+    if len(items) != 1 or items[0][0] is not BRANCH:
+        return None
+    prefixes = []
+    for branch in items[0][1][1]:
+        prefix = bytearray()
+        for op, arg in branch:
+            if op is not LITERAL or arg >= 128:
+                break
+            prefix.append(arg)
+        if not prefix:
+            return None
+        prefixes.append(bytes(prefix))
+    return tuple(prefixes)
+
+
+def regex_flags(string: Dict) -> int:
+    """Flags de re de una string regex: modificador nocase y flags /i y /s (compilar, lint y vetado)"""
+    flags = re.IGNORECASE if 'nocase' in string.get('modifiers', []) else 0
+    if 'i' in string.get('flags', ''):
+        flags |= re.IGNORECASE
+    if 's' in string.get('flags', ''):
+        flags |= re.DOTALL
+    return flags
+
+
+def compile_string(string: Dict) -> Tuple['re.Pattern', Optional[Tuple[bytes, ...]]]:
+    """String de una regla -> (regex de bytes, literales alternativos para el prefiltro)"""
+    modifiers = string.get('modifiers', [])
+    flags = re.IGNORECASE if 'nocase' in modifiers else 0
+
+    try:
+        if string['type'] == 'text':
+            raw = _unescape_text(string['value'])
+            variants = []
+            if 'ascii' in modifiers or 'wide' not in modifiers:
+                variants.append(raw)
+            if 'wide' in modifiers:
+                variants.append(b''.join(bytes([b, 0]) for b in raw))
+            pattern = b'|'.join(re.escape(v) for v in variants)
+            literal = None
+            if min(len(v) for v in variants) >= MIN_LITERAL:
+                literal = tuple(v.lower() for v in variants)
+        elif string['type'] == 'hex':
+            pattern, literal = _hex_to_regex(string['value'])
+            flags |= re.DOTALL
+        else:
+            flags = regex_flags(string)
+            # effective_value: versión reescrita al cargar (comodines acotados)
+            value = string.get('effective_value', string['value'])
+            literal = required_literals(value, flags)
+            pattern = value.encode()
+
+        if 'fullword' in modifiers:
+            pattern = b'(?<!' + _WORD_BOUNDARY + b')(?:' + pattern + b')(?!' + _WORD_BOUNDARY + b')'
+        return re.compile(pattern, flags), literal
+    except re.error as e:
+        raise RuleSyntaxError(f"{string['id']}: {e}")
+
+
+def compile_condition(condition: str, string_ids: List[str]) -> Tuple[Callable[[Set[str], Optional[int]], bool], bool]:
+    """
+    Compilar una condición a una función (strings encontrados, tamaño) -> bool
+
+    Returns:
+        (función, diferida). Una condición diferida (usa filesize o not) solo
+        se puede decidir al terminar el archivo; las demás son monótonas y se
+        pueden dar por cumplidas en cuanto se cumplen.
+    """
+    tokens = []
+    pos = 0
+    while pos < len(condition):
+        match = _CONDITION_TOKEN.match(condition, pos)
+        if not match or match.end() == pos:
+            if condition[pos:].strip():
+                raise RuleSyntaxError(f"condición inválida cerca de: {condition[pos:pos + 20]}")
+            break
+        pos = match.end()
+        ref, number, unit, op, symbol, word = match.groups()
+        if ref is not None:
+            tokens.append(('ref', ref))
+        elif number is not None:
+            tokens.append(('num', int(number) * {None: 1, 'KB': 1024, 'MB': 1024 * 1024}[unit]))
+        elif op is not None:
+            tokens.append(('op', op))
+        elif symbol is not None:
+            tokens.append((symbol, symbol))
+        else:
+            tokens.append(('word', word))
+
+    parser = _ConditionParser(tokens, string_ids)
+    func = parser.parse()
+    return func, parser.deferred
+
+
+_COMPARE = {
+    '<': lambda a, b: a < b, '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+    '==': lambda a, b: a == b, '!=': lambda a, b: a != b
+}
+
+
+class _ConditionParser:
+    """Descenso recursivo: or < and < not < primario"""
+
+    def __init__(self, tokens: List[Tuple[str, object]], string_ids: List[str]):
+        self.tokens = tokens
+        self.pos = 0
+        self.string_ids = string_ids
+        self.deferred = False
+
+    def parse(self):
+        func = self._or()
+        if self.pos != len(self.tokens):
+            raise RuleSyntaxError(f"sobra en la condición: {self.tokens[self.pos][1]}")
+        return func
+
+    def _peek(self, kind=None, value=None):
+        if self.pos >= len(self.tokens):
+            return None
+        token = self.tokens[self.pos]
+        if kind is not None and token[0] != kind:
+            return None
+        if value is not None and token[1] != value:
+            return None
+        return token
+
+    def _take(self, kind=None, value=None):
+        token = self._peek(kind, value)
+        if token is None:
+            found = self.tokens[self.pos][1] if self.pos < len(self.tokens) else 'fin'
+            raise RuleSyntaxError(f"se esperaba {value or kind}, hay {found}")
+        self.pos += 1
+        return token
+
+    def _or(self):
+        terms = [self._and()]
+        while self._peek('word', 'or'):
+            self.pos += 1
+            terms.append(self._and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda found, size: any(term(found, size) for term in terms)
+
+    def _and(self):
+        terms = [self._not()]
+        while self._peek('word', 'and'):
+            self.pos += 1
+            terms.append(self._not())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda found, size: all(term(found, size) for term in terms)
+
+    def _not(self):
+        if self._peek('word', 'not'):
+            self.pos += 1
+            self.deferred = True
+            term = self._not()
+            return lambda found, size: not term(found, size)
+        return self._primary()
+
+    def _primary(self):
+        token = self._take()
+        kind, value = token
+
+        if kind == '(':
+            func = self._or()
+            self._take(')')
+            return func
+
+        if kind == 'ref':
+            if value not in self.string_ids:
+                raise RuleSyntaxError(f"string no definido: {value}")
+            return lambda found, size: value in found
+
+        if kind == 'word' and value in ('true', 'false'):
+            result = value == 'true'
+            return lambda found, size: result
+
+        if kind == 'word' and value == 'filesize':
+            op = self._take('op')[1]
+            limit = self._take('num')[1]
+            compare = _COMPARE[op]
+            self.deferred = True
+            return lambda found, size: size is not None and compare(size, limit)
+
+        if kind == 'num' or (kind == 'word' and value in ('any', 'all', 'none')):
+            self._take('word', 'of')
+            ids = self._string_set()
+            if kind == 'num':
+                needed = value
+            else:
+                needed = {'any': 1, 'all': len(ids), 'none': 0}[value]
+            if value == 'none':
+                self.deferred = True
+                return lambda found, size: not any(i in found for i in ids)
+            return lambda found, size: sum(1 for i in ids if i in found) >= needed
+
+        raise RuleSyntaxError(f"condición inválida en: {value}")
+
+    def _string_set(self) -> List[str]:
+        if self._peek('word', 'them'):
+            self.pos += 1
+            return list(self.string_ids)
+
+        self._take('(')
+        ids = []
+        while True:
+            ref = self._take('ref')[1]
+            if ref.endswith('*'):
+                matched = [i for i in self.string_ids if i.startswith(ref[:-1])]
+            else:
+                matched = [ref] if ref in self.string_ids else []
+            if not matched:
+                raise RuleSyntaxError(f"string no definido: {ref}")
+            ids.extend(i for i in matched if i not in ids)
+            if self._peek(')'):
+                self.pos += 1
+                return ids
+            self._take(',')
+
+
+# ============================================
+# LINT DE BACKTRACKING
+# ============================================
+
+_ALL_BYTES = frozenset(range(256))
+_CATEGORY_BYTES = {
+    CATEGORY_DIGIT: frozenset(b'0123456789'),
+    CATEGORY_SPACE: frozenset(b' \t\n\r\x0b\x0c'),
+    CATEGORY_WORD: frozenset(b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_'),
+}
+UNBOUNDED_REPEAT = 100  # Repeticiones con máximo mayor cuentan como ilimitadas
+
+
+def lint_pattern(pattern: str, flags: int = 0) -> List[Dict]:
+    """
+    Señalar construcciones con riesgo de backtracking catastrófico
+
+    - high: cuantificadores ilimitados anidados ((a+)+) o alternativas que
+      se solapan bajo un cuantificador ilimitado ((a|ab)*): coste exponencial
+    - medium: comodín ilimitado (.* / .+) seguido de más patrón, o dos
+      repeticiones ilimitadas seguidas que aceptan los mismos bytes
+      (\\s*\\s*): coste cuadrático en líneas largas
+
+    Returns:
+        [{'severity', 'code', 'issue'}]; lista vacía si no se ve nada
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception as e:
+        return [{'severity': 'high', 'code': 'invalid', 'issue': f"regex inválida: {e}"}]
+
+    issues: List[Dict] = []
+    _lint_sequence(list(parsed), frozenset(), issues)
+
+    unique, seen = [], set()
+    for issue in issues:
+        if issue['issue'] not in seen:
+            seen.add(issue['issue'])
+            unique.append(issue)
+    return unique
+
+
+def _is_unbounded(op, av) -> bool:
+    return op in (MAX_REPEAT, MIN_REPEAT) and (av[1] == MAXREPEAT or av[1] > UNBOUNDED_REPEAT)
+
+
+def _lint_sequence(items: List, outer_first: frozenset, issues: List[Dict]):
+    """
+    Recorrer una secuencia; `outer_first` son los bytes con los que empieza
+    la repetición ilimitada que la contiene (vacío si no hay ninguna)
+    """
+    for i, (op, av) in enumerate(items):
+        if op in (MAX_REPEAT, MIN_REPEAT):
+            body = list(av[2])
+            unbounded = _is_unbounded(op, av)
+            text = _describe(op, av)
+            chars = _first_bytes(body)
+
+            # (a+)+: la repetición interna y la externa pueden repartirse los mismos bytes
+            if unbounded and chars & outer_first:
+                issues.append({'severity': 'high', 'code': 'nested_quantifiers', 'issue': f"cuantificadores ilimitados anidados en {text}"})
+            if unbounded and _has_overlapping_branches(body):
+                issues.append({'severity': 'high', 'code': 'overlapping_alternation', 'issue': f"alternativas solapadas bajo {text}"})
+
+            rest = items[i + 1:]
+            if unbounded and rest:
+                if _is_wildcard(body) or chars == _ALL_BYTES:
+                    issues.append({'severity': 'medium', 'code': 'greedy_wildcard', 'issue': f"comodín {text} seguido de más patrón"})
+                elif _is_unbounded(*rest[0]) and chars & _first_bytes(list(rest[0][1][2])):
+                    issues.append({'severity': 'medium', 'code': 'adjacent_repeats', 'issue': f"repeticiones ilimitadas contiguas que se solapan: {text}"})
+
+            _lint_sequence(body, (outer_first | chars) if unbounded else outer_first, issues)
+        elif op is SUBPATTERN:
+            _lint_sequence(list(av[-1]), outer_first, issues)
+        elif op is BRANCH:
+            for branch in av[1]:
+                _lint_sequence(list(branch), outer_first, issues)
+
+
+def _is_wildcard(body: List) -> bool:
+    """`.` (cualquier byte salvo salto de línea) o clase negada"""
+    return len(body) == 1 and (body[0][0] is ANY or (body[0][0] is IN and body[0][1] and body[0][1][0][0] is NEGATE))
+
+
+def _has_overlapping_branches(body: List) -> bool:
+    for op, av in body:
+        if op is SUBPATTERN:
+            if _has_overlapping_branches(list(av[-1])):
+                return True
+        elif op is BRANCH:
+            seen = set()
+            for branch in av[1]:
+                if not branch:
+                    return True  # Alternativa vacía: solapa con cualquier otra
+                chars = _first_bytes(list(branch))
+                if seen & chars:
+                    return True
+                seen |= chars
+    return False
+
+
+def _first_bytes(items: List) -> frozenset:
+    """Bytes con los que puede empezar una secuencia (aproximación conservadora)"""
+    result = set()
+    for op, av in items:
+        if op is LITERAL:
+            result.add(av & 0xFF)
+            return frozenset(result)
+        if op in (ANY, NOT_LITERAL):
+            return _ALL_BYTES
+        if op is IN:
+            result |= _class_bytes(av)
+            return frozenset(result)
+        if op is SUBPATTERN:
+            result |= _first_bytes(list(av[-1]))
+            return frozenset(result)
+        if op is BRANCH:
+            for branch in av[1]:
+                result |= _first_bytes(list(branch))
+            return frozenset(result)
+        if op in (MAX_REPEAT, MIN_REPEAT):
+            result |= _first_bytes(list(av[2]))
+            if av[0] > 0:
+                return frozenset(result)
+            continue  # Opcional: también puede empezar por lo siguiente
+        # Anclas y otros elementos de ancho cero: mirar el siguiente
+    return frozenset(result)
+
+
+def _class_bytes(items) -> frozenset:
+    result = set()
+    for op, av in items:
+        if op is NEGATE:
+            return _ALL_BYTES
+        if op is LITERAL:
+            result.add(av & 0xFF)
+        elif op is RANGE:
+            result |= set(range(av[0] & 0xFF, min(av[1], 255) + 1))
+        elif op is CATEGORY:
+            result |= _CATEGORY_BYTES.get(av, _ALL_BYTES)
+    return frozenset(result)
+
+
+def _describe(op, av) -> str:
+    low, high = av[0], av[1]
+    body = list(av[2])
+    if _is_wildcard(body):
+        inner = '.'
+    elif len(body) == 1 and body[0][0] is IN:
+        inner = '[...]'
+    else:
+        inner = '(...)'
+    if high == MAXREPEAT:
+        suffix = '*' if low == 0 else '+' if low == 1 else '{%d,}' % low
+    else:
+        suffix = '{%d,%d}' % (low, high)
+    return inner + suffix
+
+
+# ============================================
+# REESCRITURA Y SONDEO DE CRECIMIENTO
+# ============================================
+
+WILDCARD_LIMIT = 1000  # .* -> .{0,1000}: cada candidato explora como mucho esto
+
+_WILDCARD = re.compile(r'\.([*+])(\??)')
+
+
+def bound_wildcards(pattern: str) -> str:
+    """
+    Acotar los comodines ilimitados (.*, .+ y sus versiones perezosas)
+
+    Con `.*` cada aparición del prefijo recorre la línea entera antes de
+    retroceder: cuadrático en una línea larga con muchos candidatos. Con
+    `.{0,N}` el coste por candidato queda acotado. Se respetan escapes y
+    clases de caracteres.
+    """
+    out = []
+    i = 0
+    in_class = False
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            out.append(pattern[i:i + 2])
+            i += 2
+            continue
+        if in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+            # ']' justo al abrir (o tras '^') es literal
+            j = i + 1
+            if pattern[j:j + 1] == '^':
+                j += 1
+            if pattern[j:j + 1] == ']':
+                out.append(pattern[i:j + 1])
+                i = j + 1
+                continue
+        elif char == '.':
+            match = _WILDCARD.match(pattern, i)
+            if match:
+                low = 0 if match.group(1) == '*' else 1
+                out.append('.{%d,%d}%s' % (low, WILDCARD_LIMIT, match.group(2)))
+                i = match.end()
+                continue
+        out.append(char)
+        i += 1
+    return ''.join(out)
+
+
+def probe_inputs(pattern: str, flags: int, size: int) -> List[bytes]:
+    """
+    Entradas hostiles de `size` bytes para medir cómo crece el coste de una regex
+
+    Se construyen con los literales de la regex (muchos candidatos en una
+    sola línea) y con bytes que alimentan sus repeticiones sin dejar que la
+    coincidencia termine. Las tiras de relleno acaban también en un byte que
+    la repetición no consume: con un salto de línea final, `(a+)+$` casaría
+    enseguida (`$` acepta el \\n del final) y no se vería su backtracking.
+    """
+    literals = required_literals(pattern, flags) or (b'a',)
+    literal = literals[0]
+    try:
+        parsed = list(sre_parse.parse(pattern, flags))
+    except Exception:
+        return []
+
+    fillers = []
+    _collect_repeat_bytes(parsed, fillers)
+    fillers = [b for b in fillers if b not in (10, 13)] or [ord('a')]
+
+    inputs = []
+    for filler in dict.fromkeys(fillers[:3]):
+        fill = bytes([filler])
+        inputs.append((literal + fill * 16) * (size // (len(literal) + 16)))
+        inputs.append(literal + fill * size)
+        inputs.append(fill * size + b'\n')
+        inputs.append(fill * size + (b'!' if fill != b'!' else b'\x00'))
+    inputs.append((literal + b' ') * (size // (len(literal) + 1)))
+    return inputs
+
+
+def _collect_repeat_bytes(items: List, out: List[int]):
+    """Un byte representativo de cada repetición ilimitada (prefiriendo imprimibles)"""
+    for op, av in items:
+        if op in (MAX_REPEAT, MIN_REPEAT):
+            if _is_unbounded(op, av):
+                chars = _first_bytes(list(av[2]))
+                printable = sorted(c for c in chars if 33 <= c < 127)
+                if printable:
+                    out.append(printable[0])
+                elif chars:
+                    out.append(min(chars))
+            _collect_repeat_bytes(list(av[2]), out)
+        elif op is SUBPATTERN:
+            _collect_repeat_bytes(list(av[-1]), out)
+        elif op is BRANCH:
+            for branch in av[1]:
+                _collect_repeat_bytes(list(branch), out)
+
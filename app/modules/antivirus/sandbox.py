@@ -0,0 +1,358 @@
+"""
+Regex en procesos aislados: presupuesto de tiempo por patrón y por archivo
+
+`re.search` no se puede interrumpir; si un patrón (o un archivo preparado
+contra él) dispara el backtracking, la única salida es matar el proceso
+que lo ejecuta. La verificación de firmas se hace en procesos hijo que se
+matan y se reemplazan al pasar el presupuesto.
+"""
+import logging
+import multiprocessing
+import queue
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from .rules import bound_wildcards, lint_pattern, probe_inputs
+
+logger = logging.getLogger(__name__)
+
+PATTERN_TIMEOUT = 2.0       # Segundos como máximo por patrón y ventana
+FILE_TIMEOUT = 20.0         # Segundos de regex como máximo por archivo
+MAX_STRIKES = 3             # Timeouts de un patrón antes de desactivarlo en el proceso
+BOOT_TIMEOUT = 30.0         # Segundos como máximo para que un proceso nuevo esté listo
+
+PROBE_SIZES = (2048, 8192)  # Tamaños de entrada del sondeo de crecimiento (x4)
+PROBE_TIMEOUT = 0.5         # Un sondeo más lento que esto: patrón rechazado
+PROBE_MAX_GROWTH = 8.0      # x4 de entrada -> más de x8 de tiempo: superlineal
+PROBE_MIN_SECONDS = 0.005   # Por debajo de esto el ruido de medida manda
+PROBE_STRIKES = 1_000_000   # El sondeo no desactiva patrones: decide vet_pattern
+PROBE_REPEATS = 3           # Medidas por entrada (se usa la mediana)
+PROBE_RETRIES = 3           # Intentos si el proceso de sondeo falla (no arranca o muere)
+
+Pattern = Tuple[bytes, int]  # (patrón, flags)
+
+
+def _worker_main(conn):
+    """
+    Bucle del proceso hijo: recibe (patrones, datos) y responde un mensaje
+    por patrón en cuanto termina, así el padre sabe cuál se está ejecutando
+
+    El primer mensaje (None) avisa de que el proceso ya arrancó: el
+    arranque no cuenta en el tiempo de ningún patrón.
+    """
+    conn.send(None)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+
+        patterns, data = request
+        for i, (pattern, flags) in enumerate(patterns):
+            started = time.perf_counter_ns()
+            match = re.compile(pattern, flags).search(data)
+            span = (match.start(), match.end()) if match else None
+            conn.send((i, span, time.perf_counter_ns() - started))
+        conn.send(None)
+
+
+class _Worker:
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True, name='regex-sandbox')
+        self.process.start()
+        child_conn.close()
+        try:
+            if not self.conn.poll(BOOT_TIMEOUT):
+                raise OSError('el proceso no arrancó a tiempo')
+            self.conn.recv()
+        except (EOFError, OSError):
+            self.kill()
+            raise
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=1)
+        self.conn.close()
+
+
+class RegexSandbox:
+    """
+    Pool de procesos para ejecutar regex con límite de tiempo
+
+    - Cada hilo de escaneo toma un proceso libre (como mucho `workers`)
+    - Si un patrón pasa de `pattern_timeout` (o se agota el plazo del
+      archivo) se mata el proceso, se anota un strike al patrón y se sigue
+      con los patrones restantes en un proceso nuevo
+    - Con `max_strikes` strikes el patrón se desactiva en este proceso
+    - Si un proceso no arranca o muere, lo que quedaba por evaluar se
+      devuelve como 'error' (fallo del sandbox, no del patrón)
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        pattern_timeout: float = PATTERN_TIMEOUT,
+        max_strikes: int = MAX_STRIKES
+    ):
+        self.workers = workers
+        self.pattern_timeout = pattern_timeout
+        self.max_strikes = max_strikes
+        # spawn: el proceso padre tiene hilos (uvicorn, executor); fork no es seguro
+        self._context = multiprocessing.get_context('spawn')
+        self._idle: 'queue.LifoQueue[_Worker]' = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        self.strikes: Dict[Pattern, int] = {}
+        self.disabled = set()
+        self.kills = 0
+
+    def _acquire(self) -> _Worker:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.workers:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return _Worker(self._context)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    def _release(self, worker: _Worker):
+        if self._closed:
+            worker.kill()
+        else:
+            self._idle.put(worker)
+
+    def _discard(self, worker: _Worker):
+        worker.kill()
+        with self._lock:
+            self._created -= 1
+            self.kills += 1
+
+    def _strike(self, pattern: Pattern):
+        with self._lock:
+            strikes = self.strikes.get(pattern, 0) + 1
+            self.strikes[pattern] = strikes
+            if strikes >= self.max_strikes and pattern not in self.disabled:
+                self.disabled.add(pattern)
+                logger.error(f"❌ Patrón desactivado tras {strikes} timeouts: {pattern[0][:80]!r}")
+
+    def search_many(
+        self,
+        patterns: List[Pattern],
+        data: bytes,
+        deadline: Optional[float] = None,
+        timeout: Optional[float] = None
+    ) -> Tuple[List[Optional[Tuple[int, int]]], List[int], List[str]]:
+        """
+        Buscar cada patrón en `data`
+
+        Args:
+            deadline: instante (time.monotonic) a partir del cual no se sigue (plazo del archivo)
+            timeout: límite por patrón (por defecto pattern_timeout)
+
+        Returns:
+            (spans, ns por patrón, estado por patrón: ok | timeout | skipped | disabled | error)
+        """
+        timeout = timeout or self.pattern_timeout
+        spans: List[Optional[Tuple[int, int]]] = [None] * len(patterns)
+        times = [0] * len(patterns)
+        status = ['ok'] * len(patterns)
+
+        pending = []
+        for i, pattern in enumerate(patterns):
+            if pattern in self.disabled:
+                status[i] = 'disabled'
+            else:
+                pending.append(i)
+
+        while pending:
+            if deadline is not None and time.monotonic() >= deadline:
+                for i in pending:
+                    status[i] = 'skipped'
+                break
+
+            try:
+                worker = self._acquire()
+            except Exception as e:
+                logger.error(f"❌ No se pudo arrancar un proceso de regex: {e}")
+                for i in pending:
+                    status[i] = 'error'
+                break
+
+            try:
+                worker.conn.send(([patterns[i] for i in pending], data))
+                done = 0
+                started = time.monotonic()
+                while True:
+                    limit = started + timeout
+                    if deadline is not None:
+                        limit = min(limit, deadline)
+                    if not worker.conn.poll(max(0.0, limit - time.monotonic())):
+                        # El patrón en curso no terminó a tiempo: matar el proceso
+                        current = pending[done]
+                        status[current] = 'timeout'
+                        times[current] = int((time.monotonic() - started) * 1e9)
+                        self._strike(patterns[current])
+                        self._discard(worker)
+                        worker = None
+                        pending = pending[done + 1:]
+                        break
+                    message = worker.conn.recv()
+                    if message is None:
+                        pending = []
+                        break
+                    position, span, elapsed = message
+                    spans[pending[position]] = span
+                    times[pending[position]] = elapsed
+                    done = position + 1
+                    started = time.monotonic()
+            except (EOFError, OSError):
+                # El proceso murió (p.ej. sin memoria): lo que quedaba no se evaluó
+                if worker is not None:
+                    self._discard(worker)
+                    worker = None
+                for i in pending:
+                    if status[i] == 'ok' and spans[i] is None and times[i] == 0:
+                        status[i] = 'error'
+                pending = []
+            finally:
+                if worker is not None:
+                    self._release(worker)
+
+        return spans, times, status
+
+    def close(self):
+        """Matar los procesos libres (los ocupados se matan al devolverse)"""
+        self._closed = True
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.kill()
+
+
+_shared: List[RegexSandbox] = []
+
+
+@lru_cache()
+def get_regex_sandbox(workers: int = 2, pattern_timeout: float = PATTERN_TIMEOUT) -> RegexSandbox:
+    """Pool compartido por todo el proceso (un proceso hijo por hilo de escaneo)"""
+    sandbox = RegexSandbox(workers, pattern_timeout)
+    _shared.append(sandbox)
+    return sandbox
+
+
+def close_regex_sandboxes():
+    """Cerrar los pools compartidos (apagado de la aplicación)"""
+    for sandbox in _shared:
+        sandbox.close()
+
+
+def vet_pattern(pattern: str, flags: int, sandbox: Optional[RegexSandbox] = None) -> Tuple[Optional[str], List[Dict]]:
+    """
+    Revisar un patrón al cargar las firmas
+
+    - Comodines ilimitados seguidos de más patrón: se acotan (bound_wildcards)
+    - Si el lint ve riesgo, se mide el coste con entradas hostiles de
+      PROBE_SIZES bytes en un proceso aislado; si crece de forma
+      superlineal o no termina en PROBE_TIMEOUT, el patrón se rechaza
+
+    Returns:
+        (patrón efectivo o None si se rechaza, hallazgos del lint)
+    """
+    issues = lint_pattern(pattern, flags)
+    if not issues:
+        return pattern, issues
+    if any(issue['code'] == 'invalid' for issue in issues):
+        return None, issues
+
+    effective = pattern
+    if any(issue['code'] == 'greedy_wildcard' for issue in issues):
+        effective = bound_wildcards(pattern)
+
+    remaining = lint_pattern(effective, flags)
+    if not remaining:
+        return effective, issues
+
+    own_sandbox = sandbox is None
+    sandbox = sandbox or RegexSandbox(workers=1, max_strikes=PROBE_STRIKES)
+    try:
+        if _grows_badly(effective.encode(), flags, sandbox):
+            return None, issues
+    finally:
+        if own_sandbox:
+            sandbox.close()
+    return effective, issues
+
+
+def _probe_seconds(pattern: bytes, flags: int, data: bytes, sandbox: RegexSandbox) -> Optional[float]:
+    """
+    Mediana de PROBE_REPEATS búsquedas de `pattern` en `data`, en segundos
+
+    Un timeout cuenta como PROBE_TIMEOUT: la mediana solo llega ahí si
+    la mayoría de las medidas lo agotan, no por un pico de carga. Si el
+    proceso de sondeo falla se repite la medida; None si no hubo forma.
+    """
+    samples = []
+    failures = 0
+    while len(samples) < PROBE_REPEATS:
+        _, times, status = sandbox.search_many([(pattern, flags)], data, timeout=PROBE_TIMEOUT)
+        if status[0] not in ('ok', 'timeout'):
+            failures += 1
+            if failures >= PROBE_RETRIES:
+                return None
+            continue
+        samples.append(PROBE_TIMEOUT if status[0] == 'timeout' else times[0] / 1e9)
+        if sum(sample >= PROBE_TIMEOUT for sample in samples) > PROBE_REPEATS // 2:
+            return PROBE_TIMEOUT  # Mayoría de timeouts: no hace falta seguir midiendo
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def _grows_badly(pattern: bytes, flags: int, sandbox: RegexSandbox) -> bool:
+    """
+    True si el coste del patrón crece de forma superlineal con la entrada
+
+    Sin medida posible (el sandbox no funciona) el patrón no se rechaza:
+    en el escaneo sigue limitado por PATTERN_TIMEOUT y los strikes.
+    """
+    small, large = PROBE_SIZES
+    small_inputs = probe_inputs(pattern.decode(), flags, small)
+    large_inputs = probe_inputs(pattern.decode(), flags, large)
+    unmeasured = False
+
+    for small_input, large_input in zip(small_inputs, large_inputs):
+        small_seconds = _probe_seconds(pattern, flags, small_input, sandbox)
+        if small_seconds is not None and small_seconds >= PROBE_TIMEOUT:
+            return True
+        large_seconds = _probe_seconds(pattern, flags, large_input, sandbox)
+        if small_seconds is None or large_seconds is None:
+            unmeasured = True
+            continue
+        if large_seconds >= PROBE_TIMEOUT:
+            return True
+        if large_seconds > PROBE_MIN_SECONDS and large_seconds > PROBE_MAX_GROWTH * max(small_seconds, 1e-9):
+            return True
+
+    if unmeasured:
+        logger.warning(f"⚠️  Sondeo sin medida (fallo del sandbox), patrón aceptado: {pattern[:80]!r}")
+    return False
@@ -3,148 +3,610 @@ Módulo de escaneo de archivos para detección de malware
 """
 import os
 import hashlib
+import mmap
 import re
-from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional, Iterator, Iterable
 from datetime import datetime
 import asyncio
+from concurrent.futures import Executor
+
+import numpy as np
+
+from app.metrics import timed
+
+from .allowlist import HashAllowlist
+from .heuristics import (
+    analyze_structure, normalize_strings, hidden_calls,
+    DEEP_ANALYSIS_SCORE, OBFUSCATION_SCORE
+)
+from .sandbox import RegexSandbox
+from .signatures import CompiledSignatures, MatchState, get_signature_manager
+from .unpacker import LayerUnpacker, might_be_packed
+from .verdicts import VerdictCache
+from .walker import DirectoryWalker, DEFAULT_EXCLUDED_DIRS
+from .results import ScanAggregator
+
+# Lectura en streaming: memoria constante por archivo
+CHUNK_SIZE = 1024 * 1024            # Tamaño de bloque (1 MiB)
+CHUNK_OVERLAP = 4096                # Solapamiento para coincidencias entre bloques
+MMAP_THRESHOLD = 4 * 1024 * 1024    # A partir de aquí se usa mmap
+
+# Snippets: contexto acotado alrededor de la coincidencia, nunca más que esto
+SNIPPET_CONTEXT = 200               # Bytes de contexto a cada lado
+SNIPPET_MAX = 500                   # Tamaño máximo del snippet
+
+# Funciones PHP potencialmente peligrosas (se cuentan, no son amenaza por sí solas)
+SUSPICIOUS_FUNCTIONS = [
+    'eval', 'base64_decode', 'gzinflate', 'str_rot13',
+    'assert', 'create_function', 'preg_replace', 'exec',
+    'shell_exec', 'system', 'passthru', 'proc_open',
+    'popen', 'curl_exec', 'curl_multi_exec', 'parse_str',
+    'extract', 'putenv', 'ini_set', 'mail', 'header',
+    'file_get_contents', 'file_put_contents', 'fopen',
+    'readfile', 'require', 'include', 'require_once',
+    'include_once'
+]
+_FUNCTION_PATTERNS = [
+    (func, re.compile(rb'\b' + func.encode() + rb'\s*\(', re.IGNORECASE))
+    for func in SUSPICIOUS_FUNCTIONS
+]
+
+
+class LineIndex:
+    """
+    Inicios de línea de una ventana, para snippets y números de línea
+    
+    Se construye solo cuando la ventana tiene alguna coincidencia (un
+    flatnonzero sobre la ventana); después cada consulta es una búsqueda
+    binaria por desplazamiento y solo se copia el trozo del snippet.
+    """
+    
+    def __init__(self, buffer, pos: int, endpos: int, chunk_start: Optional[int] = None, newlines_before: int = 0):
+        arr = np.frombuffer(buffer, dtype=np.uint8, count=endpos - pos, offset=pos)
+        self.newlines = np.flatnonzero(arr == 10) + pos
+        del arr  # No retener el buffer (un mmap no se puede cerrar con vistas vivas)
+        
+        self.pos = pos
+        self.endpos = endpos
+        # Línea (1-based) del byte `pos`: los saltos del solapamiento ya se contaron
+        # en la ventana anterior
+        chunk_start = pos if chunk_start is None else chunk_start
+        in_overlap = int(np.searchsorted(self.newlines, chunk_start))
+        self.first_line = 1 + newlines_before - in_overlap
+    
+    def chunk_newlines(self, chunk_start: int) -> int:
+        """Saltos de línea del bloque nuevo (desde `chunk_start` hasta el final)"""
+        return len(self.newlines) - int(np.searchsorted(self.newlines, chunk_start))
+    
+    def line_number(self, offset: int) -> int:
+        return self.first_line + int(np.searchsorted(self.newlines, offset))
+    
+    def snippet(self, buffer, start: int, end: int) -> Tuple[str, int]:
+        """
+        Snippet de la coincidencia [start, end) y su número de línea
+        
+        Las líneas de la coincidencia, recortadas a SNIPPET_CONTEXT bytes de
+        contexto por cada lado (en PHP minificado una línea es el archivo entero).
+        """
+        i = int(np.searchsorted(self.newlines, start))
+        line_start = int(self.newlines[i - 1]) + 1 if i > 0 else self.pos
+        j = int(np.searchsorted(self.newlines, end))
+        line_end = int(self.newlines[j]) if j < len(self.newlines) else self.endpos
+        
+        snippet_start = max(line_start, start - SNIPPET_CONTEXT)
+        snippet_end = min(line_end, end + SNIPPET_CONTEXT, snippet_start + SNIPPET_MAX)
+        text = buffer[snippet_start:snippet_end].decode('utf-8', errors='ignore')
+        return text, self.first_line + i
+
+
+def _count_newlines(chunk) -> int:
+    if isinstance(chunk, bytes):
+        return chunk.count(b'\n')
+    return int(np.count_nonzero(np.frombuffer(chunk, dtype=np.uint8) == 10))
+
 
 class FileScanner:
     
-    def __init__(self, signatures_path: str = "signatures/malware_patterns.json"):
-        self.signatures = self._load_signatures(signatures_path)
-        self.suspicious_functions = [
-            'eval', 'base64_decode', 'gzinflate', 'str_rot13',
-            'assert', 'create_function', 'preg_replace', 'exec',
-            'shell_exec', 'system', 'passthru', 'proc_open',
-            'popen', 'curl_exec', 'curl_multi_exec', 'parse_str',
-            'extract', 'putenv', 'ini_set', 'mail', 'header',
-            'file_get_contents', 'file_put_contents', 'fopen',
-            'readfile', 'require', 'include', 'require_once',
-            'include_once'
-        ]
+    def __init__(
+        self,
+        signatures: Optional[CompiledSignatures] = None,
+        allowlist: Optional[HashAllowlist] = None,
+        verdict_cache: Optional[VerdictCache] = None,
+        executor: Optional[Executor] = None,
+        sandbox: Optional[RegexSandbox] = None,
+        regex_time_budget: Optional[float] = None
+    ):
+        # Conjunto compilado compartido: crear un scanner no relee ni recompila nada
+        compiled = signatures if signatures is not None else get_signature_manager().get_compiled()
+        self.signatures = compiled.signatures
+        self.signature_version = compiled.version
+        self.allowlist = allowlist
+        self.verdict_cache = verdict_cache
+        self.executor = executor  # Hilos para el trabajo de CPU (None: pool por defecto del loop)
+        self.sandbox = sandbox  # Procesos para las regex de firmas con límite de tiempo (None: en el hilo)
+        self.regex_time_budget = regex_time_budget  # Segundos de regex de firmas por archivo
+        self.suspicious_functions = SUSPICIOUS_FUNCTIONS
+        
+        self._compiled_signatures = compiled
+        self._function_patterns = _FUNCTION_PATTERNS
     
-    def _load_signatures(self, path: str) -> List[Dict]:
-        """Cargar firmas de malware desde archivo JSON"""
-        import json
-        try:
-            with open(path, 'r') as f:
-                return json.load(f)
-        except FileNotFoundError:
-            # Firmas por defecto si no existe el archivo
-            return [
-                {
-                    "name": "eval_base64",
-                    "pattern": r"eval\s*\(\s*base64_decode",
-                    "severity": "critical"
-                },
-                {
-                    "name": "eval_gzinflate",
-                    "pattern": r"eval\s*\(\s*gzinflate",
-                    "severity": "critical"
-                },
-                {
-                    "name": "preg_replace_eval",
-                    "pattern": r"preg_replace\s*\(.*\/e",
-                    "severity": "high"
-                },
-                {
-                    "name": "assert_post",
-                    "pattern": r"assert\s*\(\s*\$_(POST|GET|REQUEST|COOKIE)",
-                    "severity": "critical"
-                },
-                {
-                    "name": "backdoor_shell",
-                    "pattern": r"<\?php\s*@?eval\s*\(\s*\$_(POST|GET|REQUEST)",
-                    "severity": "critical"
-                },
-                {
-                    "name": "obfuscated_globals",
-                    "pattern": r"\$GLOBALS\s*\[\s*['\"]___['\"]",
-                    "severity": "high"
-                },
-                {
-                    "name": "create_function_exploit",
-                    "pattern": r"create_function\s*\(.*\$_(POST|GET|REQUEST)",
-                    "severity": "high"
-                },
-                {
-                    "name": "system_exec",
-                    "pattern": r"(system|exec|shell_exec|passthru)\s*\(\s*\$_(POST|GET|REQUEST)",
-                    "severity": "critical"
-                }
-            ]
-    
-    async def scan_file(self, file_path: str) -> Dict:
+    async def scan_file(
+        self,
+        file_path: str,
+        file_stat: Optional[os.stat_result] = None,
+        site_path: Optional[str] = None
+    ) -> Dict:
         """
         Escanear un archivo individual
         
+        La lectura y las regex se ejecutan en un hilo del executor, así el
+        event loop sigue atendiendo otras peticiones durante el escaneo.
+        
+        Args:
+            file_path: Ruta del archivo
+            file_stat: Resultado de stat() ya obtenido (evita syscalls extra)
+            site_path: Ruta relativa a la raíz del sitio: la del resultado y la que
+                se busca en los manifiestos del core (None: file_path)
+        
+        Returns:
+            Dict con: is_malicious, threats, suspicious_functions, file_hash
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.scan_path, file_path, file_stat, site_path)
+    
+    @timed('scan_file')
+    def scan_path(
+        self,
+        file_path: str,
+        file_stat: Optional[os.stat_result] = None,
+        site_path: Optional[str] = None
+    ) -> Dict:
+        """
+        Versión síncrona de scan_file
+        
+        Lee el archivo por bloques (o con mmap si es grande), calculando el hash
+        en la misma pasada, así la memoria por archivo se mantiene constante.
+        
+        Args:
+            file_path: Ruta del archivo
+            file_stat: Resultado de stat() ya obtenido (evita syscalls extra)
+            site_path: Ruta relativa a la raíz del sitio: la del resultado y la que
+                se busca en los manifiestos del core (None: file_path)
+        
         Returns:
             Dict con: is_malicious, threats, suspicious_functions, file_hash
         """
+        result_path = site_path if site_path is not None else file_path
         try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
+            with open(file_path, 'rb') as f:
+                if file_stat is None:
+                    file_stat = os.fstat(f.fileno())
+                
+                if file_stat.st_size >= MMAP_THRESHOLD:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        # Archivos grandes: hash primero (barato) y consultar antes de las regex
+                        scan = self._prehash_lookup(self._mmap_windows(mm))
+                        if scan is None:
+                            windows = self._mmap_windows(mm)
+                            try:
+                                scan = self._scan_windows(windows)
+                            finally:
+                                windows.close()  # Liberar la vista antes de cerrar el mmap
+                else:
+                    scan = None
+                    if file_stat.st_size > CHUNK_SIZE:
+                        scan = self._prehash_lookup(self._read_windows(f))
+                        f.seek(0)
+                    if scan is None:
+                        scan = self._scan_windows(self._read_windows(f))
             
-            # Calcular hash
-            file_hash = hashlib.md5(content.encode()).hexdigest()
+            return self._finish(
+                self._build_result(result_path, file_stat.st_size, file_stat.st_mtime, scan),
+                scan
+            )
             
-            # Buscar firmas de malware
-            threats = []
-            for signature in self.signatures:
-                if re.search(signature['pattern'], content, re.IGNORECASE):
-                    # Extraer contexto (5 líneas antes y después)
-                    match = re.search(signature['pattern'], content, re.IGNORECASE)
-                    start = max(0, content[:match.start()].rfind('\n', 0, match.start() - 200))
-                    end = content.find('\n', match.end() + 200)
-                    if end == -1:
-                        end = len(content)
-                    
-                    code_snippet = content[start:end]
-                    
-                    threats.append({
-                        'signature': signature['name'],
-                        'severity': signature['severity'],
-                        'pattern': signature['pattern'],
-                        'code_snippet': code_snippet[:500]  # Limitar tamaño
-                    })
+        except Exception as e:
+            return self._error_result(result_path, e)
+    
+    async def scan_stream(
+        self,
+        stream,
+        file_path: str,
+        file_size: Optional[int] = None,
+        modified_time: Optional[float] = None
+    ) -> Dict:
+        """
+        Escanear contenido que no está en disco local (p.ej. un archivo subido)
+        
+        Args:
+            stream: Objeto tipo archivo binario con read(n)
+            file_path: Ruta del archivo en el sitio de origen
+            file_size: Tamaño en bytes (None: se usan los bytes leídos)
+            modified_time: Timestamp de modificación en origen (opcional)
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.scan_fileobj, stream, file_path, file_size, modified_time
+        )
+    
+    @timed('scan_file')
+    def scan_fileobj(
+        self,
+        stream,
+        file_path: str,
+        file_size: Optional[int] = None,
+        modified_time: Optional[float] = None
+    ) -> Dict:
+        """Versión síncrona de scan_stream (para usar desde hilos de trabajo)"""
+        try:
+            scan = self._scan_windows(self._read_windows(stream))
+            if file_size is None:
+                file_size = scan['bytes_read']
+            return self._finish(self._build_result(file_path, file_size, modified_time, scan), scan)
+        except Exception as e:
+            return self._error_result(file_path, e)
+    
+    @staticmethod
+    def _error_result(file_path: str, error: Exception) -> Dict:
+        return {
+            'file_path': file_path,
+            'error': str(error),
+            'is_malicious': False,
+            'threats': [],
+            'suspicious_functions': []
+        }
+    
+    @staticmethod
+    def _read_windows(f) -> Iterator[Tuple[bytes, int, int, bool, bytes]]:
+        """
+        Generar ventanas (buffer, pos, endpos, es_última, bloque_nuevo) leyendo bloques fijos.
+        Cada ventana arrastra los últimos CHUNK_OVERLAP bytes de la anterior.
+        """
+        carry = b''
+        chunk = f.read(CHUNK_SIZE)
+        while chunk:
+            next_chunk = f.read(CHUNK_SIZE)
+            window = carry + chunk if carry else chunk
+            yield window, 0, len(window), not next_chunk, chunk
+            carry = window[-CHUNK_OVERLAP:]
+            chunk = next_chunk
+    
+    @staticmethod
+    def _mmap_windows(mm: mmap.mmap) -> Iterator[Tuple[mmap.mmap, int, int, bool, memoryview]]:
+        """Generar ventanas sobre un mmap sin copiar datos"""
+        size = len(mm)
+        with memoryview(mm) as view:
+            for offset in range(0, size, CHUNK_SIZE):
+                end = min(offset + CHUNK_SIZE, size)
+                with view[offset:end] as chunk:
+                    yield mm, max(0, offset - CHUNK_OVERLAP), end, end == size, chunk
+    
+    def _scan_windows(self, windows) -> Dict:
+        """
+        Aplicar firmas y contar funciones sospechosas ventana a ventana
+        
+        Una coincidencia que empieza en los últimos CHUNK_OVERLAP bytes de una
+        ventana se cuenta en la siguiente, que la contiene completa.
+        
+        Returns:
+            Dict con: md5, sha256 (digests), bytes_read, threats, function_counts, known_good
+        """
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        bytes_read = 0
+        threats = []
+        found = set()
+        function_counts = {}
+        obfuscation_score = 0
+        unpacker = None
+        newlines_before = 0  # Saltos de línea antes del bloque actual
+        match_state = MatchState(self.regex_time_budget)
+        first = True
+        
+        for buffer, pos, endpos, is_last, chunk in windows:
+            md5.update(chunk)
+            sha256.update(chunk)
+            bytes_read += len(chunk)
             
-            # Buscar funciones sospechosas
-            suspicious = []
-            for func in self.suspicious_functions:
-                pattern = rf'\b{func}\s*\('
-                matches = re.findall(pattern, content, re.IGNORECASE)
-                if matches:
-                    suspicious.append({
-                        'function': func,
-                        'count': len(matches)
-                    })
+            # Archivos de un solo bloque: consultar hashes conocidos antes de cualquier regex
+            if first and is_last:
+                known = self._lookup_known(md5, sha256, bytes_read)
+                if known is not None:
+                    return known
+            first = False
             
-            return {
-                'file_path': file_path,
-                'is_malicious': len(threats) > 0,
-                'threats': threats,
-                'suspicious_functions': suspicious,
-                'file_hash': file_hash,
-                'file_size': os.path.getsize(file_path),
-                'modified_time': datetime.fromtimestamp(os.path.getmtime(file_path)).isoformat()
-            }
+            chunk_start = endpos - len(chunk)
+            line_index = None
             
-        except Exception as e:
-            return {
-                'file_path': file_path,
-                'error': str(e),
-                'is_malicious': False,
-                'threats': [],
-                'suspicious_functions': []
+            def on_hit(start: int, end: int) -> Tuple[str, int]:
+                nonlocal line_index
+                if line_index is None:
+                    line_index = LineIndex(buffer, pos, endpos, chunk_start, newlines_before)
+                return line_index.snippet(buffer, start, end)
+            
+            # Firmas y reglas en un solo motor: solo se verifican las que pasan el prefiltro
+            for signature, hit in self._compiled_signatures.scan_window(match_state, buffer, pos, endpos, on_hit, self.sandbox):
+                self._add_match(signature, hit, found, threats)
+            
+            if line_index is not None:
+                newlines_before += line_index.chunk_newlines(chunk_start)
+            else:
+                newlines_before += _count_newlines(chunk)
+            
+            # Payloads empaquetados (base64/gzip/rot13/hex): firmas sobre cada capa
+            if might_be_packed(chunk):
+                if unpacker is None:
+                    unpacker = LayerUnpacker(
+                        lambda layer: self._match_layer(layer, match_state), self.signature_version
+                    )
+                self._add_unpacked(unpacker.scan(bytes(buffer[pos:endpos])), found, threats)
+            
+            # Análisis estructural vectorizado del bloque nuevo; el profundo solo si puntúa alto
+            structure = analyze_structure(chunk)
+            obfuscation_score = max(obfuscation_score, structure['score'])
+            if structure['score'] >= DEEP_ANALYSIS_SCORE:
+                self._deep_analysis(bytes(buffer[pos:endpos]), structure, found, threats, match_state)
+            
+            limit = endpos if is_last else endpos - CHUNK_OVERLAP
+            for func, pattern in self._function_patterns:
+                count = 0
+                for match in pattern.finditer(buffer, pos, endpos):
+                    if match.start() >= limit:
+                        break
+                    count += 1
+                if count:
+                    function_counts[func] = function_counts.get(func, 0) + count
+        
+        if self._is_known_good(md5, sha256):
+            return self._pass_result(md5, sha256, bytes_read, [], {}, True)
+        
+        # Reglas que dependen del tamaño o de que algo no aparezca
+        for signature, hit in self._compiled_signatures.finish(match_state, bytes_read):
+            self._add_match(signature, hit, found, threats)
+        
+        # Búsquedas cortadas por tiempo: el archivo hizo explotar alguna regex (o es enorme)
+        if match_state.exhausted:
+            detail = ', '.join(sorted(match_state.timeouts)) or 'plazo del archivo agotado'
+            threats.append({
+                'signature': 'scan_timeout',
+                'severity': 'medium',
+                'pattern': None,
+                'code_snippet': f"Escaneo de firmas incompleto ({detail}); {match_state.skipped} búsquedas sin hacer"
+            })
+        
+        if obfuscation_score >= OBFUSCATION_SCORE and 'obfuscated_code' not in found:
+            threats.append({
+                'signature': 'obfuscated_code',
+                'severity': 'medium',
+                'pattern': None,
+                'code_snippet': f"Puntuación de ofuscación: {obfuscation_score}/100"
+            })
+            found.add('obfuscated_code')
+        
+        scan = self._pass_result(md5, sha256, bytes_read, threats, function_counts, False)
+        scan['obfuscation_score'] = obfuscation_score
+        # Incompleto también si el desempaquetado se cortó (profundidad o presupuesto): no se cachea
+        scan['incomplete'] = match_state.exhausted or (unpacker is not None and unpacker.truncated)
+        return scan
+    
+    def _deep_analysis(self, data: bytes, structure: Dict, found: set, threats: List[Dict], match_state: MatchState):
+        """
+        Análisis profundo de un bloque con pinta de ofuscado
+        
+        Reconstruye literales (chr(), concatenaciones) y vuelve a pasar las
+        firmas; además detecta funciones peligrosas llamadas a través de
+        una variable cuyo nombre solo existe tras reconstruir el literal.
+        """
+        normalized = normalize_strings(data)
+        if normalized == data:
+            return
+        
+        state = match_state.derive()
+        matches = self._compiled_signatures.match_bytes(
+            normalized, lambda start, end: self._extract_snippet(normalized, start, end), self.sandbox, state
+        )
+        match_state.absorb(state)
+        for signature, snippet in matches:
+            if signature['name'] in found:
+                continue
+            found.add(signature['name'])
+            threats.append({
+                'signature': signature['name'],
+                'severity': signature['severity'],
+                'pattern': signature['pattern'],
+                'code_snippet': snippet or '',
+                'deobfuscated': True
+            })
+        
+        if structure['variable_calls'] and 'obfuscated_function_call' not in found:
+            hidden = sorted(set(hidden_calls(normalized)) - set(hidden_calls(data)))
+            if hidden:
+                found.add('obfuscated_function_call')
+                threats.append({
+                    'signature': 'obfuscated_function_call',
+                    'severity': 'high',
+                    'pattern': None,
+                    'code_snippet': f"Funciones reconstruidas: {', '.join(hidden)}"
+                })
+    
+    @staticmethod
+    def _add_match(signature: Dict, hit: Optional[Tuple[str, int]], found: set, threats: List[Dict]):
+        """Añadir la coincidencia de una firma o regla (hit = (snippet, línea) del primer string)"""
+        if signature['name'] in found:
+            return
+        found.add(signature['name'])
+        snippet, line_number = hit if hit is not None else ('', None)
+        threats.append({
+            'signature': signature['name'],
+            'severity': signature['severity'],
+            'pattern': signature['pattern'],
+            'code_snippet': snippet,
+            'line_number': line_number
+        })
+    
+    def _match_layer(self, layer: bytes, match_state: MatchState) -> Tuple[List[Dict], bool]:
+        """
+        Firmas sobre una capa desempaquetada, con el plazo de regex del archivo
+        
+        Returns:
+            (hallazgos, True si todas las búsquedas se completaron y se puede memorizar)
+        """
+        state = match_state.derive()
+        matches = self._compiled_signatures.match_bytes(
+            layer, lambda start, end: self._extract_snippet(layer, start, end), self.sandbox, state
+        )
+        match_state.absorb(state)
+        findings = [
+            {
+                'signature': signature['name'],
+                'severity': signature['severity'],
+                'pattern': signature['pattern'],
+                'code_snippet': snippet or ''
             }
+            for signature, snippet in matches
+        ]
+        return findings, not state.exhausted
+    
+    @staticmethod
+    def _add_unpacked(findings: List[Dict], found: set, threats: List[Dict]):
+        """Añadir hallazgos de capas desempaquetadas, con la cadena de capas en el snippet"""
+        for finding in findings:
+            if finding['signature'] in found:
+                continue
+            found.add(finding['signature'])
+            layers = ' > '.join(finding['layers'])
+            threats.append({
+                'signature': finding['signature'],
+                'severity': finding['severity'],
+                'pattern': finding['pattern'],
+                'code_snippet': f"[{layers}] {finding['code_snippet']}",
+                'unpacked_layers': list(finding['layers'])
+            })
+    
+    def _prehash_lookup(self, windows) -> Optional[Dict]:
+        """Pasada solo de hash para archivos grandes; devuelve el veredicto si se conoce"""
+        if self.allowlist is None and self.verdict_cache is None:
+            return None
+        
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        bytes_read = 0
+        try:
+            for _, _, _, _, chunk in windows:
+                md5.update(chunk)
+                sha256.update(chunk)
+                bytes_read += len(chunk)
+        finally:
+            windows.close()
+        
+        return self._lookup_known(md5, sha256, bytes_read)
+    
+    def _lookup_known(self, md5, sha256, bytes_read: int) -> Optional[Dict]:
+        """Allowlist y caché de veredictos, antes de cualquier regex"""
+        if self._is_known_good(md5, sha256):
+            return self._pass_result(md5, sha256, bytes_read, [], {}, True)
+        
+        if self.verdict_cache is not None:
+            verdict = self.verdict_cache.get(sha256.hexdigest())
+            if verdict is not None:
+                scan = self._pass_result(
+                    md5,
+                    sha256,
+                    bytes_read,
+                    [dict(t) for t in verdict['threats']],
+                    {f['function']: f['count'] for f in verdict['suspicious_functions']},
+                    False
+                )
+                scan['cached'] = True
+                return scan
+        
+        return None
+    
+    def _finish(self, result: Dict, scan: Dict) -> Dict:
+        """Guardar en la caché el veredicto de un archivo escaneado de verdad"""
+        if scan.get('cached'):
+            result['cached'] = True
+        elif self.verdict_cache is not None and not scan['known_good'] and not scan.get('incomplete'):
+            # Un veredicto cortado por tiempo no se reutiliza: el siguiente escaneo lo repite
+            self.verdict_cache.put(result)
+        return result
+    
+    def _is_known_good(self, md5, sha256) -> bool:
+        if self.allowlist is None:
+            return False
+        return self.allowlist.is_known_good(md5.digest()) or self.allowlist.is_known_good(sha256.digest())
+    
+    @staticmethod
+    def _pass_result(
+        md5,
+        sha256,
+        bytes_read: int,
+        threats: List[Dict],
+        function_counts: Dict[str, int],
+        known_good: bool
+    ) -> Dict:
+        return {
+            'md5': md5.digest(),
+            'sha256': sha256.digest(),
+            'bytes_read': bytes_read,
+            'threats': threats,
+            'function_counts': function_counts,
+            'known_good': known_good
+        }
+    
+    @staticmethod
+    def _extract_snippet(data: bytes, start: int, end: int) -> str:
+        """Snippet de una coincidencia en contenido reconstruido (sin número de línea del archivo)"""
+        return LineIndex(data, 0, len(data)).snippet(data, start, end)[0]
+    
+    def _build_result(
+        self,
+        file_path: str,
+        file_size: int,
+        modified_time: Optional[float],
+        scan: Dict
+    ) -> Dict:
+        """Construir el resultado de un archivo a partir de la pasada de escaneo"""
+        threats = scan['threats']
+        known_good = scan['known_good']
+        
+        # Archivo del core/plugin conocido pero con contenido distinto
+        if not known_good and self.allowlist is not None and self.allowlist.is_modified(file_path, scan['md5']):
+            threats.insert(0, {
+                'signature': 'modified_core_file',
+                'severity': 'high',
+                'pattern': None,
+                'code_snippet': ''
+            })
+        
+        result = {
+            'file_path': file_path,
+            'is_malicious': len(threats) > 0,
+            'threats': threats,
+            'suspicious_functions': [
+                {'function': func, 'count': count}
+                for func, count in scan['function_counts'].items()
+            ],
+            'file_hash': scan['md5'].hex(),
+            'file_sha256': scan['sha256'].hex(),
+            'file_size': file_size,
+            'modified_time': datetime.fromtimestamp(modified_time).isoformat() if modified_time else None
+        }
+        if scan.get('obfuscation_score'):
+            result['obfuscation_score'] = scan['obfuscation_score']
+        if known_good:
+            result['known_good'] = True
+        return result
     
     async def scan_directory(
         self, 
         directory: str, 
         extensions: List[str] = ['.php'],
         max_size_mb: int = 10,
-        progress_callback = None
+        progress_callback = None,
+        exclude_dirs: Iterable[str] = DEFAULT_EXCLUDED_DIRS,
+        aggregator: Optional[ScanAggregator] = None,
+        site_root: Optional[str] = None
     ) -> Dict:
         """
         Escanear un directorio completo
@@ -154,53 +616,42 @@ class FileScanner:
             extensions: Extensiones a escanear
             max_size_mb: Tamaño máximo de archivo a escanear
             progress_callback: Función para reportar progreso
-        """
-        results = {
-            'total_files': 0,
-            'scanned_files': 0,
-            'threats_found': 0,
-            'suspicious_files': [],
-            'clean_files': [],
-            'errors': [],
-            'start_time': datetime.utcnow().isoformat()
-        }
+            exclude_dirs: Nombres de directorio que no se recorren
+            aggregator: Acumulador de resultados (permite varios directorios por escaneo)
+            site_root: Raíz del sitio, si `directory` es una parte (p.ej. wp-content/plugins);
+                las rutas de los resultados son relativas a ella
         
-        # Obtener lista de archivos
-        files_to_scan = []
-        for ext in extensions:
-            files_to_scan.extend(Path(directory).rglob(f'*{ext}'))
+        Returns:
+            Resumen compacto del acumulador (contadores, histogramas y detalle acotado)
+        """
+        if aggregator is None:
+            aggregator = ScanAggregator()
         
-        results['total_files'] = len(files_to_scan)
-        max_size_bytes = max_size_mb * 1024 * 1024
+        # Recorrer el árbol en una sola pasada (el tamaño ya viene filtrado)
+        walker = DirectoryWalker(
+            directory,
+            extensions,
+            max_size_bytes=max_size_mb * 1024 * 1024,
+            exclude_dirs=exclude_dirs
+        )
         
-        # Escanear archivos
-        for idx, file_path in enumerate(files_to_scan):
-            # Verificar tamaño
-            if file_path.stat().st_size > max_size_bytes:
-                continue
-            
-            # Escanear
-            scan_result = await self.scan_file(str(file_path))
-            results['scanned_files'] += 1
-            
-            # Categorizar resultado
-            if scan_result.get('error'):
-                results['errors'].append(scan_result)
-            elif scan_result['is_malicious']:
-                results['threats_found'] += 1
-                results['suspicious_files'].append(scan_result)
-            else:
-                # Solo guardar archivos con funciones sospechosas
-                if scan_result['suspicious_functions']:
-                    results['suspicious_files'].append(scan_result)
-                else:
-                    results['clean_files'].append(scan_result['file_path'])
+        # Escanear archivos a medida que se encuentran
+        root = site_root if site_root is not None else directory
+        files_before = aggregator.total_files
+        for file_path, file_stat in walker:
+            site_path = os.path.relpath(file_path, root).replace(os.sep, '/')
+            scan_result = await self.scan_file(file_path, file_stat, site_path)
+            await aggregator.add(scan_result)
             
             # Reportar progreso
             if progress_callback:
-                progress = int((idx + 1) / results['total_files'] * 100)
-                await progress_callback(progress, scan_result)
+                await progress_callback(walker.progress, scan_result)
         
-        results['end_time'] = datetime.utcnow().isoformat()
+        aggregator.total_files = files_before + walker.files_found
+        for error in walker.errors:
+            aggregator.add_error({
+                'file_path': os.path.relpath(error['file_path'], root).replace(os.sep, '/'),
+                'error': error['error']
+            })
         
-        return results
+        return aggregator.summary()
@@ -1,33 +1,460 @@
 """
 Gestor de firmas de malware
 """
+import copy
+import hashlib
 import json
+import logging
+import re
+import threading
+import time
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Dict
+from typing import Any, Callable, List, Dict, Optional, Set, Tuple
+
+from .profiling import SignatureProfiler, get_signature_profiler
+from .rules import compile_condition, compile_string, lint_pattern, parse_rules, regex_flags, required_literals
+from .sandbox import PROBE_STRIKES, RegexSandbox, vet_pattern
+
+logger = logging.getLogger(__name__)
+
+
+class RuleString:
+    """String de una regla: regex de verificación y literales del prefiltro"""
+    
+    __slots__ = ('id', 'regex', 'literals', 'key')
+    
+    def __init__(self, string_id: str, regex: re.Pattern, literals: Optional[Tuple[bytes, ...]]):
+        self.id = string_id
+        self.regex = regex
+        self.literals = literals  # En minúsculas, basta uno; None = sin prefiltro posible
+        self.key = (regex.pattern, regex.flags)  # Identidad del patrón en el sandbox
+
+
+class CompiledRule:
+    """Regla compilada; una firma JSON es una regla de un solo string (`$a`)"""
+    
+    __slots__ = ('signature', 'strings', 'condition', 'deferred')
+    
+    def __init__(self, signature: Dict, strings: List[RuleString], condition: Callable, deferred: bool):
+        self.signature = signature
+        self.strings = strings
+        self.condition = condition
+        self.deferred = deferred
+
+
+class MatchState:
+    """Strings encontrados de cada regla a lo largo de las ventanas de un archivo"""
+    
+    def __init__(self, time_budget: Optional[float] = None):
+        self.hits: Dict[int, Dict[str, Any]] = {}
+        self.matched: Set[int] = set()
+        # Índice de regla -> [regex ejecutadas, descartadas por prefiltro, ns, bytes]
+        self.profile: Dict[int, List[int]] = {}
+        # Plazo de regex del archivo (time.monotonic); pasado, no se empiezan más búsquedas
+        self.deadline = time.monotonic() + time_budget if time_budget else None
+        self.timeouts: Set[str] = set()  # Firmas cortadas por timeout del patrón
+        self.skipped = 0                 # Búsquedas no hechas por agotar el plazo del archivo
+    
+    @property
+    def exhausted(self) -> bool:
+        """True si alguna búsqueda no se completó (el resultado puede estar incompleto)"""
+        return bool(self.timeouts or self.skipped)
+    
+    def derive(self) -> 'MatchState':
+        """Estado para otro contenido del mismo archivo (capa, código normalizado): hits propios, mismo plazo"""
+        state = MatchState()
+        state.deadline = self.deadline
+        return state
+    
+    def absorb(self, other: 'MatchState'):
+        """Sumar al archivo las búsquedas cortadas de un estado derivado"""
+        self.timeouts |= other.timeouts
+        self.skipped += other.skipped
+
+
+class CompiledSignatures:
+    """
+    Conjunto de firmas compilado (inmutable una vez creado)
+    
+    `version` se deriva del contenido de los archivos de firmas y de las
+    firmas descartadas al vetarlas, así que dos procesos comparten versión (y
+    veredictos cacheados) solo si tienen activas las mismas firmas.
+    
+    Firmas JSON y reglas .yar comparten motor: cada string lleva los
+    literales de los que toda coincidencia contiene alguno, y en cada
+    ventana solo se ejecutan las regex con algún literal presente (búsqueda
+    de subcadena sobre la ventana en minúsculas). Un archivo limpio cuesta
+    una pasada de `in` por literal distinto, no una regex por firma.
+    
+    Con `sandbox` las regex se ejecutan en procesos aislados con límite de
+    tiempo (ver sandbox.py); sin él, en el propio hilo.
+    """
+    
+    def __init__(
+        self,
+        signatures: List[Dict],
+        version: str,
+        rules: Optional[List[Dict]] = None,
+        profiler: Optional[SignatureProfiler] = None
+    ):
+        rules = rules or []
+        self.signatures = signatures + rules
+        self.version = version
+        self.profiler = profiler if profiler is not None else get_signature_profiler()
+        self.rules: List[CompiledRule] = [_compile_signature(s) for s in signatures]
+        self.rules += [_compile_rule(r) for r in rules]
+        self.literals = {
+            literal
+            for rule in self.rules for s in rule.strings if s.literals is not None
+            for literal in s.literals
+        }
+        self.rejected: List[Dict] = []  # Firmas descartadas al vetar sus patrones (ver vet())
+        self.fingerprints = {signature['name']: _fingerprint(signature) for signature in self.signatures}
+    
+    def __len__(self) -> int:
+        return len(self.signatures)
+    
+    def subset(self, names: Set[str]) -> 'CompiledSignatures':
+        """
+        Solo las firmas con esos nombres, reutilizando lo ya compilado
+        
+        Para pasar únicamente las firmas nuevas sobre contenido ya escaneado
+        (ver rescan.py). La versión deriva de la del conjunto completo y de
+        los nombres: lo memorizado con un subconjunto (capas desempaquetadas)
+        nunca se confunde con lo del conjunto completo.
+        """
+        subset = copy.copy(self)
+        subset.version = f"{self.version}:" + hashlib.sha1('\n'.join(sorted(names)).encode()).hexdigest()[:8]
+        subset.rules = [rule for rule in self.rules if rule.signature['name'] in names]
+        subset.signatures = [rule.signature for rule in subset.rules]
+        subset.literals = {
+            literal
+            for rule in subset.rules for s in rule.strings if s.literals is not None
+            for literal in s.literals
+        }
+        subset.fingerprints = {name: self.fingerprints[name] for name in names if name in self.fingerprints}
+        return subset
+    
+    def scan_window(
+        self,
+        state: MatchState,
+        buffer,
+        pos: int,
+        endpos: int,
+        on_hit: Callable[[int, int], Any],
+        sandbox: Optional[RegexSandbox] = None
+    ) -> List[Tuple[Dict, Any]]:
+        """
+        Buscar los strings pendientes en buffer[pos:endpos]
+        
+        `on_hit(inicio, fin)` se llama con la primera coincidencia de cada
+        string (p.ej. para extraer el snippet mientras la ventana existe).
+        Las regex que pasan el prefiltro se ejecutan todas de una vez en el
+        sandbox (una copia de la ventana por llamada) o una a una aquí.
+        
+        Returns:
+            [(firma, hit)] de las reglas que se cumplen ya (las no diferidas);
+            hit es el resultado de on_hit del primer string encontrado
+        """
+        present = None
+        if self.literals:
+            lowered = bytes(buffer[pos:endpos]).lower()
+            present = {literal for literal in self.literals if literal in lowered}
+            del lowered
+        
+        size = endpos - pos
+        pending = []
+        for index, rule in enumerate(self.rules):
+            if index in state.matched:
+                continue
+            hits = state.hits.get(index)
+            profile = state.profile.get(index)
+            if profile is None:
+                profile = state.profile[index] = [0, 0, 0, 0]
+            for string in rule.strings:
+                if hits is not None and string.id in hits:
+                    continue
+                if string.literals is not None and present.isdisjoint(string.literals):
+                    profile[1] += 1
+                    continue
+                pending.append((index, string))
+        
+        if sandbox is not None and pending:
+            self._search_sandboxed(state, sandbox, pending, bytes(buffer[pos:endpos]), pos, on_hit)
+        else:
+            for index, string in pending:
+                if state.deadline is not None and time.monotonic() >= state.deadline:
+                    state.skipped += 1
+                    continue
+                started = time.perf_counter_ns()
+                match = string.regex.search(buffer, pos, endpos)
+                self._record(state, index, string, time.perf_counter_ns() - started, size,
+                             match and (match.start(), match.end()), on_hit)
+        
+        matched = []
+        for index in dict.fromkeys(index for index, _ in pending):
+            rule = self.rules[index]
+            hits = state.hits.get(index)
+            if hits and not rule.deferred and rule.condition(hits, None):
+                state.matched.add(index)
+                matched.append((rule.signature, next(iter(hits.values()))))
+        return matched
+    
+    def _search_sandboxed(self, state: MatchState, sandbox: RegexSandbox, pending, data: bytes, pos: int, on_hit):
+        spans, times, status = sandbox.search_many(
+            [string.key for _, string in pending], data, deadline=state.deadline
+        )
+        for (index, string), span, elapsed, outcome in zip(pending, spans, times, status):
+            if outcome in ('skipped', 'disabled', 'error'):
+                # Búsqueda no hecha (plazo agotado, patrón desactivado o fallo del sandbox)
+                state.skipped += 1
+                continue
+            if outcome == 'timeout':
+                state.timeouts.add(self.rules[index].signature['name'])
+            self._record(state, index, string, elapsed, len(data),
+                         span and (span[0] + pos, span[1] + pos), on_hit)
+    
+    @staticmethod
+    def _record(state: MatchState, index: int, string: RuleString, elapsed: int, size: int, span, on_hit):
+        profile = state.profile[index]
+        profile[0] += 1
+        profile[2] += elapsed
+        profile[3] += size
+        if span:
+            hits = state.hits.get(index)
+            if hits is None:
+                hits = state.hits[index] = {}
+            hits[string.id] = on_hit(*span)
+    
+    def finish(self, state: MatchState, filesize: int) -> List[Tuple[Dict, Any]]:
+        """Evaluar con el tamaño final las reglas que aún no se cumplieron"""
+        matched = []
+        for index, rule in enumerate(self.rules):
+            if index in state.matched:
+                continue
+            hits = state.hits.get(index) or {}
+            if rule.condition(hits, filesize):
+                state.matched.add(index)
+                matched.append((rule.signature, next(iter(hits.values()), None)))
+        
+        self.profiler.record_file(
+            (self.rules[index].signature['name'], *profile, int(index in state.matched))
+            for index, profile in state.profile.items()
+        )
+        return matched
+    
+    def lint(self) -> Dict[str, List[Dict]]:
+        """Riesgos de backtracking por firma (solo las que tienen alguno), sobre el patrón original"""
+        issues = {}
+        for rule in self.rules:
+            signature = rule.signature
+            if signature.get('type') == 'rule':
+                found = []
+                for string in signature['strings']:
+                    if string['type'] == 'regex':
+                        found += [
+                            dict(issue, string=string['id'])
+                            for issue in lint_pattern(string['value'], regex_flags(string))
+                        ]
+            else:
+                found = lint_pattern(signature['pattern'], re.IGNORECASE)
+            if found:
+                issues[signature['name']] = found
+        return issues
+    
+    def match_bytes(
+        self,
+        data: bytes,
+        on_hit: Callable[[int, int], Any],
+        sandbox: Optional[RegexSandbox] = None,
+        state: Optional[MatchState] = None
+    ) -> List[Tuple[Dict, Any]]:
+        """Todas las reglas sobre un contenido completo en memoria (capas, código normalizado)"""
+        state = state or MatchState()
+        return self.scan_window(state, data, 0, len(data), on_hit, sandbox) + self.finish(state, len(data))
+
+
+def vet_signatures(signatures: List[Dict], rules: List[Dict]) -> Tuple[List[Dict], List[Dict], List[Dict]]:
+    """
+    Vetar los patrones regex antes de compilar (ver sandbox.vet_pattern)
+    
+    Los patrones reescritos guardan la versión original en `pattern`/`value`
+    y la que se ejecuta en `effective_pattern`/`effective_value`.
+    
+    Returns:
+        (firmas aceptadas, reglas aceptadas, descartadas con el motivo)
+    """
+    # Un solo proceso de sondeo para todo el conjunto (se arranca solo si hace falta)
+    probe = RegexSandbox(workers=1, max_strikes=PROBE_STRIKES)
+    try:
+        return _vet_all(signatures, rules, probe)
+    finally:
+        probe.close()
+
+
+def _vet_all(signatures: List[Dict], rules: List[Dict], probe: RegexSandbox):
+    rejected = []
+    accepted_signatures = []
+    for signature in signatures:
+        effective, issues = vet_pattern(signature['pattern'], re.IGNORECASE, probe)
+        if effective is None:
+            rejected.append({'name': signature['name'], 'pattern': signature['pattern'], 'issues': issues})
+            continue
+        if effective != signature['pattern']:
+            signature = dict(signature, effective_pattern=effective)
+        accepted_signatures.append(signature)
+    
+    accepted_rules = []
+    for rule in rules:
+        strings = []
+        for string in rule['strings']:
+            if string['type'] == 'regex':
+                effective, issues = vet_pattern(string['value'], regex_flags(string), probe)
+                if effective is None:
+                    rejected.append({'name': rule['name'], 'pattern': string['value'], 'string': string['id'], 'issues': issues})
+                    break
+                if effective != string['value']:
+                    string = dict(string, effective_value=effective)
+            strings.append(string)
+        else:
+            accepted_rules.append(dict(rule, strings=strings))
+    return accepted_signatures, accepted_rules, rejected
+
+
+def _fingerprint(signature: Dict) -> str:
+    """Huella de la definición de una firma (sin las reescrituras de carga): cambia si cambia lo que detecta"""
+    definition = {
+        key: value for key, value in signature.items()
+        if key not in ('description', 'effective_pattern')
+    }
+    if 'strings' in definition:
+        definition['strings'] = [
+            {key: value for key, value in string.items() if key != 'effective_value'}
+            for string in definition['strings']
+        ]
+    return hashlib.sha1(json.dumps(definition, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _compile_signature(signature: Dict) -> CompiledRule:
+    # Patrones sobre bytes, para escanear sin decodificar
+    # effective_pattern: versión reescrita al cargar (comodines acotados)
+    pattern = signature.get('effective_pattern', signature['pattern'])
+    regex = re.compile(pattern.encode(), re.IGNORECASE)
+    literals = required_literals(pattern, re.IGNORECASE)
+    return CompiledRule(signature, [RuleString('$a', regex, literals)], lambda found, size: '$a' in found, False)
+
+
+def _compile_rule(rule: Dict) -> CompiledRule:
+    strings = [RuleString(string['id'], *compile_string(string)) for string in rule['strings']]
+    condition, deferred = compile_condition(rule['condition'], [string.id for string in strings])
+    return CompiledRule(rule, strings, condition, deferred)
+
 
 class SignatureManager:
     
     def __init__(self, signatures_dir: str = "signatures"):
         self.signatures_dir = Path(signatures_dir)
         self.signatures_dir.mkdir(exist_ok=True)
+        self.signatures_file = self.signatures_dir / 'malware_patterns.json'
+        
+        self._lock = threading.Lock()
+        self._compiled: Optional[CompiledSignatures] = None
+        self._file_stamp = None  # (mtime_ns, size) de cada archivo en la última lectura
+        self._source_digest = None  # Hash del contenido de los archivos ya compilados
+        self.reloads = 0
     
-    def load_signatures(self) -> List[Dict]:
-        """Cargar todas las firmas"""
-        signatures_file = self.signatures_dir / 'malware_patterns.json'
+    def get_compiled(self) -> CompiledSignatures:
+        """
+        Firmas compiladas, recargando solo si algún archivo cambió
+        
+        Se comprueba mtime/tamaño con un stat del JSON y de cada .yar; si
+        cambian pero el hash del contenido es el mismo, se conserva el
+        conjunto ya compilado.
+        """
+        stamp = self._stat()
+        compiled = self._compiled
+        if compiled is not None and stamp == self._file_stamp:
+            return compiled
         
-        if not signatures_file.exists():
+        with self._lock:
+            if self._compiled is None or self._stat() != self._file_stamp:
+                self._reload()
+            return self._compiled
+    
+    def _rule_files(self) -> List[Path]:
+        """Archivos de reglas estilo YARA junto al JSON (ver rules.py)"""
+        return sorted(self.signatures_dir.glob('*.yar'))
+    
+    def _stat(self):
+        stamp = []
+        for path in [self.signatures_file] + self._rule_files():
+            try:
+                st = path.stat()
+                stamp.append((path.name, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamp.append((path.name, None, None))
+        return tuple(stamp)
+    
+    def _reload(self):
+        if not self.signatures_file.exists():
             # Crear archivo con firmas por defecto
-            default_signatures = self._get_default_signatures()
-            self.save_signatures(default_signatures)
-            return default_signatures
+            self.save_signatures(self._get_default_signatures())
+        
+        self._file_stamp = self._stat()
+        raw = self.signatures_file.read_bytes()
+        digest = hashlib.sha256(raw)
+        rule_texts = []
+        for path in self._rule_files():
+            text = path.read_bytes()
+            digest.update(path.name.encode() + b'\0' + text)
+            rule_texts.append((path.name, text.decode('utf-8', errors='replace')))
+        source_digest = digest.hexdigest()[:16]
         
-        with open(signatures_file, 'r') as f:
-            return json.load(f)
+        if self._compiled is not None and self._source_digest == source_digest:
+            return
+        
+        rules = []
+        for name, text in rule_texts:
+            parsed, errors = parse_rules(text)
+            rules.extend(parsed)
+            for error in errors:
+                logger.warning(f"⚠️  Regla descartada en {name}: {error}")
+        
+        signatures, rules, rejected = vet_signatures(json.loads(raw), rules)
+        version = source_digest
+        if rejected:
+            # Con firmas descartadas el conjunto activo es otro: sus veredictos no se comparten
+            # con los procesos que sí las tienen
+            names = sorted({entry['name'] for entry in rejected})
+            version += '-r' + hashlib.sha1('\n'.join(names).encode()).hexdigest()[:8]
+        compiled = CompiledSignatures(signatures, version, rules)
+        compiled.rejected = rejected
+        self._compiled = compiled
+        self._source_digest = source_digest
+        self.reloads += 1
+        logger.info(f"🔑 Firmas de malware compiladas: {len(compiled)} (versión {version})")
+        
+        for entry in rejected:
+            logger.error(f"❌ Firma '{entry['name']}' descartada: coste superlineal en el sondeo ({entry['pattern'][:80]})")
+        for signature in compiled.signatures:
+            effective = signature.get('effective_pattern')
+            if effective is None and signature.get('type') == 'rule':
+                effective = next((s['effective_value'] for s in signature['strings'] if 'effective_value' in s), None)
+            if effective is not None:
+                logger.info(f"✏️  Firma '{signature['name']}' reescrita con comodines acotados")
+        for name, issues in compiled.lint().items():
+            for issue in issues:
+                if issue['severity'] == 'high':
+                    logger.warning(f"⚠️  Firma '{name}' con riesgo de backtracking: {issue['issue']}")
+    
+    def load_signatures(self) -> List[Dict]:
+        """Cargar todas las firmas"""
+        return self.get_compiled().signatures
     
     def save_signatures(self, signatures: List[Dict]):
         """Guardar firmas"""
-        signatures_file = self.signatures_dir / 'malware_patterns.json'
-        with open(signatures_file, 'w') as f:
+        with open(self.signatures_file, 'w') as f:
             json.dump(signatures, f, indent=2)
     
     def _get_default_signatures(self) -> List[Dict]:
@@ -114,3 +541,9 @@ class SignatureManager:
                 "category": "obfuscation"
             }
         ]
+
+
+@lru_cache()
+def get_signature_manager(signatures_dir: str = "signatures") -> SignatureManager:
+    """Gestor de firmas compartido por todo el proceso"""
+    return SignatureManager(signatures_dir)
@@ -0,0 +1,133 @@
+"""
+Estadísticas agregadas del antivirus por sitio
+"""
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from app.metrics import cache_result
+
+logger = logging.getLogger(__name__)
+
+STATS_CACHE_TTL = 30.0  # Segundos
+SEVERITY_PAGE_SIZE = 1000  # Filas por página (el máximo habitual de PostgREST)
+
+# site_id -> (expira, estadísticas)
+_stats_cache: Dict[str, Tuple[float, Dict]] = {}
+_rpc_available = True
+
+
+def get_site_stats(client, site_id: str) -> Dict:
+    """
+    Estadísticas de un sitio (con caché de STATS_CACHE_TTL segundos)
+
+    Usa la función SQL `antivirus_site_stats(p_site_id uuid)`, que devuelve
+    en una sola fila total_scans, active_threats, threats_by_severity (JSON)
+    y last_scan (JSON con started_at, threats_found, status):
+
+        select
+          (select count(*) from scans where site_id = p_site_id) as total_scans,
+          (select count(*) from threats where site_id = p_site_id and status = 'active') as active_threats,
+          (select coalesce(jsonb_object_agg(severity, n), '{}') from (
+             select severity, count(*) n from threats
+             where site_id = p_site_id and status = 'active' group by severity) s) as threats_by_severity,
+          (select to_jsonb(l) from (
+             select started_at, threats_found, status from scans
+             where site_id = p_site_id order by started_at desc limit 1) l) as last_scan
+
+    Si la función no existe se usan dos consultas (ver _fetch_counts).
+    """
+    cached = _stats_cache.get(site_id)
+    now = time.monotonic()
+    if cached is not None and cached[0] > now:
+        cache_result('site_stats', True)
+        return cached[1]
+    cache_result('site_stats', False)
+
+    stats = _fetch_rpc(client, site_id) if _rpc_available else None
+    if stats is None:
+        stats = _fetch_counts(client, site_id)
+
+    _stats_cache[site_id] = (now + STATS_CACHE_TTL, stats)
+    return stats
+
+
+def invalidate_site_stats(site_id: str):
+    """Descartar las estadísticas en caché (nuevas amenazas, cambios de estado, fin de escaneo)"""
+    _stats_cache.pop(site_id, None)
+
+
+def _fetch_rpc(client, site_id: str) -> Optional[Dict]:
+    global _rpc_available
+    try:
+        result = client.rpc('antivirus_site_stats', {'p_site_id': site_id}).execute()
+    except Exception as e:
+        # Función inexistente (PostgREST PGRST202 / Postgres 42883): no volver a intentarlo
+        if 'PGRST202' in str(e) or '42883' in str(e):
+            _rpc_available = False
+        logger.warning(f"⚠️  RPC antivirus_site_stats no disponible, usando conteos: {e}")
+        return None
+
+    row = result.data[0] if isinstance(result.data, list) else result.data
+    row = row or {}
+    return _format_stats(
+        row.get('total_scans') or 0,
+        row.get('active_threats') or 0,
+        row.get('threats_by_severity') or {},
+        row.get('last_scan')
+    )
+
+
+def _fetch_counts(client, site_id: str) -> Dict:
+    """
+    Alternativa sin RPC: dos consultas
+
+    - El último escaneo con count='exact': el total de escaneos sale de la
+      misma respuesta (Content-Range), aunque solo se descargue una fila
+    - Las amenazas activas proyectadas a su severidad, agrupadas aquí (solo
+      se pagina si el sitio supera el máximo de filas de PostgREST)
+    """
+    last_scan = client.table('scans')\
+        .select('started_at, threats_found, status', count='exact')\
+        .eq('site_id', site_id)\
+        .order('started_at', desc=True)\
+        .limit(1)\
+        .execute()
+
+    threats_by_severity: Dict[str, int] = {}
+    active = None
+    fetched = 0
+    while active is None or fetched < active:
+        result = client.table('threats')\
+            .select('severity', count='exact')\
+            .eq('site_id', site_id)\
+            .eq('status', 'active')\
+            .range(fetched, fetched + SEVERITY_PAGE_SIZE - 1)\
+            .execute()
+        rows = result.data or []
+        active = result.count or 0
+        for row in rows:
+            threats_by_severity[row['severity']] = threats_by_severity.get(row['severity'], 0) + 1
+        fetched += len(rows)
+        if not rows:
+            break
+
+    return _format_stats(
+        last_scan.count or 0,
+        active,
+        threats_by_severity,
+        last_scan.data[0] if last_scan.data else None
+    )
+
+
+def _format_stats(total_scans: int, active_threats: int, threats_by_severity: Dict, last_scan: Optional[Dict]) -> Dict:
+    return {
+        "total_scans": total_scans,
+        "active_threats": active_threats,
+        "threats_by_severity": threats_by_severity,
+        "last_scan": {
+            "date": last_scan['started_at'] if last_scan else None,
+            "threats_found": last_scan['threats_found'] if last_scan else 0,
+            "status": last_scan['status'] if last_scan else None
+        }
+    }
@@ -0,0 +1,309 @@
+"""
+Desempaquetado estático de payloads PHP por capas (base64, gzip, rot13, hex)
+
+Nada se ejecuta: las capas se decodifican con las mismas transformaciones
+que haría PHP y sobre cada una se vuelven a pasar las firmas compiladas.
+"""
+import base64
+import binascii
+import hashlib
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+MAX_DEPTH = 6                       # Capas anidadas como máximo
+BYTE_BUDGET = 4 * 1024 * 1024       # Bytes decodificados como máximo por archivo
+TIME_BUDGET = 0.25                  # Segundos de CPU de desempaquetado por archivo
+MAX_LAYERS = 128                    # Capas distintas como máximo por archivo
+MIN_PAYLOAD = 16                    # Literales más cortos no merecen la pena
+MIN_ORPHAN_BASE64 = 256             # Base64 suelto (sin llamada alrededor) a partir de aquí
+MEMO_SIZE = 2048                    # Capas memorizadas en el proceso
+
+# Decodificadores PHP soportados (nombre de la función -> transformación)
+_ROT13 = bytes.maketrans(
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz',
+    b'NOPQRSTUVWXYZABCDEFGHIJKLMnopqrstuvwxyzabcdefghijklm'
+)
+_WHITESPACE = re.compile(rb'\s+')
+_HEX_ESCAPE = re.compile(rb'\\x([0-9A-Fa-f]{2})')
+
+_DECODER_NAMES = (
+    'base64_decode', 'gzinflate', 'gzuncompress', 'gzdecode',
+    'str_rot13', 'hex2bin', 'strrev'
+)
+# Cadena de llamadas cuyo argumento más interno es un literal:
+# eval(gzinflate(base64_decode('...'))) -> [gzinflate, base64_decode] + literal
+_CALL_CHAIN = re.compile(
+    rb'((?:\b(?:' + '|'.join(_DECODER_NAMES).encode() + rb')\s*\(\s*)+)'
+    rb'(?:\'([^\'\\]{16,})\'|"((?:[^"\\]|\\.){16,})")',
+    re.IGNORECASE
+)
+_FUNCTION_NAME = re.compile(rb'\w+')
+_ORPHAN_BASE64 = re.compile(rb'[\'"]([A-Za-z0-9+/\r\n]{' + str(MIN_ORPHAN_BASE64).encode() + rb',}={0,2})[\'"]')
+_HEX_STRING = re.compile(rb'"((?:\\x[0-9A-Fa-f]{2}){8,})"')
+_PRINTABLE = bytes(range(32, 127)) + b'\t\n\r'
+
+# Pista barata para saltarse el desempaquetado en el código normal
+_HINT = re.compile(
+    rb'\b(?:' + '|'.join(_DECODER_NAMES).encode() + rb')\s*\(|\\x[0-9A-Fa-f]{2}\\x|[A-Za-z0-9+/]{'
+    + str(MIN_ORPHAN_BASE64).encode() + rb'}',
+    re.IGNORECASE
+)
+
+# (versión de firmas, sha1 de la capa) -> hallazgos de la capa y sus descendientes
+_memo: 'OrderedDict[Tuple[str, bytes], Tuple[Dict, ...]]' = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+class BudgetExceeded(Exception):
+    """Se agotó el presupuesto de bytes, capas o tiempo del archivo"""
+
+
+class UnpackBudget:
+    """Límites de trabajo por archivo: un archivo hostil no puede bloquear al worker"""
+
+    def __init__(self, byte_budget: int = BYTE_BUDGET, time_budget: float = TIME_BUDGET, max_layers: int = MAX_LAYERS):
+        self.bytes_left = byte_budget
+        self.layers_left = max_layers
+        self.deadline = time.monotonic() + time_budget
+        self.exhausted = False
+
+    def check(self):
+        if self.bytes_left <= 0 or self.layers_left <= 0 or time.monotonic() > self.deadline:
+            self.exhausted = True
+            raise BudgetExceeded()
+
+    def consume(self, size: int):
+        self.bytes_left -= size
+        self.layers_left -= 1
+
+
+def might_be_packed(data) -> bool:
+    """True si el bloque tiene llamadas a decodificadores, escapes hex o base64 largo"""
+    return _HINT.search(data) is not None
+
+
+def _base64(data: bytes, limit: int) -> bytes:
+    data = _WHITESPACE.sub(b'', data)
+    data += b'=' * (-len(data) % 4)
+    if len(data) * 3 // 4 > limit:
+        raise BudgetExceeded()
+    return base64.b64decode(data, validate=False)
+
+
+def _inflate(data: bytes, limit: int, wbits: int) -> bytes:
+    # max_length: una bomba de compresión no puede pasar del presupuesto
+    decompressor = zlib.decompressobj(wbits)
+    out = decompressor.decompress(data, limit)
+    if decompressor.unconsumed_tail:
+        raise BudgetExceeded()
+    return out
+
+
+def _hex2bin(data: bytes, limit: int) -> bytes:
+    if len(data) // 2 > limit:
+        raise BudgetExceeded()
+    return binascii.unhexlify(_WHITESPACE.sub(b'', data))
+
+
+_DECODERS: Dict[bytes, Callable[[bytes, int], bytes]] = {
+    b'base64_decode': _base64,
+    b'gzinflate': lambda data, limit: _inflate(data, limit, -15),
+    b'gzuncompress': lambda data, limit: _inflate(data, limit, 15),
+    b'gzdecode': lambda data, limit: _inflate(data, limit, 31),
+    b'str_rot13': lambda data, limit: data.translate(_ROT13),
+    b'hex2bin': _hex2bin,
+    b'strrev': lambda data, limit: data[::-1],
+}
+
+
+def _unescape_double(data: bytes) -> bytes:
+    """Escapes \\xNN de un literal entre comillas dobles"""
+    return _HEX_ESCAPE.sub(lambda m: bytes([int(m.group(1), 16)]), data)
+
+
+def _looks_like_code(data: bytes) -> bool:
+    """Texto mayoritariamente imprimible (descarta base64 de imágenes y binarios)"""
+    if not data:
+        return False
+    sample = data[:4096]
+    non_printable = len(sample.translate(None, _PRINTABLE))
+    return non_printable / len(sample) <= 0.15
+
+
+def _decode_orphan(payload: bytes, budget: UnpackBudget) -> Optional[bytes]:
+    """Base64 suelto: se prueba solo y seguido de cada formato de compresión"""
+    decoded = _base64(payload, budget.bytes_left)
+    if _looks_like_code(decoded):
+        return decoded
+    for wbits in (-15, 15, 31):
+        budget.check()
+        try:
+            inflated = _inflate(decoded, budget.bytes_left, wbits)
+        except zlib.error:
+            continue
+        if _looks_like_code(inflated):
+            return inflated
+    return None
+
+
+def extract_layers(data: bytes, budget: UnpackBudget) -> Iterator[Tuple[str, bytes]]:
+    """
+    Siguiente nivel de capas de un bloque
+
+    El presupuesto se comprueba antes de cada decodificación, también entre
+    los pasos de una cadena y entre los literales que se descartan.
+
+    Yields:
+        (cadena de decodificadores aplicada, contenido decodificado)
+    """
+    covered = []
+
+    for match in _CALL_CHAIN.finditer(data):
+        budget.check()
+        names = [name.lower() for name in _FUNCTION_NAME.findall(match.group(1))]
+        if match.group(2) is not None:
+            payload = match.group(2)
+        else:
+            payload = _unescape_double(match.group(3))
+
+        # Las llamadas se aplican de dentro hacia fuera
+        try:
+            for name in reversed(names):
+                budget.check()
+                payload = _DECODERS[name](payload, budget.bytes_left)
+        except (binascii.Error, ValueError, zlib.error):
+            continue
+
+        covered.append((match.start(), match.end()))
+        if len(payload) >= MIN_PAYLOAD:
+            yield '('.join(name.decode() for name in names) + ')' * (len(names) - 1), payload
+
+    def inside_chain(position: int) -> bool:
+        return any(start <= position < end for start, end in covered)
+
+    for match in _ORPHAN_BASE64.finditer(data):
+        budget.check()
+        if inside_chain(match.start()):
+            continue
+        try:
+            payload = _decode_orphan(match.group(1), budget)
+        except (binascii.Error, ValueError):
+            continue
+        if payload is not None and len(payload) >= MIN_PAYLOAD:
+            yield 'base64', payload
+
+    for match in _HEX_STRING.finditer(data):
+        budget.check()
+        if inside_chain(match.start()):
+            continue
+        payload = _unescape_double(match.group(1))
+        if _looks_like_code(payload):
+            yield 'hex', payload
+
+
+class LayerUnpacker:
+    """
+    Desempaquetador recursivo de un archivo
+
+    `match(layer)` pasa las firmas sobre una capa y devuelve sus hallazgos
+    y si todas las búsquedas terminaron (una regex cortada por tiempo deja
+    la capa sin memorizar). Los hallazgos de cada capa (incluidas sus descendientes) se memorizan
+    por hash de la capa y versión de firmas: el mismo payload envuelto en
+    miles de archivos distintos solo se desempaqueta una vez por proceso.
+    Una capa repetida dentro del mismo archivo tampoco se repite, pero
+    entonces el subárbol que la contiene está incompleto (sus hallazgos
+    se cuentan en otra rama) y no se memoriza.
+
+    `truncated` indica que el archivo quedó sin recorrer entero (profundidad,
+    presupuesto o búsquedas cortadas): su resultado no debe cachearse.
+    """
+
+    def __init__(
+        self,
+        match: Callable[[bytes], Tuple[List[Dict], bool]],
+        signature_version: str,
+        max_depth: int = MAX_DEPTH,
+        budget: Optional[UnpackBudget] = None
+    ):
+        self.match = match
+        self.signature_version = signature_version
+        self.max_depth = max_depth
+        self.budget = budget or UnpackBudget()
+        self._seen = set()
+        self.truncated = False
+
+    def scan(self, data: bytes) -> List[Dict]:
+        """
+        Hallazgos en las capas empaquetadas dentro de `data` (no en `data` en sí)
+
+        Cada hallazgo lleva `layers`: la cadena de decodificadores que lleva
+        hasta la capa donde coincidió la firma.
+        """
+        if not might_be_packed(data):
+            return []
+        findings, _ = self._scan_children(data, 1)
+        return findings
+
+    def _scan_children(self, data: bytes, depth: int) -> Tuple[List[Dict], bool]:
+        """(hallazgos de las capas de `data`, True si se recorrieron todas enteras)"""
+        findings = []
+        complete = True
+        try:
+            for step, layer in extract_layers(data, self.budget):
+                layer_findings, layer_complete = self._scan_layer(layer, depth)
+                complete = complete and layer_complete
+                findings.extend(
+                    dict(finding, layers=(step,) + finding['layers'])
+                    for finding in layer_findings
+                )
+        except BudgetExceeded:
+            # Lo ya encontrado se conserva; el resto del archivo queda sin desempaquetar
+            self.budget.exhausted = True
+            self.truncated = True
+            complete = False
+        return findings, complete
+
+    def _scan_layer(self, layer: bytes, depth: int) -> Tuple[Tuple[Dict, ...], bool]:
+        """(hallazgos de una capa y sus descendientes con `layers` relativo a la capa, completo)"""
+        key = (self.signature_version, hashlib.sha1(layer).digest())
+        if key in self._seen:
+            # Ya contada en otra rama de este archivo: aquí queda fuera
+            return (), False
+        self._seen.add(key)
+
+        with _memo_lock:
+            cached = _memo.get(key)
+            if cached is not None:
+                _memo.move_to_end(key)
+                return cached, True
+
+        self.budget.check()
+        self.budget.consume(len(layer))
+
+        matches, complete = self.match(layer)
+        findings = [dict(finding, layers=()) for finding in matches]
+        if not complete:
+            self.truncated = True
+        if might_be_packed(layer):
+            if depth < self.max_depth:
+                children, children_complete = self._scan_children(layer, depth + 1)
+                complete = complete and children_complete
+                findings.extend(children)
+            else:
+                self.truncated = True
+                complete = False
+        findings = tuple(findings)
+
+        # Solo se memoriza lo completo: un subárbol cortado por presupuesto, por
+        # profundidad, por timeout de una regex o por una capa repetida podría
+        # tener más hallazgos
+        if complete:
+            with _memo_lock:
+                _memo[key] = findings
+                if len(_memo) > MEMO_SIZE:
+                    _memo.popitem(last=False)
+        return findings, complete
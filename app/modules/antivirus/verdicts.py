@@ -0,0 +1,233 @@
+"""
+Veredictos de escaneo por contenido (sha256), compartidos entre sitios
+"""
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.metrics import cache_result
+
+logger = logging.getLogger(__name__)
+
+# Amenazas que dependen de la ruta y no del contenido
+PATH_DEPENDENT_SIGNATURES = {'modified_core_file'}
+
+# Versión del motor de escaneo (heurísticas, desempaquetado, normalización).
+# Subirla al cambiar cualquiera de esas etapas: un veredicto depende de las
+# firmas y también del motor que las pasó
+ENGINE_VERSION = 2
+
+REDIS_KEY_PREFIX = "spamguard:verdict:"
+REDIS_TTL_SECONDS = 30 * 24 * 3600
+
+
+def verdict_version(signature_version: str) -> str:
+    """Versión con la que se guardan los veredictos: firmas + motor"""
+    return f"{signature_version}+e{ENGINE_VERSION}"
+
+
+def split_verdict_version(version: str) -> Tuple[str, Optional[int]]:
+    """(versión de firmas, versión del motor o None si es anterior a ENGINE_VERSION)"""
+    signature_version, _, engine = version.partition('+e')
+    return signature_version, int(engine) if engine.isdigit() else None
+
+
+class VerdictCache:
+    """
+    Caché de veredictos por hash de contenido y versión (ver verdict_version)
+
+    Capas (de más rápida a más lenta):
+    1. LRU local en memoria del proceso
+    2. Redis (si hay REDIS_URL), compartido entre workers y nodos
+    3. Tabla file_verdicts de Supabase:
+       sha256 (PK), signature_version, verdict, threats (JSON),
+       suspicious_functions (JSON), updated_at
+
+    get() solo consulta las capas 1 y 2 (se usa por archivo, desde los
+    hilos del scanner). La tabla se consulta por lotes con get_many() (un
+    MGET en Redis) y los veredictos nuevos se escriben por lotes con
+    flush(): un pipeline en Redis y un upsert en la tabla. Todo es
+    síncrono: desde el event loop se llama con asyncio.to_thread.
+    Un veredicto de otra versión de firmas o del motor cuenta como fallo.
+    """
+
+    LOOKUP_BATCH = 200  # Hashes por consulta (mantiene la URL de PostgREST acotada)
+    WRITE_BATCH = 500
+
+    def __init__(
+        self,
+        client,
+        signature_version: str,
+        redis_url: Optional[str] = None,
+        max_local: int = 50000
+    ):
+        self.client = client
+        self.signature_version = signature_version
+        self.max_local = max_local
+        self._local: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()  # El scanner también corre en hilos de trabajo
+        self._pending_writes: Dict[str, Dict] = {}
+        self._redis = None
+        self.hits = 0
+        self.misses = 0
+
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url, decode_responses=True)
+
+    def get(self, sha256: str) -> Optional[Dict]:
+        """Veredicto de un contenido (memoria y Redis), o None"""
+        sha256 = sha256.lower()
+        verdict = self._get_local(sha256)
+
+        if verdict is None and self._redis is not None:
+            try:
+                raw = self._redis.get(self._redis_key(sha256))
+                if raw:
+                    verdict = json.loads(raw)
+                    self._set_local(sha256, verdict)
+            except Exception as e:
+                logger.warning(f"⚠️  Error leyendo veredicto de Redis: {e}")
+
+        if verdict is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        cache_result('verdict', verdict is not None)
+        return verdict
+
+    def get_many(self, hashes: Iterable[str]) -> Dict[str, Dict]:
+        """Devolver {sha256: veredicto} para los hashes conocidos (todas las capas)"""
+        unique = list(dict.fromkeys(h.lower() for h in hashes))
+        found = {}
+        missing = []
+
+        for sha256 in unique:
+            verdict = self._get_local(sha256)
+            if verdict is not None:
+                found[sha256] = verdict
+            else:
+                missing.append(sha256)
+
+        if missing and self._redis is not None:
+            try:
+                values = self._redis.mget([self._redis_key(h) for h in missing])
+                still_missing = []
+                for sha256, raw in zip(missing, values):
+                    if raw:
+                        found[sha256] = json.loads(raw)
+                        self._set_local(sha256, found[sha256])
+                    else:
+                        still_missing.append(sha256)
+                missing = still_missing
+            except Exception as e:
+                logger.warning(f"⚠️  Error leyendo veredictos de Redis: {e}")
+
+        for i in range(0, len(missing), self.LOOKUP_BATCH):
+            batch = missing[i:i + self.LOOKUP_BATCH]
+            result = self.client.table('file_verdicts')\
+                .select('sha256, verdict, threats, suspicious_functions')\
+                .in_('sha256', batch)\
+                .eq('signature_version', self.signature_version)\
+                .execute()
+            for row in result.data or []:
+                verdict = {
+                    'verdict': row['verdict'],
+                    'threats': row.get('threats') or [],
+                    'suspicious_functions': row.get('suspicious_functions') or []
+                }
+                found[row['sha256']] = verdict
+                self._set_local(row['sha256'], verdict)
+
+        self.hits += len(found)
+        self.misses += len(unique) - len(found)
+        cache_result('verdict', True, len(found))
+        cache_result('verdict', False, len(unique) - len(found))
+        return found
+
+    def put(self, scan_result: Dict):
+        """Guardar el veredicto de un archivo escaneado (Redis y la tabla se escriben en flush())"""
+        if scan_result.get('error') or not scan_result.get('file_sha256'):
+            return
+
+        sha256 = scan_result['file_sha256']
+        threats = self.content_threats(scan_result)
+        verdict = {
+            'verdict': 'malicious' if threats else 'clean',
+            'threats': threats,
+            'suspicious_functions': scan_result.get('suspicious_functions', [])
+        }
+        self._set_local(sha256, verdict)
+
+        with self._lock:
+            self._pending_writes[sha256] = {
+                'sha256': sha256,
+                'signature_version': self.signature_version,
+                **verdict,
+                'updated_at': datetime.utcnow().isoformat()
+            }
+            should_flush = len(self._pending_writes) >= self.WRITE_BATCH
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """Escribir los veredictos pendientes: un pipeline en Redis y un upsert en la tabla"""
+        with self._lock:
+            rows = list(self._pending_writes.values())
+            self._pending_writes = {}
+
+        if not rows:
+            return
+
+        if self._redis is not None:
+            try:
+                pipeline = self._redis.pipeline(transaction=False)
+                for row in rows:
+                    verdict = {key: row[key] for key in ('verdict', 'threats', 'suspicious_functions')}
+                    pipeline.set(self._redis_key(row['sha256']), json.dumps(verdict), ex=REDIS_TTL_SECONDS)
+                pipeline.execute()
+            except Exception as e:
+                logger.warning(f"⚠️  Error guardando veredictos en Redis: {e}")
+
+        self.client.table('file_verdicts').upsert(rows).execute()
+
+    @staticmethod
+    def content_threats(scan_result: Dict) -> List[Dict]:
+        """Amenazas que dependen solo del contenido (sin patrón ni ruta)"""
+        return [
+            {
+                'signature': t['signature'],
+                'severity': t['severity'],
+                'code_snippet': t.get('code_snippet', ''),
+                'line_number': t.get('line_number')
+            }
+            for t in scan_result.get('threats', [])
+            if t['signature'] not in PATH_DEPENDENT_SIGNATURES
+        ]
+
+    def _get_local(self, sha256: str) -> Optional[Dict]:
+        with self._lock:
+            verdict = self._local.get(sha256)
+            if verdict is not None:
+                self._local.move_to_end(sha256)
+            return verdict
+
+    def _set_local(self, sha256: str, verdict: Dict):
+        with self._lock:
+            self._local[sha256] = verdict
+            self._local.move_to_end(sha256)
+            if len(self._local) > self.max_local:
+                self._local.popitem(last=False)
+
+    def _redis_key(self, sha256: str) -> str:
+        return f"{REDIS_KEY_PREFIX}{self.signature_version}:{sha256}"
+
+
+@lru_cache(maxsize=2)
+def get_verdict_cache(client, signature_version: str, redis_url: Optional[str] = None) -> VerdictCache:
+    """Caché compartida por todo el proceso para una versión de firmas"""
+    return VerdictCache(client, signature_version, redis_url)
@@ -0,0 +1,129 @@
+"""
+Recorrido rápido de directorios para el escaneo de malware
+"""
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Directorios que nunca contienen código a escanear (o que son enormes y regenerables)
+DEFAULT_EXCLUDED_DIRS = frozenset({
+    'node_modules', 'bower_components', 'vendor-cache',
+    '.git', '.svn', '.hg', '__pycache__',
+    'cache', '.cache', 'wp-rocket-cache', 'w3tc-cache',
+    'thumbs', 'thumbnails', '.thumbs',
+})
+
+
+class DirectoryWalker:
+    """
+    Recorrido en una sola pasada con os.scandir
+
+    - Filtra por un set de extensiones (una sola pasada para todas)
+    - Reutiliza el stat de cada DirEntry (se pasa tal cual a scan_file)
+    - Poda directorios excluidos sin entrar en ellos
+    - No sigue enlaces a directorios, y los enlaces a archivos solo si el
+      destino real está dentro de la raíz
+    - Es un generador: el escaneo empieza con el primer archivo encontrado
+      y la memoria no crece con el número de archivos del árbol
+    """
+
+    def __init__(
+        self,
+        root: str,
+        extensions: Iterable[str] = ('.php',),
+        max_size_bytes: Optional[int] = None,
+        exclude_dirs: Iterable[str] = DEFAULT_EXCLUDED_DIRS
+    ):
+        self.root = root
+        self.real_root = os.path.realpath(root)
+        self.extensions = frozenset(ext.lower() for ext in extensions)
+        self.max_size_bytes = max_size_bytes
+        self.exclude_dirs = frozenset(exclude_dirs)
+
+        self.files_found = 0
+        self.skipped_large = 0
+        self.dirs_found = 1
+        self.dirs_done = 0
+        self.errors: List[Dict] = []
+        self._progress = 0
+
+    def __iter__(self) -> Iterator[Tuple[str, os.stat_result]]:
+        """Generar (ruta, stat) de cada archivo a escanear"""
+        pending = [self.root]
+
+        while pending:
+            directory = pending.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.name not in self.exclude_dirs:
+                                    pending.append(entry.path)
+                                    self.dirs_found += 1
+                                continue
+
+                            if os.path.splitext(entry.name)[1].lower() not in self.extensions:
+                                continue
+                            if not entry.is_file():
+                                continue
+                            if entry.is_symlink() and not is_within(self.real_root, os.path.realpath(entry.path)):
+                                continue
+
+                            self.files_found += 1
+                            file_stat = entry.stat()
+                            if self.max_size_bytes is not None and file_stat.st_size > self.max_size_bytes:
+                                self.skipped_large += 1
+                                continue
+
+                            yield entry.path, file_stat
+
+                        except OSError as e:
+                            self.errors.append({'file_path': entry.path, 'error': str(e)})
+            except OSError as e:
+                self.errors.append({'file_path': directory, 'error': str(e)})
+
+            self.dirs_done += 1
+
+    @property
+    def progress(self) -> int:
+        """
+        Progreso estimado (0-99) según directorios recorridos frente a descubiertos
+
+        No se conoce el total de archivos de antemano, así que se usa la
+        proporción de directorios y nunca se retrocede.
+        """
+        estimate = int(self.dirs_done / self.dirs_found * 100)
+        self._progress = max(self._progress, min(estimate, 99))
+        return self._progress
+
+
+def is_within(root: str, path: str) -> bool:
+    """¿`path` (ya resuelta con realpath) es `root` o está debajo?"""
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def resolve_in_root(root: str, path: str) -> Optional[str]:
+    """
+    Ruta real de `path` (relativa a `root`) si no sale de `root`
+
+    Resuelve '..' y enlaces simbólicos; una ruta absoluta o que escapa de
+    la raíz devuelve None.
+    """
+    real_root = os.path.realpath(root)
+    real = os.path.realpath(os.path.join(real_root, path))
+    return real if is_within(real_root, real) else None
+
+
+def get_site_root(sites_root: Optional[str], site_id: str) -> Optional[str]:
+    """
+    Raíz local de un sitio: <sites_root>/<site_id>
+
+    None si no hay raíz configurada o el sitio no tiene directorio: en
+    ese caso nada de ese sitio se lee ni se escribe en el disco del servidor.
+    """
+    if not sites_root:
+        return None
+    root = resolve_in_root(sites_root, site_id)
+    if root is None or root == os.path.realpath(sites_root) or not os.path.isdir(root):
+        return None
+    return root
@@ -0,0 +1,204 @@
+"""
+Trazas ligeras por petición: un span por etapa de los caminos calientes
+
+Modelo compatible con OpenTelemetry (sin depender de él):
+- trace_id de 16 bytes y span_id de 8, propagados con la cabecera W3C
+  `traceparent` (si el cliente la envía, la traza continúa la suya)
+- tiempos en nanosegundos, atributos planos y exportadores con la misma
+  interfaz que los del SDK (export(spans) / shutdown()); InMemorySpanExporter
+  sirve para pruebas
+
+Sin exportadores ni Server-Timing no se crea nada: span() solo comprueba
+una contextvar.
+"""
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence
+
+_TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+MAX_SPANS = 128  # Spans de etapa guardados por traza; el resto solo suma en los totales
+
+
+class SpanContext:
+    __slots__ = ('trace_id', 'span_id')
+
+    def __init__(self, trace_id: int, span_id: int):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+
+class Span:
+    """Span terminado o en curso (atributos como los de ReadableSpan del SDK)"""
+
+    __slots__ = ('name', 'context', 'parent', 'start_time', 'end_time', 'attributes')
+
+    def __init__(self, name: str, context: SpanContext, parent: Optional[SpanContext]):
+        self.name = name
+        self.context = context
+        self.parent = parent
+        self.start_time = time.time_ns()
+        self.end_time: Optional[int] = None
+        self.attributes: Dict[str, object] = {}
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_time or time.time_ns()) - self.start_time) / 1e6
+
+    def to_dict(self) -> Dict:
+        return {
+            'name': self.name,
+            'trace_id': f"{self.context.trace_id:032x}",
+            'span_id': f"{self.context.span_id:016x}",
+            'parent_id': f"{self.parent.span_id:016x}" if self.parent else None,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'attributes': dict(self.attributes)
+        }
+
+
+class RequestTrace:
+    """
+    Spans de una petición: el raíz y uno por etapa (las etapas cuelgan del raíz)
+
+    Una petición con miles de etapas (p.ej. un span por miembro de un
+    archivo comprimido) guarda solo los MAX_SPANS primeros; los tiempos
+    de todas se suman por etapa, para Server-Timing y como atributos del
+    raíz al exportar.
+    """
+
+    def __init__(self, name: str, traceparent: Optional[str] = None):
+        parent = None
+        trace_id = None
+        match = _TRACEPARENT.match(traceparent or '')
+        if match:
+            trace_id = int(match.group(1), 16)
+            parent = SpanContext(trace_id, int(match.group(2), 16))
+        self.root = Span(name, SpanContext(trace_id or _random_id(16), _random_id(8)), parent)
+        self.spans: List[Span] = []  # Etapas terminadas (como mucho MAX_SPANS)
+        self.totals: Dict[str, List[float]] = {}  # Etapa -> [ms, repeticiones], de todas
+        self.dropped = 0
+        self.token = None
+        self._lock = threading.Lock()  # Las etapas pueden terminar en hilos (asyncio.to_thread)
+
+    def add(self, span: Span):
+        """Registrar una etapa terminada"""
+        with self._lock:
+            total = self.totals.get(span.name)
+            if total is None:
+                total = self.totals[span.name] = [0.0, 0]
+            total[0] += span.duration_ms
+            total[1] += 1
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    def finish(self):
+        self.root.end_time = time.time_ns()
+        if self.dropped:
+            self.root.set_attribute('spans.dropped', self.dropped)
+            with self._lock:
+                for name, (ms, count) in self.totals.items():
+                    self.root.set_attribute(f"stage.{name}.duration_ms", round(ms, 3))
+                    self.root.set_attribute(f"stage.{name}.count", count)
+
+    def server_timing(self) -> str:
+        """Valor de la cabecera Server-Timing: etapa;dur=ms, sumando repeticiones"""
+        with self._lock:
+            totals = {name: ms for name, (ms, _) in self.totals.items()}
+        totals['total'] = self.root.duration_ms
+        return ', '.join(f"{name};dur={ms:.2f}" for name, ms in totals.items())
+
+
+class InMemorySpanExporter:
+    """Exportador que guarda los spans en memoria (pruebas y depuración)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans: List[Span] = []
+
+    def export(self, spans: Sequence[Span]) -> bool:
+        with self._lock:
+            self._spans.extend(spans)
+        return True
+
+    def get_finished_spans(self) -> List[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        with self._lock:
+            self._spans = []
+
+    def shutdown(self):
+        self.clear()
+
+
+_current: ContextVar[Optional[RequestTrace]] = ContextVar('spamguard_trace', default=None)
+_exporters: List = []
+
+
+def _random_id(size: int) -> int:
+    return int.from_bytes(os.urandom(size), 'big') or 1
+
+
+def add_exporter(exporter):
+    """Registrar un exportador (export(spans) / shutdown())"""
+    _exporters.append(exporter)
+
+
+def remove_exporter(exporter):
+    _exporters.remove(exporter)
+
+
+def has_exporters() -> bool:
+    return bool(_exporters)
+
+
+def start_trace(name: str, traceparent: Optional[str] = None) -> RequestTrace:
+    """Empezar la traza de una petición (en el middleware)"""
+    trace = RequestTrace(name, traceparent)
+    trace.token = _current.set(trace)
+    return trace
+
+
+def end_trace(trace: RequestTrace):
+    """Cerrar la traza y entregar sus spans a los exportadores"""
+    trace.finish()
+    _current.reset(trace.token)
+    if _exporters:
+        spans = [trace.root, *trace.spans]
+        for exporter in _exporters:
+            exporter.export(spans)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str):
+    """
+    Span de una etapa dentro de la traza en curso (no-op si no hay traza)
+
+    Funciona también en hilos lanzados con asyncio.to_thread o con las
+    dependencias síncronas de FastAPI, que copian el contexto.
+    """
+    trace = _current.get()
+    if trace is None:
+        yield None
+        return
+    current = Span(name, SpanContext(trace.root.context.trace_id, _random_id(8)), trace.root.context)
+    try:
+        yield current
+    finally:
+        current.end_time = time.time_ns()
+        trace.add(current)
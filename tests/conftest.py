@@ -0,0 +1,293 @@
+"""
+Configuración común de los tests
+
+- Variables de entorno mínimas para importar la app (sin conexión real)
+- FakeSupabase: tablas en memoria con el subconjunto de PostgREST que usan
+  las rutas (filtros, or_(), orden, límites, count, update/insert/upsert/delete)
+"""
+import copy
+import os
+import re
+import uuid
+from collections import defaultdict
+
+import pytest
+
+os.environ.setdefault('SUPABASE_URL', 'http://localhost:54321')
+os.environ.setdefault('SUPABASE_KEY', 'test.test.test')
+os.environ.setdefault('SUPABASE_SERVICE_KEY', 'test.test.test')
+
+# Orden de los enums de Postgres (severity se ordena por gravedad, no alfabéticamente)
+ENUM_ORDER = {'severity': ['low', 'medium', 'high', 'critical']}
+
+
+class _Result:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+def _sort_key(column, value):
+    if column in ENUM_ORDER and value in ENUM_ORDER[column]:
+        return ENUM_ORDER[column].index(value)
+    return value
+
+
+def _compare(column, op, value, expected):
+    if op == 'is':
+        return (value is None) if expected in (None, 'null') else value == expected
+    if op == 'eq':
+        return value is not None and str(value) == str(expected) if isinstance(expected, str) else value == expected
+    if op == 'neq':
+        return value is not None and not _compare(column, 'eq', value, expected)
+    if op == 'in':
+        return value in expected
+    if op == 'like':
+        return value is not None and _like(expected).fullmatch(str(value)) is not None
+    if value is None:
+        return False
+    left, right = _sort_key(column, value), _sort_key(column, expected)
+    if isinstance(left, int) and isinstance(right, str) and column not in ENUM_ORDER:
+        right = int(right)
+    return {
+        'gt': left > right,
+        'gte': left >= right,
+        'lt': left < right,
+        'lte': left <= right,
+    }[op]
+
+
+def _like(pattern):
+    out = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern):
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        out.append('.*' if char == '%' else '.' if char == '_' else re.escape(char))
+        i += 1
+    return re.compile(''.join(out), re.DOTALL)
+
+
+def _split_top_level(expression):
+    parts, depth, current = [], 0, ''
+    for char in expression:
+        if char == ',' and depth == 0:
+            parts.append(current)
+            current = ''
+            continue
+        depth += char == '('
+        depth -= char == ')'
+        current += char
+    parts.append(current)
+    return parts
+
+
+def _or_filter(expression):
+    """Filtro de PostgREST or=(...) (con and(...) anidados)"""
+    def term(text):
+        for combinator, combine in (('and(', all), ('or(', any)):
+            if text.startswith(combinator):
+                terms = [term(t) for t in _split_top_level(text[len(combinator):-1])]
+                return lambda row: combine(t(row) for t in terms)
+        column, op, value = text.split('.', 2)
+        return lambda row: _compare(column, op, row.get(column), value)
+
+    terms = [term(t) for t in _split_top_level(expression)]
+    return lambda row: any(t(row) for t in terms)
+
+
+class _Negate:
+    def __init__(self, query):
+        self._query = query
+
+    def is_(self, column, value):
+        return self._query._filter(lambda row: not _compare(column, 'is', row.get(column), value))
+
+
+class _Query:
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.action = 'select'
+        self.payload = None
+        self.columns = '*'
+        self.count_mode = None
+        self.returning = 'representation'
+        self.filters = []
+        self.orders = []
+        self.limit_value = None
+        self.offset = 0
+        self.single_row = False
+        self.on_conflict = None
+        self.ignore_duplicates = False
+
+    # --- Acciones ---
+
+    def select(self, columns='*', count=None):
+        self.columns, self.count_mode = columns, count
+        return self
+
+    def update(self, data, count=None, returning='representation'):
+        self.action, self.payload, self.count_mode, self.returning = 'update', data, count, returning
+        return self
+
+    def insert(self, rows, count=None, returning='representation'):
+        self.action, self.payload, self.returning = 'insert', rows, returning
+        return self
+
+    def upsert(self, rows, on_conflict=None, ignore_duplicates=False, returning='representation'):
+        self.action, self.payload, self.returning = 'upsert', rows, returning
+        self.on_conflict, self.ignore_duplicates = on_conflict, ignore_duplicates
+        return self
+
+    def delete(self, count=None, returning='representation'):
+        self.action, self.count_mode, self.returning = 'delete', count, returning
+        return self
+
+    # --- Filtros ---
+
+    def _filter(self, predicate):
+        self.filters.append(predicate)
+        return self
+
+    def eq(self, column, value):
+        return self._filter(lambda row: _compare(column, 'eq', row.get(column), value))
+
+    def neq(self, column, value):
+        return self._filter(lambda row: _compare(column, 'neq', row.get(column), value))
+
+    def gt(self, column, value):
+        return self._filter(lambda row: _compare(column, 'gt', row.get(column), value))
+
+    def gte(self, column, value):
+        return self._filter(lambda row: _compare(column, 'gte', row.get(column), value))
+
+    def lt(self, column, value):
+        return self._filter(lambda row: _compare(column, 'lt', row.get(column), value))
+
+    def lte(self, column, value):
+        return self._filter(lambda row: _compare(column, 'lte', row.get(column), value))
+
+    def in_(self, column, values):
+        values = list(values)
+        return self._filter(lambda row: _compare(column, 'in', row.get(column), values))
+
+    def like(self, column, pattern):
+        return self._filter(lambda row: _compare(column, 'like', row.get(column), pattern))
+
+    def is_(self, column, value):
+        return self._filter(lambda row: _compare(column, 'is', row.get(column), value))
+
+    @property
+    def not_(self):
+        return _Negate(self)
+
+    def or_(self, expression):
+        return self._filter(_or_filter(expression))
+
+    # --- Orden y paginación ---
+
+    def order(self, column, desc=False):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, n):
+        self.limit_value = n
+        return self
+
+    def range(self, start, end):
+        self.offset, self.limit_value = start, end - start + 1
+        return self
+
+    def single(self):
+        self.single_row = True
+        return self
+
+    # --- Ejecución ---
+
+    def _matching(self):
+        rows = [row for row in self.db.tables[self.table] if all(f(row) for f in self.filters)]
+        for column, desc in reversed(self.orders):
+            rows.sort(key=lambda row: (row.get(column) is None, _sort_key(column, row.get(column))), reverse=desc)
+        return rows
+
+    def _project(self, row):
+        if self.columns.strip() == '*':
+            return copy.deepcopy(row)
+        out = {}
+        for column in (c.strip() for c in self.columns.split(',')):
+            alias, _, source = column.rpartition(':')
+            if '->' in source:
+                base, key = source.split('->', 1)
+                out[alias or key] = (row.get(base) or {}).get(key)
+            else:
+                out[alias or source] = copy.deepcopy(row.get(source))
+        return out
+
+    def execute(self):
+        self.db.calls.append((self.table, self.action))
+        if self.action in ('insert', 'upsert'):
+            return self._write()
+
+        rows = self._matching()
+        count = len(rows) if self.count_mode == 'exact' else None
+        if self.action == 'select':
+            end = None if self.limit_value is None else self.offset + self.limit_value
+            data = [self._project(row) for row in rows[self.offset:end]]
+            if self.single_row:
+                data = data[0] if data else None
+            return _Result(data, count)
+
+        if self.action == 'update':
+            for row in rows:
+                row.update(copy.deepcopy(self.payload))
+        else:
+            ids = {id(row) for row in rows}
+            self.db.tables[self.table] = [row for row in self.db.tables[self.table] if id(row) not in ids]
+        data = [] if self.returning == 'minimal' else copy.deepcopy(rows)
+        return _Result(data, len(rows) if self.count_mode == 'exact' else None)
+
+    def _write(self):
+        rows = self.payload if isinstance(self.payload, list) else [self.payload]
+        table = self.db.tables[self.table]
+        keys = (self.on_conflict or self.db.primary_keys.get(self.table, 'id')).split(',')
+        written = []
+        for row in copy.deepcopy(rows):
+            if self.action == 'insert' or not all(k in row for k in keys):
+                row.setdefault('id', str(uuid.uuid4()))
+                table.append(row)
+                written.append(row)
+                continue
+            existing = next((r for r in table if all(r.get(k) == row[k] for k in keys)), None)
+            if existing is None:
+                table.append(row)
+                written.append(row)
+            elif not self.ignore_duplicates:
+                existing.update(row)
+                written.append(existing)
+        return _Result([] if self.returning == 'minimal' else copy.deepcopy(written))
+
+
+class FakeSupabase:
+    """Cliente Supabase en memoria: db.tables['threats'] es una lista de filas (dict)"""
+
+    def __init__(self, primary_keys=None):
+        self.tables = defaultdict(list)
+        self.primary_keys = {'file_verdicts': 'sha256', 'signature_versions': 'version', **(primary_keys or {})}
+        self.calls = []
+
+    def table(self, name):
+        return _Query(self, name)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """FakeSupabase sustituyendo al cliente de las rutas del antivirus"""
+    from app.api import routes_antivirus
+
+    db = FakeSupabase()
+    monkeypatch.setattr(routes_antivirus, 'supabase', db)
+    return db
@@ -0,0 +1,152 @@
+"""
+Lectura en streaming de tar/zip y límites del archivo (ArchiveBudget)
+"""
+import asyncio
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+from app.modules.antivirus.archive import (
+    ArchiveBudget, ArchiveLimitExceeded, MemberTooLarge, StreamBridge, iter_archive_members
+)
+
+
+class _Stream(io.BytesIO):
+    """Cuerpo ya recibido entero, con el unread() de StreamBridge"""
+
+    def unread(self, data: bytes):
+        self.seek(-len(data), io.SEEK_CUR)
+
+
+class _NoSeek(io.RawIOBase):
+    """Destino sin seek: zipfile escribe data descriptors (tamaño desconocido)"""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+def _make_zip(members, streamed=False) -> bytes:
+    target = _NoSeek() if streamed else io.BytesIO()
+    with zipfile.ZipFile(target, 'w') as archive:
+        for name, data, method in members:
+            info = zipfile.ZipInfo(name)
+            info.compress_type = method
+            if streamed:
+                with archive.open(info, 'w') as f:
+                    f.write(data)
+            else:
+                archive.writestr(info, data)
+    return (target.buffer if streamed else target).getvalue()
+
+
+def _make_tar(members, mode='w:gz') -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as archive:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def _read_all(stream, **kwargs):
+    return [(name, f.read()) for name, _, _, f in iter_archive_members(stream, **kwargs)]
+
+
+def test_zip_members_are_read_in_order():
+    data = _make_zip([
+        ('a.php', b'<?php echo 1;', zipfile.ZIP_STORED),
+        ('dir/b.php', b'<?php echo 2;' * 100, zipfile.ZIP_DEFLATED),
+    ])
+    assert _read_all(_Stream(data)) == [('a.php', b'<?php echo 1;'), ('dir/b.php', b'<?php echo 2;' * 100)]
+
+
+def test_zip_members_with_data_descriptor_are_read():
+    data = _make_zip([
+        ('a.php', b'<?php echo 1;', zipfile.ZIP_DEFLATED),
+        ('b.php', b'<?php echo 2;' * 100, zipfile.ZIP_DEFLATED),
+    ], streamed=True)
+    assert _read_all(_Stream(data)) == [('a.php', b'<?php echo 1;'), ('b.php', b'<?php echo 2;' * 100)]
+
+
+def test_unread_members_are_skipped():
+    data = _make_zip([
+        ('a.php', b'x' * 100000, zipfile.ZIP_DEFLATED),
+        ('b.php', b'second', zipfile.ZIP_DEFLATED),
+    ], streamed=True)
+    names = [name for name, _, _, _ in iter_archive_members(_Stream(data))]
+    assert names == ['a.php', 'b.php']
+
+
+def test_tar_gz_members_are_read():
+    data = _make_tar([('a.php', b'<?php echo 1;'), ('b.txt', b'hola')])
+    assert _read_all(_Stream(data), archive_format='tar') == [('a.php', b'<?php echo 1;'), ('b.txt', b'hola')]
+
+
+def test_member_limit_stops_the_archive():
+    data = _make_zip([(f'{i}.php', b'x', zipfile.ZIP_STORED) for i in range(5)])
+    with pytest.raises(ArchiveLimitExceeded):
+        _read_all(_Stream(data), budget=ArchiveBudget(max_members=3))
+
+
+def test_zip_bomb_is_cut_while_inflating():
+    data = _make_zip([('bomb.txt', b'\0' * (20 * 1024 * 1024), zipfile.ZIP_DEFLATED)], streamed=True)
+    assert len(data) < 100 * 1024
+    budget = ArchiveBudget(max_total_bytes=1024 * 1024)
+    with pytest.raises(ArchiveLimitExceeded):
+        _read_all(_Stream(data), budget=budget)
+    assert budget.total_bytes <= 1024 * 1024 + 64 * 1024
+
+
+def test_skipped_tar_members_count_against_the_budget():
+    data = _make_tar([('big.bin', b'\0' * 200000), ('a.php', b'x')])
+    budget = ArchiveBudget(max_total_bytes=100000)
+    with pytest.raises(ArchiveLimitExceeded):
+        list(iter_archive_members(_Stream(data), 'tar', budget))
+
+
+def test_oversized_member_with_unknown_size_fails_alone():
+    data = _make_zip([
+        ('big.php', b'a' * 300000, zipfile.ZIP_DEFLATED),
+        ('small.php', b'<?php echo 1;', zipfile.ZIP_DEFLATED),
+    ], streamed=True)
+    members = iter_archive_members(_Stream(data), max_member_size=100000)
+
+    name, size, _, f = next(members)
+    assert (name, size) == ('big.php', None)
+    with pytest.raises(MemberTooLarge):
+        f.read()
+
+    name, _, _, f = next(members)
+    assert (name, f.read()) == ('small.php', b'<?php echo 1;')
+
+
+def test_stream_bridge_feeds_a_worker_thread():
+    data = _make_zip([(f'{i}.php', b'<?php echo %d;' % i, zipfile.ZIP_DEFLATED) for i in range(20)], streamed=True)
+
+    async def run():
+        bridge = StreamBridge(asyncio.get_running_loop(), max_chunks=2)
+
+        async def feed():
+            for i in range(0, len(data), 100):
+                await bridge.feed(data[i:i + 100])
+            await bridge.close_feed()
+
+        # Como en /scan/archive: el directorio central no se lee y el resto del cuerpo se abandona
+        feeder = asyncio.create_task(feed())
+        try:
+            return await asyncio.to_thread(_read_all, bridge)
+        finally:
+            feeder.cancel()
+
+    members = asyncio.run(run())
+    assert [name for name, _ in members] == [f'{i}.php' for i in range(20)]
+    assert members[7][1] == b'<?php echo 7;'
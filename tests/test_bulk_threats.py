@@ -0,0 +1,101 @@
+"""
+Cambios de estado en bloque: por ids o por filtro, sin sacar nada de cuarentena
+"""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.api import routes_antivirus as routes
+from app.api.routes_antivirus import BulkThreatUpdate, ThreatFilter
+
+
+@pytest.fixture
+def threats(fake_db):
+    rows = [
+        ('t01', 'wp-content/uploads/a.php', 'Eval with Base64', 'active'),
+        ('t02', 'wp-content/uploads/b.php', 'Eval with Base64', 'active'),
+        ('t03', 'wp-content/uploads/c.php', 'Eval with Base64', 'quarantined'),
+        ('t04', 'wp-content/uploads_old/d.php', 'Eval with Base64', 'active'),
+        ('t05', 'wp-content/uploads/e.php', 'File upload shell', 'active'),
+        ('t06', 'wp-content/100%/f.php', 'Eval with Base64', 'active'),
+        ('t07', 'wp-content/100x/g.php', 'Eval with Base64', 'active'),
+    ]
+    for threat_id, path, signature, status in rows:
+        fake_db.tables['threats'].append({
+            'id': threat_id, 'scan_id': 'scan-1', 'site_id': 'site-1', 'file_path': path,
+            'signature_matched': signature, 'status': status, 'file_sha256': None
+        })
+    fake_db.tables['threats'].append({
+        'id': 't99', 'scan_id': 'scan-1', 'site_id': 'site-2', 'file_path': 'wp-content/uploads/a.php',
+        'signature_matched': 'Eval with Base64', 'status': 'active', 'file_sha256': None
+    })
+    return fake_db
+
+
+def _statuses(db):
+    return {row['id']: row['status'] for row in db.tables['threats']}
+
+
+def _set(update, status):
+    return asyncio.run(routes._bulk_set_status('site-1', update, status))
+
+
+def test_filter_by_signature_and_literal_path_prefix(threats):
+    update = BulkThreatUpdate(filter=ThreatFilter(
+        scan_id='scan-1', signature='Eval with Base64', path_prefix='wp-content/uploads/'
+    ))
+
+    assert _set(update, 'ignored') == {'updated': 2, 'skipped_quarantined': 1}
+
+    statuses = _statuses(threats)
+    assert [i for i, s in statuses.items() if s == 'ignored'] == ['t01', 't02']
+    assert statuses['t03'] == 'quarantined'
+    assert statuses['t04'] == 'active'  # '_' del prefijo no es comodín
+    assert statuses['t99'] == 'active'  # otro sitio
+
+
+def test_percent_in_prefix_is_not_a_wildcard(threats):
+    update = BulkThreatUpdate(filter=ThreatFilter(scan_id='scan-1', path_prefix='wp-content/100%'))
+
+    assert _set(update, 'resolved')['updated'] == 1
+    assert _statuses(threats)['t06'] == 'resolved'
+    assert _statuses(threats)['t07'] == 'active'
+
+
+def test_threat_ids_never_leave_quarantine(threats):
+    update = BulkThreatUpdate(threat_ids=['t01', 't03', 't99'])
+
+    assert _set(update, 'active') == {'updated': 0, 'skipped_quarantined': 1}
+    assert _set(update, 'resolved') == {'updated': 1, 'skipped_quarantined': 1}
+    assert _statuses(threats)['t03'] == 'quarantined'
+    assert _statuses(threats)['t99'] == 'active'
+
+
+def test_ids_and_filter_are_mutually_exclusive(threats):
+    for update in (
+        BulkThreatUpdate(),
+        BulkThreatUpdate(threat_ids=['t01'], filter=ThreatFilter(scan_id='scan-1')),
+    ):
+        with pytest.raises(HTTPException) as error:
+            _set(update, 'ignored')
+        assert error.value.status_code == 400
+
+
+def test_bulk_quarantine_pages_and_updates_by_id(threats, monkeypatch, tmp_path):
+    from app.modules.antivirus.quarantine import QuarantineStore
+
+    monkeypatch.setattr(routes, 'QUARANTINE_PAGE_SIZE', 2)
+    monkeypatch.setattr(routes, 'QUARANTINE_ID_BATCH', 2)
+    monkeypatch.setattr(routes, 'get_quarantine_store', lambda: QuarantineStore(str(tmp_path)))
+    update = BulkThreatUpdate(filter=ThreatFilter(scan_id='scan-1', signature='Eval with Base64'))
+
+    counts = _set(update, 'quarantined')
+
+    assert counts['updated'] == counts['quarantined'] == 5
+    assert counts['without_content'] == 5  # escaneo no local: no se lee el disco
+    statuses = _statuses(threats)
+    assert sorted(i for i, s in statuses.items() if s == 'quarantined') == ['t01', 't02', 't03', 't04', 't06', 't07']
+    assert statuses['t05'] == 'active' and statuses['t99'] == 'active'
+    selects = [call for call in threats.calls if call == ('threats', 'select')]
+    assert len(selects) == 3  # 5 filas activas en páginas de 2
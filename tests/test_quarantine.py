@@ -0,0 +1,146 @@
+"""
+Cuarentena: blobs deduplicados por contenido, restauración verificada y
+archivos locales confinados a los escaneos locales del sitio
+"""
+import asyncio
+import hashlib
+import io
+import os
+import zlib
+
+import pytest
+
+from app.api import routes_antivirus as routes
+from app.config import get_settings
+from app.modules.antivirus.quarantine import QuarantineStore
+
+WEBSHELL = b'<?php eval(base64_decode($_POST["x"])); ?>'
+SHA = hashlib.sha256(WEBSHELL).hexdigest()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return QuarantineStore(str(tmp_path / 'quarantine'))
+
+
+def _blobs(store):
+    return sorted(store.root.glob('*/*.z'))
+
+
+def test_same_content_is_stored_once(store, tmp_path):
+    for name in ('a.php', 'b.php'):
+        (tmp_path / name).write_bytes(WEBSHELL)
+
+    assert store.put_file(str(tmp_path / 'a.php')) == (SHA, len(WEBSHELL))
+    assert store.put_file(str(tmp_path / 'b.php'), SHA) == (SHA, len(WEBSHELL))
+    assert store.put_fileobj(io.BytesIO(WEBSHELL)) == (SHA, len(WEBSHELL))
+    assert _blobs(store) == [store.blob_path(SHA)]
+    assert not list(store.root.glob('.incoming-*'))
+
+
+def test_changed_file_is_stored_under_its_real_hash(store, tmp_path):
+    store.put_fileobj(io.BytesIO(WEBSHELL))
+    (tmp_path / 'a.php').write_bytes(b'<?php echo 1;')
+
+    sha256, _ = store.put_file(str(tmp_path / 'a.php'), SHA)
+
+    assert sha256 == hashlib.sha256(b'<?php echo 1;').hexdigest()
+    assert len(_blobs(store)) == 2
+
+
+def test_restore_writes_the_original_content(store, tmp_path):
+    store.put_fileobj(io.BytesIO(WEBSHELL))
+    dest = tmp_path / 'site' / 'wp-content' / 'shell.php'
+
+    assert store.restore(SHA, str(dest)) == len(WEBSHELL)
+    assert dest.read_bytes() == WEBSHELL
+
+
+def test_restore_rejects_a_corrupt_blob(store, tmp_path):
+    store.put_fileobj(io.BytesIO(WEBSHELL))
+    store.blob_path(SHA).write_bytes(zlib.compress(b'something else'))
+    dest = tmp_path / 'shell.php'
+    dest.write_bytes(b'current')
+
+    with pytest.raises(ValueError):
+        store.restore(SHA, str(dest))
+    assert dest.read_bytes() == b'current'
+    assert [p.name for p in tmp_path.iterdir() if p.name.startswith('.shell.php')] == []
+
+
+def test_quarantine_files_only_touches_local_paths(store, tmp_path):
+    local, remote = tmp_path / 'local.php', tmp_path / 'remote.php'
+    local.write_bytes(WEBSHELL)
+    remote.write_bytes(WEBSHELL)
+    threats = [
+        {'id': 't1', 'file_path': 'local.php', 'file_sha256': SHA},
+        {'id': 't2', 'file_path': 'local.php', 'file_sha256': SHA},
+        {'id': 't3', 'file_path': str(remote), 'file_sha256': SHA},
+    ]
+
+    assert store.quarantine_files(threats[2:]) == {None: threats[2:]}
+    assert remote.exists() and not _blobs(store)
+
+    by_blob = store.quarantine_files(threats, {'t1': str(local), 't2': str(local)})
+
+    assert by_blob == {SHA: threats}  # t3 reutiliza el blob ya guardado desde t1
+    assert not local.exists()
+    assert remote.exists()
+
+
+def test_prune_removes_least_recently_seen_blobs(store):
+    first, _ = store.put_fileobj(io.BytesIO(b'a' * 1000))
+    second, _ = store.put_fileobj(io.BytesIO(WEBSHELL))
+    stat = store.blob_path(first).stat()
+    os.utime(store.blob_path(second), (stat.st_atime - 100, stat.st_mtime - 100))
+
+    assert store.prune(store.blob_path(first).stat().st_size) == 1
+    assert store.has(first) and not store.has(second)
+
+
+@pytest.fixture
+def site(fake_db, store, tmp_path, monkeypatch):
+    sites_root = tmp_path / 'sites'
+    (sites_root / 'site-1' / 'wp-content').mkdir(parents=True)
+    (sites_root / 'site-1' / 'wp-content' / 'shell.php').write_bytes(WEBSHELL)
+    (tmp_path / 'outside.php').write_bytes(WEBSHELL)
+    monkeypatch.setattr(get_settings(), 'scan_sites_root', str(sites_root))
+    monkeypatch.setattr(routes, 'get_quarantine_store', lambda: store)
+
+    fake_db.tables['scans'] += [
+        {'id': 'local', 'site_id': 'site-1', 'options': {'path': '.'}},
+        {'id': 'manifest', 'site_id': 'site-1', 'options': None},
+    ]
+    return sites_root / 'site-1'
+
+
+def _threat(fake_db, threat_id, scan_id, file_path):
+    row = {'id': threat_id, 'scan_id': scan_id, 'site_id': 'site-1', 'file_path': file_path,
+           'file_sha256': SHA, 'status': 'active'}
+    fake_db.tables['threats'].append(row)
+    return dict(row)
+
+
+def test_local_paths_only_for_local_scans_inside_the_site_root(site, fake_db):
+    threats = [
+        _threat(fake_db, 't1', 'local', 'wp-content/shell.php'),
+        _threat(fake_db, 't2', 'local', '../../outside.php'),
+        _threat(fake_db, 't3', 'manifest', 'wp-content/shell.php'),
+    ]
+
+    assert routes._local_threat_paths('site-1', threats) == {
+        't1': str((site / 'wp-content' / 'shell.php').resolve())
+    }
+
+
+def test_quarantine_threats_updates_only_selected_rows(site, fake_db, store):
+    threat = _threat(fake_db, 't1', 'local', 'wp-content/shell.php')
+    _threat(fake_db, 't2', 'manifest', 'wp-content/shell.php')
+
+    counts = asyncio.run(routes._quarantine_threats('site-1', [threat]))
+
+    assert counts == {'quarantined': 1, 'blobs': 1, 'without_content': 0}
+    assert not (site / 'wp-content' / 'shell.php').exists()
+    rows = {row['id']: row for row in fake_db.tables['threats']}
+    assert rows['t1']['status'] == 'quarantined' and rows['t1']['quarantine_blob'] == SHA
+    assert rows['t2']['status'] == 'active'
@@ -0,0 +1,145 @@
+"""
+Reescaneo diferencial: qué firmas se pasan, qué amenazas se olvidan y qué veredictos se tocan
+"""
+import asyncio
+import io
+
+import pytest
+
+from app.modules.antivirus.quarantine import QuarantineStore
+from app.modules.antivirus.rescan import DifferentialRescanner, RescanScheduler
+from app.modules.antivirus.signatures import CompiledSignatures
+from app.modules.antivirus.verdicts import ENGINE_VERSION, verdict_version
+from tests.conftest import FakeSupabase
+
+_diff = DifferentialRescanner._diff
+
+WEBSHELL = b'<?php system($_GET["cmd"]); ?>'
+SYSTEM = {'name': 'System execution', 'pattern': r'system\s*\(\s*\$_GET', 'severity': 'critical'}
+EVAL = {'name': 'Eval with Base64', 'pattern': r'eval\s*\(\s*base64_decode', 'severity': 'critical'}
+
+
+def test_diff_runs_new_and_modified_signatures():
+    changed, stale = _diff({'a': '1', 'b': '2'}, {'a': '1', 'b': '3', 'c': '4'})
+    assert changed == {'b', 'c'}
+    assert stale == {'b', 'c'}
+
+
+def test_diff_drops_threats_of_signatures_no_longer_defined():
+    changed, stale = _diff({'a': '1', 'gone': '2'}, {'a': '1'})
+    assert changed == set()
+    assert stale == {'gone'}
+
+
+def test_diff_keeps_threats_of_signatures_rejected_by_vetting():
+    # 'slow' sigue en los archivos de firmas pero este proceso la descartó al vetarla
+    changed, stale = _diff({'a': '1', 'slow': '2'}, {'a': '1', 'slow': None})
+    assert changed == set()
+    assert stale == set()
+
+
+def test_diff_runs_a_signature_that_was_rejected_before():
+    changed, stale = _diff({'a': '1', 'slow': None}, {'a': '1', 'slow': '2'})
+    assert changed == {'slow'}
+    assert stale == {'slow'}
+
+
+class _Manager:
+    def __init__(self, compiled):
+        self.compiled = compiled
+
+    def get_compiled(self):
+        return self.compiled
+
+
+@pytest.fixture
+def setup(tmp_path):
+    db = FakeSupabase()
+    store = QuarantineStore(str(tmp_path))
+    sha256, _ = store.put_fileobj(io.BytesIO(WEBSHELL))
+
+    old = CompiledSignatures([EVAL], 'old')
+    newer = CompiledSignatures([EVAL, SYSTEM, {**SYSTEM, 'name': 'Other'}], 'newer')
+    current = CompiledSignatures([EVAL, SYSTEM], 'current')
+    rows = [
+        {'version': 'old', 'fingerprints': old.fingerprints, 'created_at': '2026-01-01T00:00:00'},
+        {'version': 'current', 'fingerprints': current.fingerprints, 'created_at': '2026-02-01T00:00:00'},
+        {'version': 'newer', 'fingerprints': newer.fingerprints, 'created_at': '2026-03-01T00:00:00'},
+    ]
+    db.tables['signature_versions'] += rows
+    rescanner = DifferentialRescanner(db, _Manager(current), store)
+    return db, rescanner, sha256
+
+
+def _verdict(sha256, version, threats):
+    return {
+        'sha256': sha256, 'signature_version': version, 'verdict': 'malicious' if threats else 'clean',
+        'threats': threats, 'suspicious_functions': []
+    }
+
+
+def test_run_once_rescans_older_versions_with_new_signatures_only(setup):
+    db, rescanner, sha256 = setup
+    db.tables['file_verdicts'].append(_verdict(sha256, verdict_version('old'), []))
+    db.tables['site_files'].append({'site_id': 'site-1', 'file_path': 'shell.php', 'sha256': sha256})
+
+    stats = rescanner.run_once()
+
+    assert stats['checked'] == 1 and stats['rules_run'] == 1 and stats['new_threats'] == 1
+    row = db.tables['file_verdicts'][0]
+    assert row['signature_version'] == verdict_version('current')
+    assert [t['signature'] for t in row['threats']] == ['System execution']
+    threat = db.tables['threats'][0]
+    assert (threat['site_id'], threat['file_path'], threat['signature_matched']) == ('site-1', 'shell.php', 'System execution')
+
+
+def test_run_once_leaves_newer_and_unregistered_versions_alone(setup):
+    db, rescanner, sha256 = setup
+    threats = [{'signature': 'Other', 'severity': 'critical', 'code_snippet': ''}]
+    db.tables['file_verdicts'] += [
+        _verdict(sha256, verdict_version('newer'), threats),
+        _verdict('f' * 64, verdict_version('unregistered'), threats),
+        _verdict('e' * 64, f"old+e{ENGINE_VERSION + 1}", threats),
+    ]
+    before = [dict(row) for row in db.tables['file_verdicts']]
+
+    stats = rescanner.run_once()
+
+    assert stats['not_older'] == 3 and stats['checked'] == 0
+    assert db.tables['file_verdicts'] == before
+    assert not db.tables['threats']
+
+
+def test_run_once_pages_past_skipped_verdicts(setup):
+    db, rescanner, _ = setup
+    rescanner.batch_size = 2
+    for i in range(3):
+        db.tables['file_verdicts'].append(_verdict(f'{i:064x}', verdict_version('newer'), []))
+
+    first, second, third = rescanner.run_once(), rescanner.run_once(), rescanner.run_once()
+
+    assert (first['more'], first['not_older']) == (True, 2)
+    assert (second['more'], second['not_older']) == (False, 1)
+    assert third['not_older'] == 2  # Vuelta nueva desde el principio
+
+
+def test_scheduler_pauses_between_batches():
+    class _Busy:
+        store = None
+
+        def __init__(self):
+            self.runs = 0
+
+        def run_once(self):
+            self.runs += 1
+            return {'more': True}
+
+    async def run():
+        rescanner = _Busy()
+        scheduler = RescanScheduler(rescanner, interval=60, batch_pause=0.05)
+        await scheduler.start()
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+        return rescanner.runs
+
+    assert 2 <= asyncio.run(run()) <= 6
@@ -0,0 +1,138 @@
+"""
+Leases de escaneo: toma atómica, renovación, pérdida del lease y recuperación
+"""
+import asyncio
+from datetime import datetime, timedelta
+
+from app.api import routes_antivirus as routes
+from app.modules.antivirus.jobs import ScanJob, ScanScheduler, worker_id
+
+
+def _scan(scan_id, status='pending', lease_owner=None, lease_expires_at=None, options=None):
+    return {
+        'id': scan_id,
+        'site_id': 'site-1',
+        'scan_type': 'quick',
+        'status': status,
+        'progress': 40,
+        'started_at': '2026-01-01T00:00:00',
+        'options': {'paths': None, 'max_size_mb': 10} if options is None else options,
+        'lease_owner': lease_owner,
+        'lease_expires_at': lease_expires_at
+    }
+
+
+def _iso(seconds):
+    return (datetime.utcnow() + timedelta(seconds=seconds)).isoformat()
+
+
+def test_claim_takes_a_pending_scan_only_once(fake_db):
+    fake_db.tables['scans'].append(_scan('s1'))
+    job = ScanJob('s1', 'site-1', {})
+
+    assert routes._claim_scan(job) is True
+    assert routes._claim_scan(job) is False
+
+    row = fake_db.tables['scans'][0]
+    assert row['status'] == 'running'
+    assert row['lease_owner'] == worker_id()
+    assert row['lease_expires_at'] > datetime.utcnow().isoformat()
+
+
+def test_renew_fails_when_another_process_owns_the_lease(fake_db):
+    fake_db.tables['scans'].append(_scan('s1', 'running', 'other-host:1:abcd', _iso(60)))
+    assert routes._renew_lease(ScanJob('s1', 'site-1', {})) is False
+
+    fake_db.tables['scans'][0]['lease_owner'] = worker_id()
+    assert routes._renew_lease(ScanJob('s1', 'site-1', {})) is True
+
+
+def test_recover_only_reclaims_expired_leases(fake_db, monkeypatch):
+    fake_db.tables['scans'] += [
+        _scan('alive', 'running', 'other:1:a', _iso(60)),
+        _scan('expired', 'running', 'other:2:b', _iso(-60)),
+        _scan('no-lease', 'running'),
+        dict(_scan('manifest', 'running'), options=None),
+        _scan('queued', 'pending'),
+    ]
+    submitted = []
+
+    class Scheduler:
+        def get_job(self, scan_id):
+            return None
+
+        async def submit(self, job):
+            submitted.append(job.scan_id)
+
+    monkeypatch.setattr(routes, 'scan_scheduler', Scheduler())
+    assert asyncio.run(routes.recover_scan_queue()) == 3
+
+    status = {row['id']: row['status'] for row in fake_db.tables['scans']}
+    assert status == {
+        'alive': 'running',
+        'expired': 'pending',
+        'no-lease': 'pending',
+        'manifest': 'running',
+        'queued': 'pending'
+    }
+    assert sorted(submitted) == ['expired', 'no-lease', 'queued']
+
+
+def test_scheduler_does_not_run_a_job_it_could_not_claim():
+    ran = []
+
+    async def run():
+        scheduler = ScanScheduler(runner=lambda job: ran.append(job.scan_id), claim=lambda job: False)
+        await scheduler.start()
+        await scheduler.submit(ScanJob('s1', 'site-1', {}))
+        await asyncio.sleep(0.05)
+        await scheduler.stop()
+
+    asyncio.run(run())
+    assert ran == []
+
+
+def test_lost_lease_stops_the_running_job():
+    renewals = []
+
+    async def runner(job):
+        while True:
+            job.check_cancelled()
+            await asyncio.sleep(0.01)
+
+    def renew(job):
+        renewals.append(job.scan_id)
+        return len(renewals) < 2
+
+    async def run():
+        scheduler = ScanScheduler(runner=runner, claim=lambda job: True, renew=renew, lease_seconds=0.06)
+        await scheduler.start()
+        job = ScanJob('s1', 'site-1', {})
+        await scheduler.submit(job)
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if scheduler.get_job('s1') is None:
+                break
+        await scheduler.stop()
+        return job
+
+    job = asyncio.run(run())
+    assert job.cancelled
+    assert len(renewals) == 2
+
+
+def test_reaper_recovers_periodically():
+    recovered = []
+
+    async def recover():
+        recovered.append(1)
+        return 0
+
+    async def run():
+        scheduler = ScanScheduler(runner=None, claim=lambda job: True, recover=recover, lease_seconds=0.02)
+        await scheduler.start()
+        await asyncio.sleep(0.11)
+        await scheduler.stop()
+
+    asyncio.run(run())
+    assert len(recovered) >= 3
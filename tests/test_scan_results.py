@@ -0,0 +1,72 @@
+"""
+Resultados de un escaneo: amenazas paginadas por (severidad, id) con cursor
+"""
+import asyncio
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+from app.api import routes_antivirus as routes
+
+SEVERITIES = ['low', 'critical', 'medium', 'high', 'critical', 'low', 'high', 'critical', 'medium', 'low']
+
+
+@pytest.fixture
+def scan(fake_db):
+    fake_db.tables['scans'].append({
+        'id': 'scan-1', 'site_id': 'site-1', 'status': 'completed', 'scan_type': 'full',
+        'started_at': '2026-01-01T00:00:00', 'completed_at': '2026-01-01T00:01:00',
+        'files_scanned': 10, 'threats_found': len(SEVERITIES)
+    })
+    for severity in SEVERITIES:
+        fake_db.tables['threats'].append({
+            'id': str(uuid.uuid4()), 'scan_id': 'scan-1', 'site_id': 'site-1',
+            'file_path': f'wp-content/{severity}.php', 'threat_type': 'malware', 'severity': severity,
+            'signature_matched': 'Eval with Base64', 'line_number': 1, 'code_snippet': 'eval(',
+            'detected_at': '2026-01-01T00:00:30'
+        })
+    return fake_db
+
+
+def _page(cursor=None, limit=3, severity=None):
+    return asyncio.run(routes.get_scan_results(
+        'scan-1', site_id='site-1', limit=limit, cursor=cursor, severity=severity, summary=False
+    ))
+
+
+def _all_pages(**kwargs):
+    threats, cursor, pages = [], None, 0
+    while True:
+        page = _page(cursor, **kwargs)
+        threats += page.threats
+        pages += 1
+        cursor = page.next_cursor
+        if cursor is None:
+            return threats, pages
+
+
+def test_pages_are_ordered_by_severity_then_id_without_gaps(scan):
+    threats, pages = _all_pages()
+    rank = {'critical': 0, 'high': 1, 'medium': 2, 'low': 3}
+    expected = sorted(scan.tables['threats'], key=lambda t: (rank[t['severity']], t['id']))
+
+    assert pages == 4
+    assert [t.id for t in threats] == [t['id'] for t in expected]
+    assert [t.severity for t in threats[:3]] == ['critical'] * 3
+
+
+def test_severity_filter_is_applied_with_the_cursor(scan):
+    threats, _ = _all_pages(limit=2, severity=['high', 'low'])
+    assert [t.severity for t in threats] == ['high', 'high', 'low', 'low', 'low']
+
+
+def test_last_page_has_no_cursor(scan):
+    assert _page(limit=len(SEVERITIES)).next_cursor is None
+
+
+@pytest.mark.parametrize('cursor', ['critical', 'critical:zz', "low:1),id.gt.(0", 'high:' + 'a' * 65])
+def test_malformed_cursor_is_rejected(scan, cursor):
+    with pytest.raises(HTTPException) as error:
+        _page(cursor)
+    assert error.value.status_code == 400
@@ -0,0 +1,51 @@
+"""
+Trazas por petición: spans acotados por traza y tiempos agregados por etapa
+"""
+import asyncio
+
+from app import tracing
+from app.tracing import InMemorySpanExporter, end_trace, span, start_trace
+
+
+def test_spans_per_trace_are_capped_but_totals_count_every_stage(monkeypatch):
+    monkeypatch.setattr(tracing, 'MAX_SPANS', 5)
+    exporter = InMemorySpanExporter()
+    tracing.add_exporter(exporter)
+    try:
+        trace = start_trace('POST /scan/archive')
+
+        async def scan_members():
+            def scan_member():
+                with span('scan_file'):
+                    pass
+            # Como en la ruta: cada miembro en un hilo que copia el contexto de la traza
+            for _ in range(50):
+                await asyncio.to_thread(scan_member)
+
+        asyncio.run(scan_members())
+        with span('db_write'):
+            pass
+        end_trace(trace)
+    finally:
+        tracing.remove_exporter(exporter)
+
+    assert len(trace.spans) == 5
+    assert trace.dropped == 46
+    assert trace.totals['scan_file'][1] == 50 and trace.totals['db_write'][1] == 1
+    assert trace.server_timing().startswith('scan_file;dur=')
+    assert 'db_write;dur=' in trace.server_timing()
+
+    exported = exporter.get_finished_spans()
+    assert len(exported) == 6
+    assert exported[0].attributes['spans.dropped'] == 46
+    assert exported[0].attributes['stage.scan_file.count'] == 50
+
+
+def test_short_traces_keep_every_span_and_no_extra_attributes():
+    trace = start_trace('GET /health')
+    with span('db_read'):
+        pass
+    end_trace(trace)
+
+    assert [s.name for s in trace.spans] == ['db_read']
+    assert trace.root.attributes == {}
@@ -0,0 +1,68 @@
+"""
+Desempaquetado por capas: memo solo de subárboles completos y archivos truncados marcados
+"""
+import base64
+
+from app.modules.antivirus import unpacker as unpacker_module
+from app.modules.antivirus.unpacker import LayerUnpacker
+
+PAYLOAD = b'<?php system($_GET["cmd"]); /* webshell */ ?>'
+
+
+def _wrap(data: bytes, times: int) -> bytes:
+    for _ in range(times):
+        data = b"<?php eval(base64_decode('" + base64.b64encode(data) + b"')); ?>"
+    return data
+
+
+def _matcher(complete=True):
+    calls = []
+
+    def match(layer):
+        calls.append(layer)
+        findings = [{'signature': 'webshell', 'severity': 'critical', 'pattern': None, 'code_snippet': ''}]
+        return (findings if b'system(' in layer else []), complete
+
+    return match, calls
+
+
+def test_complete_layers_are_memoized(monkeypatch):
+    monkeypatch.setattr(unpacker_module, '_memo', type(unpacker_module._memo)())
+    match, calls = _matcher()
+    data = _wrap(PAYLOAD, 2)
+
+    first = LayerUnpacker(match, 'v-memo')
+    findings = first.scan(data)
+    assert [f['layers'] for f in findings] == [('base64_decode', 'base64_decode')]
+    assert not first.truncated
+
+    seen = len(calls)
+    assert LayerUnpacker(match, 'v-memo').scan(data) == findings
+    assert len(calls) == seen
+
+
+def test_timed_out_layers_are_not_memoized(monkeypatch):
+    monkeypatch.setattr(unpacker_module, '_memo', type(unpacker_module._memo)())
+    match, calls = _matcher(complete=False)
+    data = _wrap(PAYLOAD, 1)
+
+    unpacker = LayerUnpacker(match, 'v-timeout')
+    assert unpacker.scan(data)
+    assert unpacker.truncated
+    assert not unpacker_module._memo
+
+    LayerUnpacker(match, 'v-timeout').scan(data)
+    assert len(calls) == 2
+
+
+def test_depth_limit_truncates_the_file(monkeypatch):
+    monkeypatch.setattr(unpacker_module, '_memo', type(unpacker_module._memo)())
+    match, _ = _matcher()
+
+    unpacker = LayerUnpacker(match, 'v-depth', max_depth=2)
+    assert unpacker.scan(_wrap(PAYLOAD, 4)) == []
+    assert unpacker.truncated
+
+    shallow = LayerUnpacker(match, 'v-depth', max_depth=6)
+    assert shallow.scan(_wrap(PAYLOAD, 3))
+    assert not shallow.truncated
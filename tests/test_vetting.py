@@ -0,0 +1,97 @@
+"""
+Vetado de patrones al cargar las firmas (sondeo de backtracking catastrófico)
+"""
+import re
+
+from app.modules.antivirus import signatures as signatures_module
+from app.modules.antivirus.rules import regex_flags
+from app.modules.antivirus.sandbox import vet_pattern
+from app.modules.antivirus.signatures import CompiledSignatures, MatchState, SignatureManager, vet_signatures
+
+
+def test_nested_quantifier_anchored_at_end_is_rejected():
+    effective, issues = vet_pattern(r'(a+)+$', 0)
+    assert effective is None
+    assert issues
+
+
+def test_overlapping_alternation_anchored_at_end_is_rejected():
+    effective, _ = vet_pattern(r'(a|aa)+$', 0)
+    assert effective is None
+
+
+def test_linear_pattern_is_accepted_unchanged():
+    effective, issues = vet_pattern(r'eval\s*\(\s*base64_decode', re.IGNORECASE)
+    assert effective == r'eval\s*\(\s*base64_decode'
+    assert issues == []
+
+
+def test_regex_flags_include_nocase_modifier_and_dotall():
+    assert regex_flags({'type': 'regex', 'value': 'x', 'modifiers': ['nocase']}) == re.IGNORECASE
+    assert regex_flags({'type': 'regex', 'value': 'x', 'flags': 's'}) == re.DOTALL
+    assert regex_flags({'type': 'regex', 'value': 'x', 'flags': 'is'}) == re.IGNORECASE | re.DOTALL
+
+
+class _FailingSandbox:
+    """Sandbox cuyos procesos no arrancan o mueren las primeras `failures` veces"""
+
+    def __init__(self, failures, outcome='error'):
+        self.failures = failures
+        self.outcome = outcome
+        self.calls = 0
+
+    def search_many(self, patterns, data, deadline=None, timeout=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            return [None] * len(patterns), [0] * len(patterns), [self.outcome] * len(patterns)
+        return [None] * len(patterns), [1000] * len(patterns), ['ok'] * len(patterns)
+
+
+def test_stock_signatures_survive_vetting_with_bounded_wildcards(tmp_path):
+    defaults = SignatureManager(str(tmp_path))._get_default_signatures()
+
+    accepted, _, rejected = vet_signatures(defaults, [])
+
+    assert rejected == []
+    effective = {s['name']: s.get('effective_pattern') for s in accepted}
+    assert effective['preg_replace /e modifier'] == r'preg_replace\s*\(.{0,1000}\/e'
+
+
+def test_sandbox_failures_are_retried_not_rejected():
+    sandbox = _FailingSandbox(failures=2)
+    effective, _ = vet_pattern(r'move_uploaded_file.*\$_(FILES|POST)', re.IGNORECASE, sandbox)
+    assert effective == r'move_uploaded_file.{0,1000}\$_(FILES|POST)'
+
+    broken = _FailingSandbox(failures=10 ** 6)
+    effective, _ = vet_pattern(r'move_uploaded_file.*\$_(FILES|POST)', re.IGNORECASE, broken)
+    assert effective is not None
+
+
+def test_disabled_patterns_leave_the_scan_incomplete():
+    compiled = CompiledSignatures([{
+        'name': 'Eval with Base64', 'pattern': r'eval\s*\(\s*base64_decode', 'severity': 'critical'
+    }], 'v1')
+    state = MatchState()
+
+    matches = compiled.match_bytes(
+        b'<?php eval(base64_decode("x"));', lambda start, end: None, _FailingSandbox(1, 'disabled'), state
+    )
+
+    assert matches == []
+    assert state.skipped == 1 and state.exhausted
+
+
+def test_version_changes_when_signatures_are_rejected(tmp_path, monkeypatch):
+    manager = SignatureManager(str(tmp_path))
+    full = manager.get_compiled().version
+
+    def reject_first(signatures, rules):
+        rejected = [{'name': signatures[0]['name'], 'pattern': signatures[0]['pattern'], 'issues': []}]
+        return signatures[1:], rules, rejected
+
+    monkeypatch.setattr(signatures_module, 'vet_signatures', reject_first)
+    partial = SignatureManager(str(tmp_path)).get_compiled()
+
+    assert partial.version.startswith(full + '-r')
+    assert partial.version != full
+    assert SignatureManager(str(tmp_path)).get_compiled().version == partial.version